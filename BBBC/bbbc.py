@@ -1,22 +1,31 @@
+import os
 import sys
+import json
 import time
-import subprocess
+import threading
 from typing import Optional
+from functools import partial
 from pathlib import Path
 import logging
-import numpy as np
 import typer
 from nyxus import Nyxus
-from tqdm import tqdm
-import preadator
-from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import filepattern as fp
-from multiprocessing import cpu_count
-from bfio import BioReader
-import vaex
 import re
 import shutil
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from common.ome_converter import NUM_WORKERS, convert_directory, convert_files, output_name
+from common.executor import Job, JobResult, run_job, container_command
+from common.scheduler import available_cpus, nyxus_threads
+from common.feature_cache import open_cache, featurize_files_cached
+from common.tiled_features import featurize_directory_tiled
+from common.image_index import ImageIndex, resolution_groups, featurize_by_resolution
+from common.inventory import Inventory
+from common.pipeline import Stage, Pipeline
+from common.arrow_metadata import attach_metadata
+
 
 app = typer.Typer()
 
@@ -28,21 +37,127 @@ logger = logging.getLogger("Download bbbc dataset")
 logger.setLevel(logging.INFO)
 
 
-NUM_THREADS = max(cpu_count() // 2, 2)
-   
-def bbc_download() -> None:  
-    """ 
+DOWNLOAD_DIR = Path("/projects/PanMicroscopy/data")
+DOWNLOAD_PLUGIN = "bbbc-download-plugin_0_1_0-dev1.sif"
+RENAMING_PLUGIN = "/home/abbasih2/plugins/file-renaming-tool_0_2_4_dev2.sif"
+JOB_TIMEOUT = 4 * 3600
+DOWNLOAD_SLOTS = 3
+DOWNLOAD_TIMEOUT = 12 * 3600
+DOWNLOAD_RETRIES = 3
+MIN_FREE_GB = 100
+
+
+def download_status_path(out_dir:Path, name:str) -> Path:
+    return Path(out_dir, ".download_status", f"{name}.json")
+
+
+def read_download_status(out_dir:Path, name:str) -> dict:
+    status_path = download_status_path(out_dir, name)
+    if not status_path.exists():
+        return {}
+    with open(status_path, "r") as fh:
+        return json.load(fh)
+
+
+def write_download_status(out_dir:Path, name:str, **status) -> None:
+    status_path = download_status_path(out_dir, name)
+    status_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = status_path.with_suffix(".tmp")
+    with open(tmp, "w") as fh:
+        json.dump({"name": name, **status}, fh, indent=1)
+    os.replace(tmp, status_path)
+
+
+def wait_for_space(out_dir:Path, min_free_gb:float, running:dict, poll:int=60) -> None:
+    """ Block until out_dir has min_free_gb free, as long as other downloads may still free up space
+    """
+    while True:
+        free_gb = shutil.disk_usage(out_dir).free / 1024 ** 3
+        if free_gb >= min_free_gb:
+            return
+        with running["lock"]:
+            others = running["count"]
+        if others == 0:
+            raise IOError(f"Only {free_gb:.1f} GB free on {out_dir}, {min_free_gb} GB required")
+        logger.info(f"{free_gb:.1f} GB free on {out_dir}, waiting for {others} running downloads")
+        time.sleep(poll)
+
+
+def download_dataset(name:str, out_dir:Path, running:dict, timeout:int, retries:int, min_free_gb:float) -> JobResult:
+    """ Run the download plugin for one dataset with retries and a status file
+    """
+    job = Job(
+        name=name,
+        command=container_command(DOWNLOAD_PLUGIN, [f"--name={name}", f"--outDir={out_dir}"]),
+        log_path=download_status_path(out_dir, name).with_suffix(".log"),
+        timeout=timeout,
+        retries=retries,
+        backoff=60,
+    )
+
+    try:
+        wait_for_space(out_dir, min_free_gb, running)
+        write_download_status(out_dir, name, state="running")
+        with running["lock"]:
+            running["count"] += 1
+        try:
+            result = run_job(job)
+        finally:
+            with running["lock"]:
+                running["count"] -= 1
+    except Exception as e:
+        # The status file must not be left saying running, or stale from an earlier run
+        write_download_status(out_dir, name, state="failed", error=str(e))
+        raise
+
+    state = "done" if result.ok else "failed"
+    write_download_status(
+        out_dir, name, state=state, attempt=result.attempts, duration=result.duration,
+        returncode=result.returncode, peak_rss_mb=result.peak_rss_mb,
+    )
+    if not result.ok:
+        raise RuntimeError(f"Download of {name} failed after {result.attempts} attempts, see {result.log_path}")
+
+    logger.info(f"Downloaded {name} in {result.duration / 60:.1f} minutes")
+    return result
+
+
+def bbc_download(
+    namelist:Optional[list]=None,
+    out_dir:Path=DOWNLOAD_DIR,
+    slots:int=DOWNLOAD_SLOTS,
+    timeout:int=DOWNLOAD_TIMEOUT,
+    retries:int=DOWNLOAD_RETRIES,
+    min_free_gb:float=MIN_FREE_GB,
+) -> None:
+    """ Download BBBC datasets, several at a time
+
+    Datasets whose status file says done are skipped, each dataset waits for
+    min_free_gb on the output volume before it starts, and failures are
+    retried with exponential backoff.
     """
     logger.info('downloading')
 
-    namelist = ["BBBC017", "BBBC021", "BBBC022"
-    ]
+    if namelist is None:
+        namelist = ["BBBC017", "BBBC021", "BBBC022"
+        ]
 
-    for name in namelist:
-        command =  f"singularity run --bind /projects/PanMicroscopy:/projects/PanMicroscopy bbbc-download-plugin_0_1_0-dev1.sif --name={name} --outDir=/projects/PanMicroscopy/data"
+    todo = [name for name in namelist if read_download_status(out_dir, name).get("state") != "done"]
+    logger.info(f"{len(namelist) - len(todo)} of {len(namelist)} datasets already downloaded")
+
+    running = {"lock": threading.Lock(), "count": 0}
+
+    with ThreadPoolExecutor(max_workers=slots) as executor:
+        threads = {
+            executor.submit(download_dataset, name, out_dir, running, timeout, retries, min_free_gb): name
+            for name in todo
+        }
+        for f in as_completed(threads):
+            try:
+                f.result()
+            except Exception as e:
+                logger.error(f"{threads[f]}: {e}")
 
-        p = subprocess.run(command,shell=True,stdout=subprocess.PIPE)
-    
     return 
 
 # def file_renaming(name:str, file_pattern:str, out_file_pattern:str, out_dir:Path) -> None:  
@@ -68,56 +183,128 @@ def bbc_download() -> None:
 
 #     return 
 
-def max_path_parts(path):
-    # Create a Path object
-    path_obj = Path(path)
-    
-    # Get the parts of the path
-    path_parts = path_obj.parts
-    
-    # Get the number of parts
-    num_parts = len(path_parts)
-    
-    return num_parts
+# Compiled once, these normalise the BBBC007/BBBC020 folder and image names
+FOLDER_CHARS = re.compile(r'\W+')
+IMAGE_CHARS = re.compile(r'[\s+\+|()|_|-]')
+LINK_MODES = ["hardlink", "symlink", "map"]
 
-def file_renaming(inp_dir:Path, name:str, file_pattern:str, out_file_pattern:str, out_dir:Path) -> None:  
-    """ File Renaming 
-    """
 
-    command =  f"singularity run --bind /projects/PanMicroscopy:/projects/PanMicroscopy /home/abbasih2/plugins/file-renaming-tool_0_2_4_dev2.sif --inpDir={inp_dir} --filePattern={file_pattern} --outFilePattern={out_file_pattern} --outDir={out_dir}"
+def rename_map(folderpath:list, rename_root:Path, file_pattern:str, inventory:Optional[Inventory]=None) -> dict:
+    """ Normalised name of every image, grouped by normalised folder
 
-    _ = subprocess.run(command,shell=True,stdout=subprocess.PIPE)
+    Images are listed from the inventory when one is given. Returns
+    {rename folder: {renamed image path: source image path}}.
+    """
+    renamed = {}
+    for fl in folderpath:
+        flname = FOLDER_CHARS.sub('_', fl.name).rstrip('_')
+        rename_dir = Path(rename_root, fl.parent.name, flname)
+        file_map = renamed.setdefault(rename_dir, {})
+
+        if inventory is not None:
+            images = inventory.files(fl, file_pattern)
+        else:
+            images = [f[1][0] for f in fp.FilePattern(fl, file_pattern)()]
+        for image in images:
+            file_map[Path(rename_dir, IMAGE_CHARS.sub('', image.name))] = image
+    return renamed
+
+
+def link_renamed(renamed:dict, mode:str="hardlink") -> str:
+    """ Expose renamed images as hardlinks or symlinks instead of copies
+
+    Falls back from hardlink to symlink to an in-memory map when the
+    filesystem refuses a link, and returns the mode that ended up in use.
+    With "map" nothing is written and downstream stages read the sources
+    through the mapping.
+    """
+    modes = LINK_MODES[LINK_MODES.index(mode):]
+    mode = modes.pop(0)
+    for rename_dir, file_map in renamed.items():
+        if mode == "map":
+            break
+        rename_dir.mkdir(parents=True, exist_ok=True)
+        for newname, image in file_map.items():
+            while mode != "map":
+                try:
+                    if newname.exists() and newname.samefile(image):
+                        break
+                    if newname.is_symlink() or newname.exists():
+                        newname.unlink()
+                    if mode == "hardlink":
+                        os.link(image, newname)
+                    else:
+                        os.symlink(Path(image).resolve(), newname)
+                    break
+                except OSError as e:
+                    logger.warning(f"Cannot {mode} {image} ({e}), falling back to {modes[0]}")
+                    mode = modes.pop(0)
+    return mode
 
 
-    return 
+def file_renaming(inp_dir:Path, name:str, file_pattern:str, out_file_pattern:str, out_dir:Path) -> JobResult:  
+    """ File Renaming 
+    """
+    job = Job(
+        name=f"file_renaming_{name}",
+        command=container_command(RENAMING_PLUGIN, [
+            f"--inpDir={inp_dir}", f"--filePattern={file_pattern}",
+            f"--outFilePattern={out_file_pattern}", f"--outDir={out_dir}",
+        ]),
+        log_path=Path(out_dir, "logs", f"file_renaming_{name}.log"),
+        timeout=JOB_TIMEOUT,
+        retries=2,
+    )
+    result = run_job(job)
+    if not result.ok:
+        logger.error(f"File renaming of {name} failed with exit code {result.returncode}, see {result.log_path}")
 
+    return result
 
 
-def omeconverter(inp_dir:Path, file_pattern:str, file_extension:str, out_dir:Path) -> None:  
-    """ Ome Converter 
-    """
-    command =  f"singularity run --bind /projects/PanMicroscopy:/projects/PanMicroscopy /home/abbasih2/plugins/ome-converter-tool_0_1_0_dev0.sif --inpDir={inp_dir} --filePattern={file_pattern} --fileExtension={file_extension} --outDir={out_dir}"
-    # command =  f"singularity run --bind /projects/PanMicroscopy:/projects/PanMicroscopy --fakeroot /home/abbasih2/plugins/ome-converter-plugin_0_3_2_dev1.sif --env USER=polusai --userns --uid 1001 --inpDir={inp_dir} --filePattern={file_pattern} --fileExtension={file_extension} --outDir={out_dir}"
 
-    _ = subprocess.run(command,shell=True,stdout=subprocess.PIPE)
+def omeconverter(inp_dir:Path, file_pattern:str, file_extension:str, out_dir:Path, file_map:Optional[dict]=None, num_workers:int=NUM_WORKERS) -> None:  
+    """ Ome Converter 
 
+    With file_map (renamed path -> source path) the sources are converted
+    directly and the outputs named after the renamed paths.
+    """
+    if file_map is None:
+        result = convert_directory(inp_dir, file_pattern, file_extension, out_dir, num_workers=num_workers)
+    else:
+        result = convert_files(
+            {src: Path(out_dir, output_name(new, file_extension)) for new, src in file_map.items()},
+            num_workers=num_workers,
+            desc=str(inp_dir),
+        )
+    if result["failed"]:
+        logger.warning(f"{len(result['failed'])} images in {inp_dir} could not be converted")
 
     return 
 
 
-def nyxfun(intensity_dir, file_pattern, out_dir, pixels_per_micron):
+def nyxfun(intensity_dir, file_pattern, out_dir, pixels_per_micron, dataset=None, tile_memory_mb=None, aggregate_tiles=False, n_threads=None):
 
     nyx = Nyxus(["*ALL*"])
 
     nyx_params = {
         "neighbor_distance": 5,
         "pixels_per_micron": pixels_per_micron,
-        # "n_feature_calc_threads": 8,
+        "n_feature_calc_threads": n_threads or nyxus_threads(dataset),
     }
 
     nyx.set_params(**nyx_params)
 
-    
+    # Large images: featurize tile by tile within a memory budget
+    if tile_memory_mb:
+        featurize_directory_tiled(nyx, intensity_dir, file_pattern, out_dir, tile_memory_mb, aggregate=aggregate_tiles)
+        return
+
+    cache = open_cache(["*ALL*"], nyx_params, mode="directory")
+    if cache is not None:
+        featurize_files_cached(nyx, intensity_dir, file_pattern, Path(out_dir, "NyxusFeatures.arrow"), cache)
+        return
+
     nyx.featurize_directory(intensity_dir=str(intensity_dir), 
                             label_dir=None,
                             file_pattern=file_pattern,
@@ -125,6 +312,56 @@ def nyxfun(intensity_dir, file_pattern, out_dir, pixels_per_micron):
                             output_path = str(out_dir))
     
 
+def convert_folder(unit:dict, num_workers:int=NUM_WORKERS) -> dict:
+    """ Pipeline stage converting a folder's images to ome.tif with num_workers processes
+    """
+    ome_dir = unit["ome_dir"]
+    if not ome_dir.exists():
+        ome_dir.mkdir(parents=True, exist_ok=True)
+        logger.info(f"{ome_dir} is created")
+
+    omeconverter(inp_dir=unit["source"], file_pattern=unit["file_pattern"], file_extension=".ome.tif",
+                 out_dir=ome_dir, file_map=unit["file_map"], num_workers=num_workers)
+    return unit
+
+
+def featurize_folder(unit:dict, dataset:str, tile_memory_mb=None, aggregate_tiles=False, n_threads=None) -> Optional[dict]:
+    """ Pipeline stage extracting the nyxus features of a converted folder
+    """
+    image_path = [f[1][0] for f in fp.FilePattern(unit["ome_dir"], ".*.ome.tif")()]
+    if len(image_path) == 0:
+        logger.warning(f"No converted images in {unit['ome_dir']}")
+        return None
+
+    logger.info(f"Extracting nyxus feature {dataset}")
+    nyxdir = unit["nyxdir"]
+    nyxdir.mkdir(exist_ok=True, parents=True)
+
+    # sqlite connections stay in the thread that opened them
+    index = ImageIndex()
+    headers = index.headers(image_path)
+    index.close()
+    logger.info(f'pixels_per_micro: {", ".join(str(v) for v in resolution_groups(headers))}')
+
+    featurize_by_resolution(nyxfun, unit["ome_dir"], ".*.ome.tif", nyxdir, headers, dataset=dataset,
+                            tile_memory_mb=tile_memory_mb, aggregate_tiles=aggregate_tiles, n_threads=n_threads)
+    return unit
+
+
+def annotate_folder(unit:dict, dataset:str) -> dict:
+    """ Pipeline stage adding the dataset, plate and path columns to a folder's features
+    """
+    nyxdir = unit["nyxdir"]
+    arrowpath = Path(nyxdir, 'NyxusFeatures.arrow')
+
+    attach_metadata(
+        arrowpath,
+        {"dataset": dataset, "plate": unit["plate"], "path": unit["ome_dir"]},
+        out_path=nyxdir.joinpath("combined_NyxusFeatures.arrow"),
+    )
+    return unit
+
+
 def feature_extraction(intensity_dir, file_pattern, out_dir):
 
     fps = fp.FilePattern(intensity_dir, file_pattern)
@@ -132,29 +369,6 @@ def feature_extraction(intensity_dir, file_pattern, out_dir):
     # flist = [f[1][0] for f in fps()]
 
     # logger.info("Processing BBBC dataset")
-
-
-    # with preadator.ProcessManager(
-    #     name="Extracting nyxus features",
-    #     num_processes=NUM_THREADS,
-    #     threads_per_process=20,
-    # ) as executor:
-    #     threads = []
-    #     for f in flist:
-    #         threads.append(
-    #             executor.submit(nyxfun, f, file_pattern, out_dir),
-    #         )
-
-    #     for f in tqdm(
-    #         as_completed(threads),
-    #         total=len(threads),
-    #         mininterval=5,
-    #         desc=f"Extracting features {f}",
-    #         initial=0,
-    #         unit_scale=True,
-    #         colour="cyan",
-    #     ):
-    #         f.result()
                             
 
 
@@ -195,17 +409,35 @@ def main(
         writable=True,
         file_okay=False,
         dir_okay=True,
-    )
+    ),
+    link_mode: str = typer.Option(
+        "hardlink",
+        "--linkMode",
+        help="How renamed BBBC007/BBBC020 images are exposed: hardlink, symlink or map",
+    ),
+    tile_memory_mb: float = typer.Option(
+        None,
+        "--tileMemoryMB",
+        help="Featurize images tile by tile, sizing tiles to this memory budget per worker",
+    ),
+    aggregate_tiles: bool = typer.Option(
+        False,
+        "--aggregateTiles",
+        help="With --tileMemoryMB, write one row per image with mean, std, min and max over its tiles",
+    ),
+    convert_workers: int = typer.Option(1, "--convertWorkers", help="Folders converted at once"),
+    featurize_workers: int = typer.Option(1, "--featurizeWorkers", help="Folders featurized at once, sharing the Nyxus threads"),
+    annotate_workers: int = typer.Option(1, "--annotateWorkers", help="Folders annotated at once"),
+    queue_size: int = typer.Option(2, "--queueSize", help="Folders waiting between two stages"),
     ):
 
     starttime = time.time()
 
     inp_dir = inp_dir.joinpath(name)
 
-    folderpath = sorted([path for path in inp_dir.rglob('*') if path.is_dir() if "Images" in path.parts and not "Images" in path.name])
-    max_parts = max([max_path_parts(path) for path in inp_dir.rglob('*') if path.is_dir() and "Images" in path.parts])
-
-    folderpath = sorted([path for path in inp_dir.rglob('*') if path.is_dir() and "Images" in path.parts if max_path_parts(path) == max_parts])
+    # One walk of the tree; folders and images are then looked up in the listing
+    inventory = Inventory(inp_dir)
+    folderpath = inventory.leaf_dirs("Images")
 
 
     # rename_dir = Path(inp_dir, 'rename')
@@ -220,110 +452,63 @@ def main(
 
     # logger.info(f' Renaming images files of dataset: {name} --- Completed!!!')
 
+    units = []
     if name in ["BBBC007", "BBBC020"]:
-        for fl in folderpath:
-            root_path = fl.parent.name
-            rename = Path(f'{inp_dir}/rename/{root_path}')
-            flname = re.sub(r'\W+', '_', fl.name)
-            flname = flname.rstrip('_')
-            rename_dir = Path(rename, flname)
-            if not Path(rename_dir).exists():
-                Path(rename_dir).mkdir(parents=True, exist_ok=False)
-
-            files = fp.FilePattern(fl, file_pattern)
-
-            for image in files():
-                image = image[1][0]
-                imagename = re.sub(r'[\s+\+|()|_|-]', '', image.name)
-                newname = (Path(rename_dir, imagename))
-                shutil.copy(image, newname)
-
-    
-        renamepath = sorted([path for path in rename.rglob('*') if path.is_dir()])
-        for fl in renamepath:
-            fps = fp.FilePattern(fl, file_pattern)
-            flist = [f[1][0] for f in fps()]
-            if len(flist) > 0:
-                ome_dir = Path(inp_dir, 'omeconverted', fl.name)
-                if not Path(ome_dir).exists():
-                    Path(ome_dir).mkdir(parents=True, exist_ok=False)
-                logger.info(f"{ome_dir} is created") 
-
-                omeconverter(inp_dir=fl, file_pattern=file_pattern, file_extension=".ome.tif", out_dir=ome_dir)
-                logger.info(f"Extracting nyxus feature {name}")
-
-                nyxdir = Path(out_dir, name, fl.name)
-                if not nyxdir.exists():
-                    nyxdir.mkdir(exist_ok=True, parents=True)
-
-            
-                fps = fp.FilePattern(ome_dir, ".*.ome.tif")
-                image_path = [f[1][0] for f in fps()]
-                if len(image_path) > 0:
-                    br = BioReader(image_path[0])
-                    if br.physical_size_y[0] is not None:
-                        pixels_per_micron = br.physical_size_y[0]
-                    else:
-                        pixels_per_micron = 1.0
-
-                    logger.info(f'pixels_per_micro: {pixels_per_micron}')
-
-                    nyxfun(intensity_dir=ome_dir, file_pattern=".*.ome.tif", out_dir=nyxdir, pixels_per_micron = pixels_per_micron)
-
-                    arrowpath = Path(nyxdir, 'NyxusFeatures.arrow')
-
-                    x = vaex.open(arrowpath)
-                    x['dataset'] =  np.array([name] * len(x))
-                    x['plate'] =  np.array([fl.name] * len(x))
-                    x['path'] =  np.array([str(ome_dir)] * len(x))
-
-                    finishtime = (time.time() - starttime) / 60
-                    logger.info(f'total time taken in minutes {finishtime}')
-                    x.export_feather(nyxdir.joinpath(f"combined_NyxusFeatures.arrow"))
-                        
+        renamed = rename_map(folderpath, Path(inp_dir, 'rename'), file_pattern, inventory)
+        mode = link_renamed(renamed, link_mode)
+        logger.info(f"Renamed images of {name} exposed as {mode}")
+
+        for fl, file_map in sorted(renamed.items()):
+            if len(file_map) > 0:
+                # Parent and folder, as same-named folders of different parents run concurrently
+                relative = fl.relative_to(Path(inp_dir, 'rename'))
+                units.append({
+                    "plate": fl.name,
+                    "source": fl,
+                    "file_pattern": file_pattern,
+                    "file_map": file_map if mode == "map" else None,
+                    "ome_dir": Path(inp_dir, 'omeconverted', relative),
+                    "nyxdir": Path(out_dir, name, relative),
+                })
     else:
         for fl in folderpath:
             split_string = str(fl).split('Images')[-1].lstrip('/')
-            fps = fp.FilePattern(fl, file_pattern)
-            flist = [f[1][0] for f in fps()]
+            flist = inventory.files(fl, file_pattern)
             if len(flist) > 0:
-                ome_dir = Path(inp_dir, 'omeconverted', split_string)
-                if not Path(ome_dir).exists():
-                    Path(ome_dir ).mkdir(parents=True, exist_ok=False)
-                    logger.info(f"{ome_dir} is created")
-
-                omeconverter(inp_dir=fl, file_pattern=file_pattern, file_extension=".ome.tif", out_dir=ome_dir)
-
-                logger.info(f"Extracting nyxus feature {name}")
-
-                nyxdir = Path(out_dir, name, split_string)
-    
-                if not nyxdir.exists():
-                    nyxdir.mkdir(exist_ok=True, parents=True)
-
-            
-                fps = fp.FilePattern(ome_dir, ".*.ome.tif")
-                image_path = [f[1][0] for f in fps()][0]
-                br = BioReader(image_path)
-                if br.physical_size_y[0] is not None:
-                    pixels_per_micron = br.physical_size_y[0]
-                else:
-                    pixels_per_micron = 1.0
-
-                logger.info(f'pixels_per_micro: {pixels_per_micron}')
-
-                nyxfun(intensity_dir=ome_dir, file_pattern=".*.ome.tif", out_dir=nyxdir, pixels_per_micron = pixels_per_micron)
-
-                arrowpath = Path(nyxdir, 'NyxusFeatures.arrow')
-
-                x = vaex.open(arrowpath)
-                x['dataset'] =  np.array([name] * len(x))
-                x['plate'] =  np.array([fl.name] * len(x))
-                x['path'] =  np.array([str(ome_dir)] * len(x))
+                units.append({
+                    "plate": fl.name,
+                    "source": fl,
+                    "file_pattern": file_pattern,
+                    # The images are already listed, the converter does not list the folder again
+                    "file_map": {image: image for image in flist},
+                    "ome_dir": Path(inp_dir, 'omeconverted', split_string),
+                    "nyxdir": Path(out_dir, name, split_string),
+                })
+
+    # Conversion, featurization and annotation of different folders overlap, so
+    # the CPUs are shared between the converter pools and the Nyxus threads
+    cpus = available_cpus()
+    convert_processes = max(cpus // (convert_workers + featurize_workers), 1)
+    n_threads = max(min(nyxus_threads(name), cpus - convert_workers * convert_processes) // featurize_workers, 1)
+    logger.info(f"{convert_workers} x {convert_processes} converter processes, {featurize_workers} x {n_threads} Nyxus threads")
+    pipeline = Pipeline(
+        [
+            Stage("convert", partial(convert_folder, num_workers=convert_processes), workers=convert_workers, queue_size=queue_size),
+            Stage(
+                "featurize",
+                partial(featurize_folder, dataset=name, tile_memory_mb=tile_memory_mb,
+                        aggregate_tiles=aggregate_tiles, n_threads=n_threads),
+                workers=featurize_workers,
+                queue_size=queue_size,
+            ),
+            Stage("annotate", partial(annotate_folder, dataset=name), workers=annotate_workers, queue_size=queue_size),
+        ],
+        describe=lambda unit: str(unit["source"]),
+    )
+    pipeline.run(units)
 
-                finishtime = (time.time() - starttime) / 60
-                logger.info(f'total time taken in minutes {finishtime}')
-                x.export_feather(nyxdir.joinpath(f"combined_NyxusFeatures.arrow"))
+    finishtime = (time.time() - starttime) / 60
+    logger.info(f'{len(pipeline.results)} of {len(units)} folders done, total time taken in minutes {finishtime}')
 
 
 
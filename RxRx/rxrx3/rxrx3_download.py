@@ -1,17 +1,61 @@
 import os
+import json
+import shutil
+import tarfile
+import time
+import logging
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError as StreamError
 from bs4 import BeautifulSoup
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from multiprocessing import cpu_count
 from tqdm import tqdm
 from pathlib import Path
-import numpy as np
+import typer
 
-out_dir = Path('/projects/PanMicroscopy/data/recursionpharma/raw/rxrx3')
 
+app = typer.Typer()
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Download rxrx3 dataset")
+logger.setLevel(logging.INFO)
+
+out_dir = Path('/projects/PanMicroscopy/data/recursionpharma/raw/rxrx3')
+link_file = Path('/home/abbasih2/projects/PANMicroscopy_scripts/RxRx/rxrx3_links.txt')
 
 num_workers = max([cpu_count() , 2])
 
+MANIFEST_NAME = "download_manifest.json"
+CHUNK_SIZE = 1024 * 1024
+# Files above this size are fetched as parallel byte ranges
+SPLIT_SIZE = 512 * 1024 * 1024
+NUM_PARTS = 8
+MEMBER_LOG = ".members.jsonl"
+STREAM_RETRIES = 3
+
+PENDING, PARTIAL, DONE, FAILED = "pending", "partial", "done", "failed"
+
+_local = threading.local()
+
+
+def get_session(pool_size:int=num_workers) -> requests.Session:
+    """ Return a pooled HTTP session, one per thread
+    """
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _local.session = session
+    return session
 
 
 def extract_links_and_texts(text):
@@ -19,33 +63,327 @@ def extract_links_and_texts(text):
     links_texts = [(a['href'], a.text.split(' ')[0]) for a in soup.find_all('a', href=True)]
     return links_texts
 
-def download_content(url, filename):
-    images, compd, fname = filename.split('/')
-    outdir = Path(out_dir, images, compd)
-    if not Path(outdir).exists():
-        Path(outdir).mkdir(exist_ok=True, parents=True)
 
-    output_file_path = Path(outdir, fname)
+class Manifest:
+    """ Persistent record of every link to download
 
-    try:
-        response = requests.get(url, stream=True, verify=True)
+    Each entry is keyed by the relative target path and stores the url,
+    the expected size, the state and, for split files, the byte ranges
+    already completed. The manifest is rewritten atomically on every update
+    so an interrupted run can pick up where it stopped.
+    """
+
+    def __init__(self, path:Path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path, "r") as fh:
+                self.entries = json.load(fh)
+
+    def add(self, url:str, filename:str) -> None:
+        if filename not in self.entries:
+            self.entries[filename] = {"url": url, "path": filename, "size": None, "state": PENDING, "parts": []}
+
+    def update(self, filename:str, **kwargs) -> None:
+        with self.lock:
+            self.entries[filename].update(kwargs)
+            self.save()
+
+    def complete_part(self, filename:str, index:int) -> None:
+        """ Mark a byte range of a split file as written
+        """
+        with self.lock:
+            self.entries[filename]["parts"][index][2] = True
+            self.save()
+
+    def save(self) -> None:
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as fh:
+            json.dump(self.entries, fh, indent=1)
+        os.replace(tmp, self.path)
+
+    def pending(self, root:Path, stream:bool=False) -> list:
+        """ Entries that are not done, or done but missing/incomplete on disk
+        """
+        todo = []
+        for filename, entry in self.entries.items():
+            target = Path(root, filename)
+            if entry["state"] == DONE:
+                if stream and Path(plate_dir(root, filename), MEMBER_LOG).exists():
+                    continue
+                if not stream and target.exists() and target.stat().st_size == entry["size"]:
+                    continue
+            todo.append(entry)
+        return todo
+
+
+def plate_dir(root:Path, filename:str) -> Path:
+    """ Directory a plate tar is extracted into, images/<exp>/Plate1.tar -> images/<exp>/Plate1
+    """
+    tar_path = Path(root, filename)
+    return Path(tar_path.parent, tar_path.stem)
+
+
+class MemberLog:
+    """ Append-only record of tar members already written by a streaming ingest
+
+    Each line stores the member name, size and the absolute byte range the
+    member occupies in the archive, so an interrupted stream can be
+    restarted with a Range request at the first member not yet written.
+    """
+
+    def __init__(self, path:Path):
+        self.path = Path(path)
+        self.members = {}
+        self.end = 0
+        if self.path.exists():
+            with open(self.path, "r") as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn last line from an interrupted write
+                        break
+                    self.members[record["name"]] = record
+                    self.end = max(self.end, record["end"])
+
+    def add(self, name:str, size:int, offset:int, end:int) -> None:
+        record = {"name": name, "size": size, "offset": offset, "end": end}
+        with open(self.path, "a") as fh:
+            fh.write(json.dumps(record) + "\n")
+        self.members[name] = record
+        self.end = max(self.end, end)
+
+
+def build_manifest(text_block:str, root:Path) -> Manifest:
+    """ Parse the link page once into a manifest stored under root
+    """
+    manifest = Manifest(Path(root, MANIFEST_NAME))
+    for link, filename in extract_links_and_texts(text_block):
+        manifest.add(link, filename)
+    manifest.save()
+    return manifest
+
+
+def probe(url:str):
+    """ Return the remote size and whether the server accepts byte ranges
+    """
+    response = get_session().head(url, allow_redirects=True, timeout=60)
+    if not response.ok:
+        return None, False
+    size = response.headers.get("Content-Length")
+    ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    return (int(size) if size is not None else None), ranges
+
+
+def fetch_range(url:str, output_file_path:Path, start:int, end:int) -> int:
+    """ Write bytes start..end (inclusive) of url at the same offset in output_file_path
+    """
+    headers = {"Range": f"bytes={start}-{end}"}
+    written = 0
+    with get_session().get(url, headers=headers, stream=True, timeout=60) as response:
         response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError(f"Server ignored range request for {url}")
+        with open(output_file_path, "r+b") as file:
+            file.seek(start)
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                file.write(chunk)
+                written += len(chunk)
+    if written != end - start + 1:
+        raise IOError(f"Short read for {url} range {start}-{end}: {written} bytes")
+    return written
+
+
+def download_split(entry:dict, output_file_path:Path, manifest:Manifest, num_parts:int=NUM_PARTS) -> None:
+    """ Download a large file as parallel byte ranges, skipping ranges already done
+    """
+    size = entry["size"]
+    parts = entry["parts"]
+    if not parts:
+        step = -(-size // num_parts)
+        parts = [[start, min(start + step, size) - 1, False] for start in range(0, size, step)]
+        manifest.update(entry["path"], parts=parts, state=PARTIAL)
+
+    if not output_file_path.exists() or output_file_path.stat().st_size != size:
+        with open(output_file_path, "ab") as file:
+            file.truncate(size)
+
+    with ThreadPoolExecutor(max_workers=num_parts) as exe:
+        futures = {
+            exe.submit(fetch_range, entry["url"], output_file_path, start, end): i
+            for i, (start, end, done) in enumerate(parts) if not done
+        }
+        for f in as_completed(futures):
+            f.result()
+            manifest.complete_part(entry["path"], futures[f])
+
 
+def download_resume(entry:dict, output_file_path:Path) -> None:
+    """ Stream url into output_file_path, continuing from any partial file
+    """
+    offset = output_file_path.stat().st_size if output_file_path.exists() else 0
+    if entry["size"] is not None and offset > entry["size"]:
+        offset = 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
 
-        with open(str(output_file_path), "wb") as file: 
-            for chunk in response.iter_content(chunk_size=8192):
+    with get_session().get(entry["url"], headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 416:
+            return
+        response.raise_for_status()
+        mode = "ab" if offset and response.status_code == 206 else "wb"
+        with open(output_file_path, mode) as file:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
                 file.write(chunk)
 
-        print(f"Downloaded {filename}")
-    except requests.RequestException as e:
-        print(f"Error downloading {url}: {e}")
 
-def main(text_block):
-    links_texts = extract_links_and_texts(text_block)
+def written_prefix(parts:list) -> int:
+    """ Bytes of a split file known to be written: the finished parts contiguous from its start
+    """
+    end = 0
+    for start, stop, done in sorted(parts):
+        if not done or start != end:
+            break
+        end = stop + 1
+    return end
+
+
+def truncate_split(output_file_path:Path, length:int) -> None:
+    """ Cut a preallocated split file back to bytes actually written, so a plain resume sees no holes
+    """
+    if output_file_path.exists() and output_file_path.stat().st_size > length:
+        with open(output_file_path, "r+b") as file:
+            file.truncate(length)
+
+
+def download_content(entry:dict, root:Path, manifest:Manifest, split_size:int=SPLIT_SIZE) -> str:
+    filename = entry["path"]
+    output_file_path = Path(root, filename)
+    output_file_path.parent.mkdir(exist_ok=True, parents=True)
+
+    try:
+        size, ranges = probe(entry["url"])
+        parts = entry["parts"]
+        unfinished = any(not done for _, _, done in parts)
+        # A split file is preallocated, so its size says nothing about what was written
+        if unfinished and size is None:
+            raise IOError(f"Cannot resume the split download of {filename}: remote size unknown")
+        if parts and entry["size"] != size:
+            # Ranges of an earlier run are only valid for the same file
+            truncate_split(output_file_path, 0)
+            parts = []
+        elif unfinished and not ranges:
+            truncate_split(output_file_path, written_prefix(parts))
+            parts = []
+        manifest.update(filename, size=size, parts=parts)
+        entry = manifest.entries[filename]
+
+        # An interrupted split download resumes as one, whatever split_size is now
+        if parts or (ranges and size is not None and size >= split_size):
+            download_split(entry, output_file_path, manifest)
+        else:
+            manifest.update(filename, state=PARTIAL)
+            download_resume(entry, output_file_path)
+
+        actual = output_file_path.stat().st_size
+        if size is not None and actual != size:
+            raise IOError(f"Size mismatch for {filename}: expected {size}, got {actual}")
+
+        manifest.update(filename, size=actual, state=DONE)
+        logger.info(f"Downloaded {filename}")
+    except (requests.RequestException, IOError) as e:
+        manifest.update(filename, state=FAILED)
+        logger.error(f"Error downloading {entry['url']}: {e}")
+        raise
+    return filename
+
+
+def extract_stream(url:str, target_dir:Path, log:MemberLog, ranges:bool) -> int:
+    """ Pipe the response body of url through a tar stream reader into target_dir
+
+    Resumes at the first member not recorded in log when the server accepts
+    byte ranges, otherwise restarts the stream and skips logged members.
+    Returns the number of members written.
+    """
+    offset = log.end if ranges else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    written = 0
+
+    with get_session().get(url, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 416:
+            return written
+        response.raise_for_status()
+        if offset and response.status_code != 206:
+            offset = 0
+        response.raw.decode_content = True
+
+        with tarfile.open(fileobj=response.raw, mode="r|*") as tar:
+            for member in tar:
+                if not member.isfile() or member.name in log.members:
+                    continue
+                dest = Path(target_dir, member.name).resolve()
+                if target_dir.resolve() not in dest.parents:
+                    raise IOError(f"Refusing to extract {member.name} outside {target_dir}")
+                dest.parent.mkdir(exist_ok=True, parents=True)
+
+                tmp = dest.with_name(dest.name + ".part")
+                with tar.extractfile(member) as src, open(tmp, "wb") as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                os.replace(tmp, dest)
 
+                end = offset + member.offset_data + -(-member.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                log.add(member.name, member.size, offset + member.offset, end)
+                written += 1
+    return written
 
-    with ThreadPoolExecutor(max_workers=num_workers) as exe:
-        threads = [exe.submit(download_content, link, filename) for link, filename in links_texts]
+
+def stream_content(entry:dict, root:Path, manifest:Manifest) -> str:
+    """ Extract a plate tar straight from the HTTP stream without landing the .tar on disk
+    """
+    filename = entry["path"]
+    target_dir = plate_dir(root, filename)
+    target_dir.mkdir(exist_ok=True, parents=True)
+    log = MemberLog(Path(target_dir, MEMBER_LOG))
+
+    size, ranges = probe(entry["url"])
+    # Byte offsets only line up with the archive when it is not compressed
+    ranges = ranges and filename.endswith(".tar")
+    manifest.update(filename, size=size, state=PARTIAL)
+
+    for attempt in range(1, STREAM_RETRIES + 1):
+        try:
+            written = extract_stream(entry["url"], target_dir, log, ranges)
+            break
+        except (requests.RequestException, StreamError, tarfile.TarError, IOError) as e:
+            logger.warning(f"Stream of {filename} interrupted after {len(log.members)} members (attempt {attempt}): {e}")
+            if attempt == STREAM_RETRIES:
+                manifest.update(filename, state=FAILED)
+                raise
+            time.sleep(2 ** attempt)
+
+    manifest.update(filename, state=DONE)
+    logger.info(f"Extracted {filename}: {written} new members, {len(log.members)} total")
+    return filename
+
+
+def download_all(text_block:str, root:Path, workers:int=num_workers, split_size:int=SPLIT_SIZE, stream:bool=False) -> Manifest:
+    """ Download every link in text_block below root, skipping completed entries
+
+    With stream set, plate tars are extracted while they download instead of
+    being written to disk.
+    """
+    root = Path(root)
+    root.mkdir(exist_ok=True, parents=True)
+    manifest = build_manifest(text_block, root)
+    todo = manifest.pending(root, stream=stream)
+    logger.info(f"{len(manifest.entries) - len(todo)} of {len(manifest.entries)} files already downloaded")
+
+    with ThreadPoolExecutor(max_workers=workers) as exe:
+        if stream:
+            threads = [exe.submit(stream_content, entry, root, manifest) for entry in todo]
+        else:
+            threads = [exe.submit(download_content, entry, root, manifest, split_size) for entry in todo]
 
         for f in tqdm(
             as_completed(threads),
@@ -57,17 +395,64 @@ def main(text_block):
             colour="cyan",
         ):
             try:
-            # Wait for the result of the future and print it
-                f.result()  # This will also raise exceptions if any
-                print(f"Thread {f} has completed successfully.")
+                f.result()
             except Exception as e:
-                # Print out an error message if an exception occurred
-                print(f"Thread {f} encountered an error: {e}")
+                logger.error(f"Download failed: {e}")
 
+    return manifest
 
-if __name__ == "__main__":
-    # Load text from file linktxt.txt
-    with open('/home/abbasih2/projects/PANMicroscopy_scripts/RxRx/rxrx3_links.txt', 'r') as file:
+
+@app.command()
+def main(
+    link_path: Path = typer.Option(
+        link_file,
+        "--linkFile",
+        help="HTML page listing the rxrx3 download links",
+        exists=True,
+        resolve_path=True,
+        readable=True,
+        file_okay=True,
+        dir_okay=False,
+    ),
+    output_dir: Path = typer.Option(
+        out_dir,
+        "--outDir",
+        help="Output directory",
+        resolve_path=True,
+        file_okay=False,
+        dir_okay=True,
+    ),
+    workers: int = typer.Option(
+        num_workers,
+        "--workers",
+        help="Number of files downloaded concurrently",
+    ),
+    split_size: int = typer.Option(
+        SPLIT_SIZE,
+        "--splitSize",
+        help="Files larger than this many bytes are downloaded as parallel ranges",
+    ),
+    stream: bool = typer.Option(
+        False,
+        "--stream",
+        help="Extract plate tars while downloading instead of saving the .tar",
+    ),
+    ):
+
+    starttime = time.time()
+
+    with open(link_path, 'r') as file:
         text_block = file.read()
 
-    main(text_block)
\ No newline at end of file
+    manifest = download_all(text_block, output_dir, workers=workers, split_size=split_size, stream=stream)
+
+    failed = [e["path"] for e in manifest.entries.values() if e["state"] != DONE]
+    if failed:
+        logger.warning(f"{len(failed)} files not downloaded, rerun to resume: {failed[:10]}")
+
+    finishtime = (time.time() - starttime) / 60
+    logger.info(f'total time taken in minutes {finishtime}')
+
+
+if __name__ == "__main__":
+    app()
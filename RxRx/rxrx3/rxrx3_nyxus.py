@@ -1,15 +1,23 @@
 import time
 from pathlib import Path
 import logging
-import numpy as np
 import typer
 from nyxus import Nyxus
 from tqdm import tqdm
 import filepattern as fp
-from bfio import BioReader
-import vaex
 import re
 import os
+import sys
+import json
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+from common.scheduler import nyxus_threads
+from common.feature_cache import open_cache, featurize_files_cached
+from common.backfill import backfill, remove_sidecars
+from common.image_index import ImageIndex, resolution_groups, featurize_by_resolution
+from common.inventory import Inventory
+from common.arrow_metadata import attach_metadata
 
 
 app = typer.Typer()
@@ -65,19 +73,23 @@ varlist = [
 
 
 
-def nyxfun(intensity_dir, file_pattern, out_dir, pixels_per_micron):
+def nyxfun(intensity_dir, file_pattern, out_dir, pixels_per_micron, dataset=None, features=varlist):
 
-    nyx = Nyxus(varlist)
+    nyx = Nyxus(features)
 
     nyx_params = {
         "neighbor_distance": 5,
         "pixels_per_micron": pixels_per_micron,
-        "n_feature_calc_threads": 8,
+        "n_feature_calc_threads": nyxus_threads(dataset),
     }
 
     nyx.set_params(**nyx_params)
 
-    
+    cache = open_cache(features, nyx_params, mode="directory")
+    if cache is not None:
+        featurize_files_cached(nyx, intensity_dir, file_pattern, Path(out_dir, "NyxusFeatures.arrow"), cache)
+        return
+
     nyx.featurize_directory(intensity_dir=str(intensity_dir), 
                             label_dir=None,
                             file_pattern=file_pattern,
@@ -106,37 +118,65 @@ def main(
         writable=True,
         file_okay=False,
         dir_okay=True,
-    )
+    ),
+    features: str = typer.Option(
+        None,
+        "--features",
+        help="Comma separated Nyxus features or @file.json from feature_profile.py plan, varlist when not given",
+    ),
+    backfill_features: bool = typer.Option(
+        False,
+        "--backfill",
+        help="Only compute the features missing from an existing NyxusFeatures.arrow",
+    ),
+    merge: bool = typer.Option(
+        False,
+        "--merge",
+        help="With --backfill, rewrite NyxusFeatures.arrow with the new columns instead of a sidecar file",
+    ),
     ):
 
     starttime = time.time()
 
-    fps = fp.FilePattern(inp_dir, ".*.ome.tif")
-    image_path = [f[1][0] for f in fps()]
-    if len(image_path) > 0:
-        br = BioReader(image_path[0])
-        if br.physical_size_y[0] is not None:
-            pixels_per_micron = br.physical_size_y[0]
-        else:
-            pixels_per_micron = 1.0
-
-    logger.info(f'pixels_per_micro: {pixels_per_micron}')
+    inventory = Inventory(inp_dir)
+    headers = ImageIndex().headers(inventory.files(inp_dir, ".*.ome.tif"))
+    if inventory.previous is not None:
+        logger.info(f'{len(inventory.changed())} images changed, {len(inventory.removed())} removed since the last run')
+    if not headers:
+        logger.warning(f"No images in {inp_dir}, nothing to featurize")
+        return
+    groups = resolution_groups(headers)
+
+    logger.info(f'pixels_per_micro: {", ".join(str(v) for v in groups)}')
+    # Plates are laid out as <dataset>/<experiment>/<plate>, the dataset also keys the autotuned profile
     dataset = inp_dir.parent.parent.name
     experiment = inp_dir.parent.name
     plate = re.findall(r'\d+',  inp_dir.name)[0]
-
-
-    nyxfun(intensity_dir=inp_dir, file_pattern=".*.ome.tif", out_dir=out_dir, pixels_per_micron = pixels_per_micron)
+    if features and features.startswith("@"):
+        with open(features[1:], "r") as fh:
+            features = json.load(fh)
+    else:
+        features = features.split(",") if features else varlist
 
     arrowpath = Path(out_dir, 'NyxusFeatures.arrow')
 
-    x = vaex.open(arrowpath)
-    x['dataset'] =  np.array([dataset] * len(x))
-    x['experiment'] =  np.array([experiment] * len(x))
-    x['plate'] =  np.array([plate] * len(x))
-    x['path'] =  np.array([str(inp_dir)] * len(x))
-
-    x.export_feather(out_dir.joinpath(f"NyxusFeatures.arrow"))
+    if backfill_features and arrowpath.exists():
+        # Each resolution is backfilled with its own pixels_per_micron, as featurize_by_resolution does
+        nyx_params = {
+            "neighbor_distance": 5,
+            "n_feature_calc_threads": nyxus_threads(dataset),
+        }
+        backfill(inp_dir, ".*.ome.tif", arrowpath, features, nyx_params, merge=merge, groups=groups)
+        finishtime = (time.time() - starttime) / 60
+        logger.info(f'total time taken in minutes {finishtime}')
+        return
+
+    # Sidecars of an earlier backfill belong to the rows being replaced
+    remove_sidecars(arrowpath)
+    featurize_by_resolution(nyxfun, inp_dir, ".*.ome.tif", out_dir, headers, dataset=dataset, features=features)
+
+    # Constant columns are appended to the existing batches and the file replaced atomically
+    attach_metadata(arrowpath, {"dataset": dataset, "experiment": experiment, "plate": plate, "path": inp_dir})
 
     finishtime = (time.time() - starttime) / 60
     logger.info(f'total time taken in minutes {finishtime}')
@@ -0,0 +1,185 @@
+from pathlib import Path
+import re
+import os
+import mmap
+import time
+import logging
+import tarfile
+import numpy as np
+import typer
+import imagecodecs
+from tqdm import tqdm
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+app = typer.Typer()
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Index tar files")
+logger.setLevel(logging.INFO)
+num_workers = max([cpu_count() , 2])
+
+INDEX_SUFFIX = ".idx.npz"
+
+# rxrx image names look like Plate1/B02_s1_w3.png
+image_pattern = re.compile(r"(?P<well>[A-Z]\d{2})_s(?P<site>\d+)_w(?P<channel>\d+)\.\w+$")
+
+
+def index_path(tar_file) -> Path:
+    return Path(f"{tar_file}{INDEX_SUFFIX}")
+
+
+def build_index(tar_file, force:bool=False) -> Path:
+    """ Scan a tar once and store member name, data offset and size in a sidecar
+
+    The sidecar also keeps the size and mtime of the tar it was built from so
+    that a stale index is rebuilt rather than served.
+    """
+    tar_file = Path(tar_file)
+    idx = index_path(tar_file)
+    stat = tar_file.stat()
+    if not force and idx.exists():
+        with np.load(idx) as data:
+            if int(data["tar_size"]) == stat.st_size and int(data["tar_mtime"]) == stat.st_mtime_ns:
+                return idx
+
+    names, offsets, sizes = [], [], []
+    with tarfile.open(tar_file, "r:") as tar:
+        for member in tar:
+            if member.isfile():
+                names.append(member.name)
+                offsets.append(member.offset_data)
+                sizes.append(member.size)
+
+    tmp = idx.with_name(idx.name + ".tmp.npz")
+    np.savez(
+        tmp,
+        names=np.array(names, dtype=str),
+        offsets=np.array(offsets, dtype=np.int64),
+        sizes=np.array(sizes, dtype=np.int64),
+        tar_size=np.int64(stat.st_size),
+        tar_mtime=np.int64(stat.st_mtime_ns),
+    )
+    os.replace(tmp, idx)
+    logger.info(f"Indexed {len(names)} members of '{tar_file}'")
+    return idx
+
+
+class TarReader:
+    """ Random access to the members of an indexed tar without extracting it
+
+    The archive is memory-mapped once and members are returned as memoryview
+    slices of the mapping, so reads are served from the page cache without
+    copying.
+    """
+
+    def __init__(self, tar_file):
+        self.tar_file = Path(tar_file)
+        with np.load(build_index(self.tar_file)) as data:
+            names, offsets, sizes = data["names"], data["offsets"], data["sizes"]
+        self.members = {name: (int(o), int(s)) for name, o, s in zip(names.tolist(), offsets, sizes)}
+        # (well, site, channel) of every image member, the first one wins like in a scan
+        self.images = {}
+        for name in self.members:
+            match = image_pattern.search(name)
+            if match:
+                self.images.setdefault((match["well"], int(match["site"]), int(match["channel"])), name)
+        self._fh = open(self.tar_file, "rb")
+        self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mm)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        self._view.release()
+        try:
+            self._mm.close()
+        except BufferError:
+            # Slices handed out by read() are still alive, the mapping is
+            # unmapped once they are garbage collected
+            pass
+        self._fh.close()
+
+    def __len__(self):
+        return len(self.members)
+
+    def names(self) -> list:
+        return list(self.members)
+
+    def read(self, name:str) -> memoryview:
+        """ Raw bytes of a member as a zero-copy slice of the archive
+        """
+        offset, size = self.members[name]
+        return self._view[offset:offset + size]
+
+    def find(self, well:str, site:int, channel:int) -> str:
+        """ Member name of the image for a given well, site and channel
+        """
+        name = self.images.get((well, int(site), int(channel)))
+        if name is None:
+            raise KeyError(f"No image for well {well} site {site} channel {channel} in '{self.tar_file}'")
+        return name
+
+    def read_image(self, name:str) -> np.ndarray:
+        """ Decode a member image straight from the mapped archive
+        """
+        data = self.read(name)
+        if name.endswith(".png"):
+            return imagecodecs.png_decode(data)
+        return imagecodecs.tiff_decode(data)
+
+
+@app.command()
+def main(
+    inp_dir: Path = typer.Option(
+        ...,
+        "--inpDir",
+        help="Directory containing plate tar files",
+        exists=True,
+        resolve_path=True,
+        readable=True,
+        file_okay=False,
+        dir_okay=True,
+    ),
+    force: bool = typer.Option(
+        False,
+        "--force",
+        help="Rebuild indexes even when they are up to date",
+    ),
+    ):
+
+    starttime = time.time()
+
+    tar_files = sorted(inp_dir.rglob("*.tar"))
+
+    with ThreadPoolExecutor(max_workers=num_workers) as exe:
+        threads = [exe.submit(build_index, tar_file, force) for tar_file in tar_files]
+
+        for f in tqdm(
+            as_completed(threads),
+            total=len(threads),
+            mininterval=1,
+            desc=f"Index plate",
+            initial=0,
+            unit_scale=True,
+            colour="cyan",
+        ):
+            try:
+                f.result()
+            except Exception as e:
+                logger.error(f"Indexing failed: {e}")
+
+    finishtime = (time.time() - starttime) / 60
+    logger.info(f'total time taken in minutes {finishtime}')
+
+
+if __name__ == '__main__':
+    app()
@@ -6,13 +6,22 @@ import typer
 import time
 import logging
 from multiprocessing import cpu_count
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from collections import defaultdict
 app = typer.Typer()
 import glob
 import os
+import sys
+import json
 import tarfile
 import subprocess
 from nyxus import Nyxus
+from tar_index import build_index, index_path
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+from common.ome_converter import convert_directory
+from common.scheduler import nyxus_threads
 
 
 
@@ -24,16 +33,19 @@ logger = logging.getLogger("Untar files")
 logger.setLevel(logging.INFO)
 num_workers = max([cpu_count() , 2])
 
+DONE_MARKER = ".untar_done"
+# Members of a tar are grouped into batches of about this many bytes
+BATCH_BYTES = 256 * 1024 * 1024
+CHUNK_SIZE = 8 * 1024 * 1024
+
 
 
 def omeconverter(inp_dir:Path, file_pattern:str, file_extension:str, out_dir:Path) -> None:  
     """ Ome Converter 
     """
-    command =  f"singularity run --bind /projects/PanMicroscopy:/projects/PanMicroscopy /home/abbasih2/plugins/ome-converter-tool_0_1_0_dev0.sif --inpDir={inp_dir} --filePattern={file_pattern} --fileExtension={file_extension} --outDir={out_dir}"
-    # command =  f"singularity run --bind /projects/PanMicroscopy:/projects/PanMicroscopy --fakeroot /home/abbasih2/plugins/ome-converter-plugin_0_3_2_dev1.sif --env USER=polusai --userns --uid 1001 --inpDir={inp_dir} --filePattern={file_pattern} --fileExtension={file_extension} --outDir={out_dir}"
-
-    _ = subprocess.run(command,shell=True,stdout=subprocess.PIPE)
-
+    result = convert_directory(inp_dir, file_pattern, file_extension, out_dir)
+    if result["failed"]:
+        logger.warning(f"{len(result['failed'])} images in {inp_dir} could not be converted")
 
     return 
 
@@ -45,7 +57,7 @@ def nyxfun(intensity_dir, file_pattern, out_dir, pixels_per_micron):
     nyx_params = {
         "neighbor_distance": 5,
         "pixels_per_micron": pixels_per_micron,
-        # "n_feature_calc_threads": 8,
+        "n_feature_calc_threads": nyxus_threads(),
     }
 
     nyx.set_params(**nyx_params)
@@ -58,24 +70,165 @@ def nyxfun(intensity_dir, file_pattern, out_dir, pixels_per_micron):
                             output_path = str(out_dir))
     
 
-def untar_file(tar_file):
+def untar_file(tar_file, remove_tar:bool=False):
+    """ Extract a single plate tar into a directory named after it
+    """
+    return extract_tars([tar_file], remove_tar=remove_tar)
+
+
+def is_extracted(tar_file) -> bool:
+    """ Check the done-marker written after a tar was extracted and verified
+    """
+    marker = Path(Path(tar_file).parent, Path(tar_file).stem, DONE_MARKER)
+    if not marker.exists():
+        return False
+    with open(marker, "r") as fh:
+        done = json.load(fh)
+    stat = Path(tar_file).stat()
+    return done["tar_size"] == stat.st_size and done["tar_mtime"] == stat.st_mtime_ns
+
+
+def plan_batches(tar_file, batch_bytes:int=BATCH_BYTES) -> list:
+    """ Split the regular-file members of a tar into batches of roughly batch_bytes
+    """
+    with np.load(build_index(tar_file)) as data:
+        members = list(zip(data["names"].tolist(), data["offsets"].tolist(), data["sizes"].tolist()))
+
+    batches, batch, nbytes = [], [], 0
+    for member in members:
+        batch.append(member)
+        nbytes += member[2]
+        if nbytes >= batch_bytes:
+            batches.append(batch)
+            batch, nbytes = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def extract_batch(tar_file, outpath, members):
+    """ Copy a batch of members out of a tar by offset, without re-parsing the archive
+
+    Returns the worker pid, the number of bytes written and the elapsed seconds.
+    """
+    starttime = time.time()
+    root = Path(outpath).resolve()
+    nbytes = 0
+    with open(tar_file, "rb") as src:
+        for name, offset, size in members:
+            dest = Path(root, name).resolve()
+            if root not in dest.parents:
+                raise IOError(f"Refusing to extract {name} outside {root}")
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            with open(dest, "wb") as dst:
+                remaining = size
+                while remaining:
+                    if hasattr(os, "copy_file_range"):
+                        n = os.copy_file_range(src.fileno(), dst.fileno(), min(CHUNK_SIZE, remaining), offset + size - remaining)
+                    else:
+                        src.seek(offset + size - remaining)
+                        n = dst.write(src.read(min(CHUNK_SIZE, remaining)))
+                    if n == 0:
+                        raise IOError(f"Unexpected end of '{tar_file}' while extracting {name}")
+                    remaining -= n
+            nbytes += size
+    return os.getpid(), nbytes, time.time() - starttime
+
+
+def verify_tar(tar_file, outpath) -> bool:
+    """ Compare extracted file sizes with the tar headers and write the done-marker
+    """
+    with np.load(build_index(tar_file)) as data:
+        names, sizes = data["names"].tolist(), data["sizes"].tolist()
+
+    bad = [name for name, size in zip(names, sizes)
+           if not Path(outpath, name).exists() or Path(outpath, name).stat().st_size != size]
+    if bad:
+        logger.error(f"{len(bad)} members of '{tar_file}' failed verification: {bad[:5]}")
+        return False
+
+    stat = Path(tar_file).stat()
+    with open(Path(outpath, DONE_MARKER), "w") as fh:
+        json.dump({"members": len(names), "bytes": int(sum(sizes)),
+                   "tar_size": stat.st_size, "tar_mtime": stat.st_mtime_ns}, fh)
+    return True
+
+
+def remove_source(tar_file) -> None:
+    os.remove(tar_file)
+    index_path(tar_file).unlink(missing_ok=True)
+    logger.info(f"Removed tar file '{tar_file}'")
+
+
+def finish_tar(tar_file, remove_tar:bool=False) -> None:
+    """ Verify a tar whose member batches have all been extracted, writing its done-marker
+    """
     outpath = f"{Path(tar_file).parent}/{Path(tar_file).stem}"
-    print(outpath)
-    # if not Path(outpath).exists():
-    #     Path(outpath).mkdir(parents=True, exist_ok=True)
-  
-    # with tarfile.open(tar_file, "r:*") as tar:
-    #     tar.extractall(path=outpath)
-    #     logger.info(f"Extracted '{tar_file}' to '{outpath}'")
+    if verify_tar(tar_file, outpath):
+        logger.info(f"Extracted '{tar_file}' to '{outpath}'")
+        if remove_tar:
+            remove_source(tar_file)
+
 
-    # # os.remove(tar_file)
-    # logger.info(f"Removed tar file '{tar_file}'")
+def extract_tars(tar_files:list, workers:int=num_workers, batch_bytes:int=BATCH_BYTES, remove_tar:bool=False) -> dict:
+    """ Extract many tars with member batches spread over a process pool
 
-    # omeoutdir = Path("/projects/PanMicroscopy/data/recursionpharma/omeconverted/rxrx3")
-    # if not Path(omeoutdir).exists():
-    #     Path(outpath).mkdir(parents=True, exist_ok=True)
+    Tars with a valid done-marker are skipped. Returns bytes and busy seconds
+    per worker pid.
+    """
+    todo = [t for t in tar_files if not is_extracted(t)]
+    logger.info(f"{len(tar_files) - len(todo)} of {len(tar_files)} tars already extracted")
+    if remove_tar:
+        for tar_file in set(tar_files) - set(todo):
+            remove_source(tar_file)
+
+    with ThreadPoolExecutor(max_workers=workers) as exe:
+        plans = dict(zip(todo, exe.map(lambda t: plan_batches(t, batch_bytes), todo)))
+
+    pending = {t: len(b) for t, b in plans.items()}
+    stats = defaultdict(lambda: [0, 0.0])
+
+    # Tars without regular-file members have no batch to wait for
+    for tar_file, batches in plans.items():
+        if not batches:
+            Path(Path(tar_file).parent, Path(tar_file).stem).mkdir(parents=True, exist_ok=True)
+            finish_tar(tar_file, remove_tar)
 
+    with ProcessPoolExecutor(max_workers=workers) as exe:
+        threads = {}
+        for tar_file, batches in plans.items():
+            outpath = f"{Path(tar_file).parent}/{Path(tar_file).stem}"
+            for batch in batches:
+                threads[exe.submit(extract_batch, tar_file, outpath, batch)] = tar_file
+
+        for f in tqdm(
+            as_completed(threads),
+            total=len(threads),
+            mininterval=1,
+            desc=f"Untar batches",
+            initial=0,
+            unit_scale=True,
+            colour="cyan",
+        ):
+            tar_file = threads[f]
+            try:
+                pid, nbytes, seconds = f.result()
+                stats[pid][0] += nbytes
+                stats[pid][1] += seconds
+            except Exception as e:
+                logger.error(f"Batch of '{tar_file}' failed: {e}")
+                pending[tar_file] = -1
+                continue
 
+            pending[tar_file] -= 1
+            if pending[tar_file] == 0:
+                finish_tar(tar_file, remove_tar)
+
+    for pid, (nbytes, seconds) in sorted(stats.items()):
+        rate = nbytes / (1024 * 1024) / seconds if seconds else 0.0
+        logger.info(f"worker {pid}: {nbytes / (1024 * 1024):.1f} MB in {seconds:.1f} s ({rate:.1f} MB/s)")
+
+    return dict(stats)
 
 
 @app.command()
@@ -89,7 +242,22 @@ def main(
         readable=True,
         file_okay=False,
         dir_okay=True,
-    )
+    ),
+    workers: int = typer.Option(
+        num_workers,
+        "--workers",
+        help="Number of extraction processes",
+    ),
+    batch_mb: int = typer.Option(
+        BATCH_BYTES // (1024 * 1024),
+        "--batchMB",
+        help="Approximate size of the member batches handed to each process",
+    ),
+    remove_tar: bool = typer.Option(
+        False,
+        "--removeTar",
+        help="Delete each tar once its extraction is verified",
+    ),
     ):
 
     starttime = time.time()
@@ -98,26 +266,7 @@ def main(
 
     tar_files = glob.glob(pattern, recursive=True)
 
-    with ThreadPoolExecutor(max_workers=num_workers) as exe:
-        threads = [exe.submit(untar_file, tar_file) for tar_file in tar_files]
-
-        for f in tqdm(
-            as_completed(threads),
-            total=len(threads),
-            mininterval=1,
-            desc=f"Untar plate",
-            initial=0,
-            unit_scale=True,
-            colour="cyan",
-        ):
-            try:
-            # Wait for the result of the future and print it
-                f.result()  # This will also raise exceptions if any
-                print(f"Thread {f} has completed successfully.")
-            except Exception as e:
-                # Print out an error message if an exception occurred
-                print(f"Thread {f} encountered an error: {e}")
-
+    extract_tars(tar_files, workers=workers, batch_bytes=batch_mb * 1024 * 1024, remove_tar=remove_tar)
 
    
     finishtime = (time.time() - starttime) / 60
@@ -0,0 +1 @@
+"""Helpers shared by the BBBC, RxRx and tissueNet pipelines."""
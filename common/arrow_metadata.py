@@ -0,0 +1,78 @@
+from pathlib import Path
+import os
+import json
+import logging
+from typing import Optional
+import numpy as np
+import pyarrow as pa
+
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Arrow metadata")
+logger.setLevel(logging.INFO)
+
+# Schema metadata key holding the attached values as JSON
+METADATA_KEY = b"panmicro.metadata"
+
+
+def constant_column(value:str, length:int, dictionary:bool=True) -> pa.Array:
+    """ A column repeating value, as one dictionary entry and int8 indices by default
+    """
+    if dictionary:
+        return pa.DictionaryArray.from_arrays(pa.array(np.zeros(length, np.int8)), pa.array([value], pa.string()))
+    return pa.array(np.full(length, value, dtype=object), pa.string())
+
+
+def read_metadata(arrowpath:Path) -> dict:
+    """ Values attached by attach_metadata, read from the schema alone
+    """
+    with pa.memory_map(str(arrowpath)) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+    return json.loads(metadata.get(METADATA_KEY, b"{}"))
+
+
+def attach_metadata(arrowpath:Path, values:dict, out_path:Optional[Path]=None, dictionary:bool=True) -> Path:
+    """ Add constant columns, e.g. dataset and plate, to a Nyxus arrow file
+
+    The record batches of the memory-mapped input are written out as they
+    are, with one constant column per value appended. The feature columns
+    are never materialised or converted. Constant columns are dictionary
+    encoded, one entry and an int8 index per row, unless dictionary is
+    False. The values are also kept in the schema metadata. Existing columns
+    of the same names are replaced.
+
+    The output, arrowpath itself by default, is written under a temporary
+    name and renamed into place, so readers never see a partial file and
+    an input that is memory-mapped elsewhere stays valid.
+    """
+    arrowpath = Path(arrowpath)
+    out_path = Path(out_path or arrowpath)
+    values = {name: str(value) for name, value in values.items()}
+    tmp = out_path.with_name(f".{out_path.name}.{os.getpid()}.tmp")
+
+    with pa.memory_map(str(arrowpath)) as source:
+        reader = pa.ipc.open_file(source)
+        keep = [i for i, name in enumerate(reader.schema.names) if name not in values]
+        fields = [reader.schema.field(i) for i in keep]
+        fields += [
+            pa.field(name, pa.dictionary(pa.int8(), pa.string()) if dictionary else pa.string())
+            for name in values
+        ]
+        metadata = dict(reader.schema.metadata or {})
+        metadata[METADATA_KEY] = json.dumps({**json.loads(metadata.get(METADATA_KEY, b"{}")), **values})
+        schema = pa.schema(fields, metadata=metadata)
+
+        with pa.OSFile(str(tmp), "wb") as sink:
+            with pa.ipc.new_file(sink, schema) as writer:
+                for i in range(reader.num_record_batches):
+                    batch = reader.get_batch(i)
+                    columns = [batch.column(j) for j in keep]
+                    columns += [constant_column(value, batch.num_rows, dictionary) for value in values.values()]
+                    writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+
+    os.replace(tmp, out_path)
+    logger.debug(f"Attached {', '.join(values)} to {out_path}")
+    return out_path
@@ -0,0 +1,214 @@
+from pathlib import Path
+import sys
+import os
+import time
+import logging
+import tempfile
+import threading
+from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+import psutil
+import typer
+import filepattern as fp
+from bfio import BioReader
+from nyxus import Nyxus
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from common.executor import tree_rss
+from common.scheduler import available_cpus, host_signature, save_profile, PROFILE_PATH
+
+
+app = typer.Typer()
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Autotune")
+logger.setLevel(logging.INFO)
+
+SAMPLE_SIZE = 16
+MEMORY_POLL = 0.1
+
+# One Nyxus instance per trial worker, created by _init_worker
+_nyx = None
+
+
+def _init_worker(features:list, threads:int) -> None:
+    global _nyx
+    _nyx = Nyxus(features)
+    _nyx.set_params(neighbor_distance=5, pixels_per_micron=1.0, n_feature_calc_threads=threads)
+
+
+def _featurize_directory(shard:str) -> None:
+    # The call the pipelines make on a folder: no labels, arrow output
+    out_dir = Path(f"{shard}_out")
+    out_dir.mkdir()
+    _nyx.featurize_directory(intensity_dir=shard, label_dir=None, file_pattern=".*",
+                             output_type="arrowipc", output_path=str(out_dir))
+
+
+def sample_pixels(files:list) -> int:
+    """ Pixels of the files, from their headers
+    """
+    pixels = 0
+    for f in files:
+        with BioReader(f) as br:
+            pixels += br.X * br.Y * br.Z
+    return pixels
+
+
+def sample_files(inp_dir:Path, file_pattern:str, sample:int) -> list:
+    """ Up to sample images spread evenly over a folder
+    """
+    files = sorted(str(f[1][0]) for f in fp.FilePattern(inp_dir, file_pattern)())
+    if len(files) <= sample:
+        return files
+    step = len(files) / sample
+    return [files[int(i * step)] for i in range(sample)]
+
+
+def grid(cpus:int, max_processes:Optional[int]=None) -> list:
+    """ (processes, threads) pairs using at most cpus CPUs
+
+    Counts are powers of two plus the full CPU count, so a 48 core node is
+    covered in a few dozen trials. Processes are capped at max_processes,
+    the sample size, since more would have no image to work on.
+    """
+    counts = sorted({2 ** i for i in range(cpus.bit_length()) if 2 ** i <= cpus} | {cpus})
+    max_processes = min(max_processes or cpus, cpus)
+    processes = sorted({p for p in counts if p <= max_processes} | {max_processes})
+    return [(p, t) for p in processes for t in counts if p * t <= cpus]
+
+
+def link_shards(files:list, root:Path, processes:int) -> list:
+    """ Split files over one folder of symlinks per process
+    """
+    shards = []
+    for i in range(processes):
+        shard = Path(root, f"shard_{i}")
+        shard.mkdir()
+        for f in files[i::processes]:
+            os.symlink(Path(f).resolve(), Path(shard, Path(f).name))
+        shards.append(str(shard))
+    return shards
+
+
+def run_trial(files:list, features:list, processes:int, threads:int, pixels:Optional[int]=None) -> dict:
+    """ Featurize files with one configuration, measuring throughput and peak memory
+
+    Each process runs featurize_directory on its share of the files, linked
+    into a folder of its own, which is what the featurization scripts time.
+    """
+    pixels = pixels if pixels is not None else sample_pixels(files)
+    parent = psutil.Process()
+    peak = 0
+    done = threading.Event()
+
+    def sample_memory():
+        nonlocal peak
+        while not done.is_set():
+            peak = max(peak, tree_rss(parent))
+            time.sleep(MEMORY_POLL)
+
+    monitor = threading.Thread(target=sample_memory, daemon=True)
+    monitor.start()
+    with tempfile.TemporaryDirectory(prefix=".autotune_") as scratch:
+        shards = link_shards(files, Path(scratch), processes)
+        starttime = time.time()
+        try:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(features, threads)) as executor:
+                list(executor.map(_featurize_directory, shards))
+        finally:
+            done.set()
+            monitor.join()
+        elapsed = time.time() - starttime
+
+    return {
+        "processes": processes,
+        "threads": threads,
+        "images_per_second": len(files) / elapsed,
+        "megapixels_per_second": pixels / 1e6 / elapsed,
+        "peak_rss_mb": peak / 1024 ** 2,
+    }
+
+
+def autotune(files:list, features:list, cpus:Optional[int]=None, max_memory_mb:Optional[float]=None) -> dict:
+    """ Run every configuration of the grid on files and return the profile of the fastest
+
+    Configurations above max_memory_mb are discarded. The profile also keeps
+    the best thread count for a single process, used by scripts that make a
+    single Nyxus call per folder. A warm-up trial, which pays for imports
+    and a cold page cache, runs first and is not counted.
+    """
+    cpus = cpus or available_cpus()
+    configs = grid(cpus, max_processes=len(files))
+    pixels = sample_pixels(files)
+    # The widest configuration reads every file once, quickly
+    run_trial(files, features, *configs[-1], pixels=pixels)
+
+    trials = []
+    for processes, threads in configs:
+        trial = run_trial(files, features, processes, threads, pixels=pixels)
+        logger.info(
+            f"{processes:3d} processes x {threads:3d} threads: {trial['images_per_second']:8.2f} images/s, "
+            f"peak RSS {trial['peak_rss_mb']:.0f} MB"
+        )
+        trials.append(trial)
+
+    fitting = [t for t in trials if max_memory_mb is None or t["peak_rss_mb"] <= max_memory_mb]
+    if not fitting:
+        raise RuntimeError(f"No configuration stays below {max_memory_mb} MB")
+    best = max(fitting, key=lambda t: t["images_per_second"])
+    single = max((t for t in fitting if t["processes"] == 1), key=lambda t: t["images_per_second"], default=best)
+
+    return {
+        **best,
+        "single_threads": single["threads"],
+        "sample": len(files),
+        "features": features,
+        "tuned": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "trials": trials,
+    }
+
+
+@app.command()
+def main(
+    inp_dir: Path = typer.Option(
+        ...,
+        "--inpDir",
+        help="Folder of images to sample, e.g. one plate",
+        exists=True,
+        resolve_path=True,
+        readable=True,
+        file_okay=False,
+        dir_okay=True,
+    ),
+    dataset: str = typer.Option(
+        ...,
+        "--dataset",
+        help="Dataset the profile is for, matched case-insensitively: the BBBC name (e.g. BBBC001), TissueNet, or for RxRx the folder two levels above the plate images (e.g. rxrx3)",
+    ),
+    file_pattern: str = typer.Option(".*.ome.tif", "--filePattern", help="Pattern of the images"),
+    sample: int = typer.Option(SAMPLE_SIZE, "--sample", help="Number of images featurized per trial"),
+    features: str = typer.Option("*ALL*", "--features", help="Comma separated Nyxus features"),
+    max_memory_mb: float = typer.Option(None, "--maxMemoryMB", help="Discard configurations using more memory"),
+    ):
+    """ Sweep process and thread counts on a sample and store the fastest profile
+    """
+    files = sample_files(inp_dir, file_pattern, sample)
+    if not files:
+        raise typer.BadParameter(f"No images matching {file_pattern} in {inp_dir}")
+
+    logger.info(f"Tuning {dataset} on {host_signature()} with {len(files)} images")
+    profile = autotune(files, features.split(","), max_memory_mb=max_memory_mb)
+    save_profile(dataset, profile)
+    logger.info(
+        f"Best: {profile['processes']} processes x {profile['threads']} threads, "
+        f"{profile['images_per_second']:.2f} images/s, saved to {PROFILE_PATH}"
+    )
+
+
+if __name__ == '__main__':
+    app()
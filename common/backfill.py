@@ -0,0 +1,188 @@
+from pathlib import Path
+import os
+import hashlib
+import logging
+import tempfile
+from typing import Optional
+from functools import lru_cache
+import numpy as np
+import pyarrow as pa
+from nyxus import Nyxus
+
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Feature backfill")
+logger.setLevel(logging.INFO)
+
+# Columns identifying a row, not features
+ID_COLUMNS = ["intensity_image", "mask_image", "ROI_label", "t_index"]
+# Rows of a backfill are matched to the existing rows on these
+KEY_COLUMNS = ["intensity_image", "ROI_label"]
+MAX_TAG_LENGTH = 64
+
+
+@lru_cache(maxsize=None)
+def feature_columns(feature:str) -> tuple:
+    """ Output columns of a Nyxus feature or feature group, e.g. GABOR -> GABOR_0 ...
+
+    Found by featurizing a small random image with the feature alone.
+    """
+    image = np.random.default_rng(0).integers(1, 1000, (32, 32)).astype(np.uint16)
+    mask = np.ones(image.shape, dtype=np.uint32)
+    df = Nyxus([feature]).featurize(image, mask, intensity_names=["probe"], label_names=["probe"])
+    return tuple(c for c in df.columns if c not in ID_COLUMNS)
+
+
+def sidecars(arrowpath:Path) -> list:
+    """ Backfilled column files of a feature file, NyxusFeatures.<features>.arrow
+    """
+    arrowpath = Path(arrowpath)
+    return sorted(arrowpath.parent.glob(f"{arrowpath.stem}.*{arrowpath.suffix}"))
+
+
+def _read(path:Path) -> pa.Table:
+    with pa.memory_map(str(path)) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def read_features(arrowpath:Path) -> pa.Table:
+    """ A feature file with the columns of its sidecars joined on intensity_image and ROI_label
+
+    Sidecars missing rows of the feature file, left from before it was
+    rewritten, are skipped with a warning rather than attached to the wrong
+    rows.
+    """
+    table = _read(arrowpath)
+    keys = _row_keys(table)
+    for sidecar in sidecars(arrowpath):
+        extra = _read(sidecar)
+        rows = {key: i for i, key in enumerate(_row_keys(extra))}
+        if any(key not in rows for key in keys):
+            logger.warning(f"Skipping {sidecar}: its rows do not match {arrowpath}, backfill again")
+            continue
+        extra = extra.take(pa.array([rows[key] for key in keys], pa.int64()))
+        for name in extra.column_names:
+            if name not in KEY_COLUMNS and name not in table.column_names:
+                table = table.append_column(name, extra[name])
+    return table
+
+
+def remove_sidecars(arrowpath:Path) -> None:
+    """ Delete the sidecars of a feature file about to be rewritten
+    """
+    for sidecar in sidecars(arrowpath):
+        sidecar.unlink()
+        logger.info(f"Removed {sidecar}, its rows are being featurized again")
+
+
+def missing_features(arrowpath:Path, features:list) -> list:
+    """ Features of the list whose columns are not all in the file or its sidecars
+    """
+    columns = set(read_features(arrowpath).column_names)
+    return [f for f in features if not set(feature_columns(f)) <= columns]
+
+
+def _row_keys(table:pa.Table) -> list:
+    # Nyxus writes bare file names to arrow files but full paths to pandas
+    return list(zip(
+        (Path(name).name for name in table["intensity_image"].to_pylist()),
+        table["ROI_label"].to_pylist(),
+    ))
+
+
+def _write(table:pa.Table, path:Path) -> None:
+    tmp = Path(f"{path}.tmp")
+    with pa.OSFile(str(tmp), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp, path)
+
+
+def _featurize(features:list, nyx_params:dict, intensity_dir:Path, file_pattern:str) -> pa.Table:
+    nyx = Nyxus(features)
+    nyx.set_params(**nyx_params)
+    df = nyx.featurize_directory(intensity_dir=str(intensity_dir), label_dir=None, file_pattern=file_pattern)
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def backfill(
+    intensity_dir:Path,
+    file_pattern:str,
+    arrowpath:Path,
+    features:list,
+    nyx_params:dict,
+    merge:bool=False,
+    groups:Optional[dict]=None,
+) -> list:
+    """ Compute the requested features missing from an existing feature file
+
+    Only the missing features are computed, and the rows are matched to the
+    existing ones on intensity_image and ROI_label. Arrow files cannot grow
+    columns in place, so by default the new columns go to a sidecar file next
+    to the original, which is left untouched; read_features joins them. With
+    merge the feature file is rewritten once with all columns, sidecars
+    included, and replaced atomically.
+
+    groups, pixels_per_micron mapped to image paths as resolution_groups
+    gives them, featurizes each resolution with its own value, from a
+    folder of links to its images.
+
+    Returns the features that were computed.
+    """
+    arrowpath = Path(arrowpath)
+    missing = missing_features(arrowpath, features)
+    if not missing:
+        logger.info(f"{arrowpath} already has all {len(features)} features")
+        if merge and sidecars(arrowpath):
+            _merge(arrowpath)
+        return []
+
+    logger.info(f"Backfilling {len(missing)} features into {arrowpath}: {', '.join(missing)}")
+    if not groups or len(groups) == 1:
+        params = {**nyx_params, "pixels_per_micron": next(iter(groups))} if groups else nyx_params
+        new = _featurize(missing, params, intensity_dir, file_pattern)
+    else:
+        tables = []
+        with tempfile.TemporaryDirectory(dir=arrowpath.parent, prefix=".backfill_") as scratch:
+            for i, (value, paths) in enumerate(sorted(groups.items())):
+                link_dir = Path(scratch, f"resolution_{i}")
+                link_dir.mkdir()
+                for path in paths:
+                    os.symlink(Path(path).resolve(), Path(link_dir, Path(path).name))
+                tables.append(_featurize(missing, {**nyx_params, "pixels_per_micron": value}, link_dir, file_pattern))
+        new = pa.concat_tables(tables, promote_options="default")
+
+    existing = _read(arrowpath).select(KEY_COLUMNS)
+    rows = {key: i for i, key in enumerate(_row_keys(new))}
+    unmatched = [key for key in _row_keys(existing) if key not in rows]
+    if unmatched:
+        raise ValueError(f"{len(unmatched)} rows of {arrowpath} have no match in {intensity_dir}, e.g. {unmatched[0]}")
+    new = new.take(pa.array([rows[key] for key in _row_keys(existing)], pa.int64()))
+
+    present = set(read_features(arrowpath).column_names)
+    columns = [c for c in new.column_names if c not in ID_COLUMNS and c not in present]
+    sidecar = existing.select(KEY_COLUMNS)
+    for name in columns:
+        sidecar = sidecar.append_column(name, new[name])
+
+    tag = "+".join(missing)
+    if len(tag) > MAX_TAG_LENGTH:
+        tag = hashlib.blake2b(tag.encode(), digest_size=6).hexdigest()
+    _write(sidecar, arrowpath.with_name(f"{arrowpath.stem}.{tag}{arrowpath.suffix}"))
+
+    if merge:
+        _merge(arrowpath)
+    return missing
+
+
+def _merge(arrowpath:Path) -> None:
+    """ Rewrite a feature file with the columns of its sidecars and remove them
+    """
+    merged = sidecars(arrowpath)
+    _write(read_features(arrowpath), arrowpath)
+    for sidecar in merged:
+        sidecar.unlink()
+    logger.info(f"Merged {len(merged)} sidecars into {arrowpath}")
@@ -0,0 +1,66 @@
+from pathlib import Path
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+import typer
+from bfio import BioWriter
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from common.ome_converter import convert_directory, container_convert, NUM_WORKERS
+
+
+app = typer.Typer()
+
+
+def make_synthetic_folder(out_dir:Path, num_images:int, size:int) -> Path:
+    """ Write num_images random uint16 OME tiffs of size x size pixels
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(0)
+    for i in range(num_images):
+        image = rng.integers(0, 4096, (size, size), dtype=np.uint16)
+        with BioWriter(Path(out_dir, f"r{i:03d}_c0.ome.tif")) as bw:
+            bw.X = image.shape[1]
+            bw.Y = image.shape[0]
+            bw.dtype = image.dtype
+            bw[:] = image
+    return out_dir
+
+
+@app.command()
+def main(
+    num_images: int = typer.Option(64, "--numImages", help="Number of synthetic images"),
+    size: int = typer.Option(2048, "--size", help="Width and height of each image"),
+    num_workers: int = typer.Option(NUM_WORKERS, "--numWorkers", help="Conversion processes"),
+    container: bool = typer.Option(False, "--container", help="Also time the singularity converter"),
+    ):
+    """ Time in-process conversion against the container path on a synthetic folder
+    """
+    root = Path(tempfile.mkdtemp(prefix="bench_ome_"))
+    try:
+        inp_dir = make_synthetic_folder(Path(root, "inp"), num_images, size)
+        megapixels = num_images * size * size / 1e6
+
+        starttime = time.time()
+        convert_directory(inp_dir, ".*.ome.tif", ".ome.tif", Path(root, "native"), num_workers=num_workers)
+        native = time.time() - starttime
+        print(f"native    {native:8.2f} s  {megapixels / native:8.1f} MP/s  ({num_workers} workers)")
+
+        starttime = time.time()
+        convert_directory(inp_dir, ".*.ome.tif", ".ome.tif", Path(root, "native"), num_workers=num_workers)
+        print(f"rerun     {time.time() - starttime:8.2f} s  (all outputs up to date)")
+
+        if container:
+            starttime = time.time()
+            result = container_convert(inp_dir, ".*.ome.tif", ".ome.tif", Path(root, "container"))
+            elapsed = time.time() - starttime
+            print(f"container {elapsed:8.2f} s  {megapixels / elapsed:8.1f} MP/s  (exit code {result.returncode}, peak RSS {result.peak_rss_mb:.0f} MB)")
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    app()
@@ -0,0 +1,197 @@
+from pathlib import Path
+import os
+import time
+import signal
+import logging
+import threading
+import subprocess
+from typing import Optional
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import psutil
+
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Job executor")
+logger.setLevel(logging.INFO)
+
+# Point this at a stand-in script to run the pipelines without singularity
+SINGULARITY = os.environ.get("SINGULARITY", "singularity")
+BIND = "/projects/PanMicroscopy:/projects/PanMicroscopy"
+POLL_INTERVAL = 0.5
+
+
+@dataclass
+class Job:
+    """ An external command to supervise
+
+    Args:
+        name: Job name, used for the log file and in messages
+        command: Command and arguments, run without a shell
+        log_path: File receiving the job's stdout and stderr
+        timeout: Wall-clock limit per attempt in seconds, None for no limit
+        max_memory_mb: Resident memory limit of the job's process tree, None for no limit
+        retries: Number of attempts for transient failures
+        backoff: Seconds to wait before the first retry, doubled on each retry
+        cancel: Event killing the job when set, e.g. once its work unit is lost
+    """
+    name: str
+    command: list
+    log_path: Path
+    timeout: Optional[float] = None
+    max_memory_mb: Optional[float] = None
+    retries: int = 1
+    backoff: float = 30.0
+    cancel: Optional[threading.Event] = None
+
+
+@dataclass
+class JobResult:
+    name: str
+    returncode: Optional[int]
+    duration: float
+    peak_rss_mb: float
+    attempts: int
+    timed_out: bool = False
+    memory_exceeded: bool = False
+    cancelled: bool = False
+    start_failed: bool = False
+    log_path: Optional[Path] = None
+    history: list = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+
+def container_command(image:str, args:list, bind:str=BIND) -> list:
+    """ Command list running a singularity image with the project directory bound
+    """
+    return [SINGULARITY, "run", "--bind", bind, str(image), *args]
+
+
+def tree_rss(proc:psutil.Process) -> int:
+    """ Resident memory of a process and all of its children in bytes
+    """
+    rss = 0
+    try:
+        procs = [proc] + proc.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return rss
+    for p in procs:
+        try:
+            rss += p.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss
+
+
+def kill_group(popen:subprocess.Popen) -> None:
+    try:
+        os.killpg(popen.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run_once(job:Job, attempt:int) -> JobResult:
+    """ Run a job a single time, enforcing its time and memory limits
+    """
+    log_path = Path(job.log_path)
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    starttime = time.time()
+    peak = 0
+    timed_out = memory_exceeded = cancelled = False
+
+    with open(log_path, "a") as log:
+        log.write(f"# attempt {attempt}: {' '.join(map(str, job.command))}\n")
+        log.flush()
+        # New session so the whole container process tree can be killed together
+        try:
+            popen = subprocess.Popen(job.command, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        except OSError as e:
+            # Missing or non-executable container binary: a failed job, not a crash of run_jobs
+            log.write(f"# could not start: {e}\n")
+            logger.error(f"{job.name} could not be started: {e}")
+            return JobResult(
+                name=job.name,
+                returncode=None,
+                duration=time.time() - starttime,
+                peak_rss_mb=0.0,
+                attempts=attempt,
+                start_failed=True,
+                log_path=log_path,
+            )
+        proc = psutil.Process(popen.pid)
+
+        interval = 0.05
+        while popen.poll() is None:
+            peak = max(peak, tree_rss(proc))
+            if job.max_memory_mb is not None and peak > job.max_memory_mb * 1024 ** 2:
+                memory_exceeded = True
+                kill_group(popen)
+            elif job.timeout is not None and time.time() - starttime > job.timeout:
+                timed_out = True
+                kill_group(popen)
+            elif job.cancel is not None and job.cancel.is_set():
+                cancelled = True
+                kill_group(popen)
+            # Poll quickly at first so short jobs still get an RSS sample
+            time.sleep(interval)
+            interval = min(interval * 2, POLL_INTERVAL)
+
+    return JobResult(
+        name=job.name,
+        returncode=popen.returncode,
+        duration=time.time() - starttime,
+        peak_rss_mb=peak / 1024 ** 2,
+        attempts=attempt,
+        timed_out=timed_out,
+        memory_exceeded=memory_exceeded,
+        cancelled=cancelled,
+        log_path=log_path,
+    )
+
+
+def run_job(job:Job) -> JobResult:
+    """ Run a job, retrying failures with exponential backoff
+
+    A job killed for exceeding its memory limit is not retried since it would
+    fail the same way again, nor is a job that could not be started or was
+    cancelled.
+    """
+    history = []
+    for attempt in range(1, job.retries + 1):
+        result = run_once(job, attempt)
+        history.append((result.returncode, round(result.duration, 2)))
+        if result.ok or result.memory_exceeded or result.cancelled or result.start_failed:
+            break
+        logger.warning(
+            f"{job.name} failed (attempt {attempt}/{job.retries}, exit code {result.returncode}"
+            f"{', timed out' if result.timed_out else ''}), see {result.log_path}"
+        )
+        if attempt < job.retries:
+            time.sleep(job.backoff * 2 ** (attempt - 1))
+
+    result.history = history
+    if result.memory_exceeded:
+        logger.error(f"{job.name} killed at {result.peak_rss_mb:.0f} MB, limit {job.max_memory_mb} MB")
+    return result
+
+
+def run_jobs(jobs:list, slots:int=1) -> list:
+    """ Run jobs with at most slots of them at the same time, results in job order
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=slots) as executor:
+        threads = {executor.submit(run_job, job): i for i, job in enumerate(jobs)}
+        for f in as_completed(threads):
+            result = f.result()
+            results[threads[f]] = result
+            logger.info(
+                f"{result.name}: exit code {result.returncode} in {result.duration:.1f} s, "
+                f"peak RSS {result.peak_rss_mb:.0f} MB, {result.attempts} attempt(s)"
+            )
+    return [results[i] for i in range(len(jobs))]
@@ -0,0 +1,305 @@
+from pathlib import Path
+import os
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import logging
+import tempfile
+from typing import Optional
+from collections import defaultdict
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import filepattern as fp
+import nyxus
+from bfio import BioReader
+
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Feature cache")
+logger.setLevel(logging.INFO)
+
+# Directory of the cache, caching is off when unset
+CACHE_ENV = "PANMICRO_FEATURE_CACHE"
+CACHE_SIZE_ENV = "PANMICRO_FEATURE_CACHE_GB"
+CACHE_SIZE_GB = 50
+# Nyxus parameters that do not change the feature values
+IGNORED_PARAMS = {"n_feature_calc_threads"}
+# sqlite limits the number of variables of a query
+QUERY_CHUNK = 500
+# Images read into memory at once by featurize_files_cached
+READ_CHUNK = 64
+# Hex digits of an image key
+KEY_LENGTH = 32
+# Bumped when the stored rows change, so older segments are not served
+ROW_FORMAT = 2
+
+
+class FeatureCache:
+    """ Nyxus feature rows keyed by pixel content, feature list and parameters
+
+    Rows are kept in arrow segment files, one per put, with the
+    intensity_image column holding the image key. A sqlite index maps keys
+    to segments and tracks when each segment was last used; once the cache
+    grows beyond max_bytes the least recently used segments are deleted.
+    The processes of a node can share the index; sqlite relies on file
+    locks that are unreliable on NFS, so nodes should not share a cache
+    directory there.
+
+    The mode separates rows computed by different Nyxus entry points, as
+    featurize_directory without labels and featurize with a whole-image mask
+    give different values for some features.
+    """
+
+    def __init__(self, root, features:list, params:dict, max_bytes:int, mode:str="memory"):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        params = {k: v for k, v in params.items() if k not in IGNORED_PARAMS}
+        config = json.dumps(
+            {"features": sorted(features), "params": params, "mode": mode, "nyxus": nyxus.__version__, "rows": ROW_FORMAT}, sort_keys=True
+        )
+        self.config = hashlib.blake2b(config.encode(), digest_size=16).hexdigest()
+        self.segment_dir = Path(self.root, self.config)
+        self.segment_dir.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+        self.db = sqlite3.connect(Path(self.root, "index.sqlite"), timeout=300)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS entries (config TEXT, key TEXT, segment TEXT, PRIMARY KEY (config, key))"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS segments (segment TEXT PRIMARY KEY, config TEXT, bytes INTEGER, last_used REAL)"
+            )
+
+    @staticmethod
+    def image_key(image:np.ndarray) -> str:
+        """ Content hash of the pixels, their dtype and shape
+        """
+        h = hashlib.blake2b(digest_size=KEY_LENGTH // 2)
+        h.update(f"{image.dtype.str}{image.shape}".encode())
+        h.update(np.ascontiguousarray(image).data)
+        return h.hexdigest()
+
+    def _segment_path(self, segment:str) -> Path:
+        return Path(self.segment_dir, f"{segment}.arrow")
+
+    def get(self, keys:list) -> Optional[pa.Table]:
+        """ Cached rows of keys, None when none of them is cached
+        """
+        keys = list(set(keys))
+        by_segment = defaultdict(list)
+        for i in range(0, len(keys), QUERY_CHUNK):
+            chunk = keys[i:i + QUERY_CHUNK]
+            rows = self.db.execute(
+                f"SELECT key, segment FROM entries WHERE config = ? AND key IN ({','.join('?' * len(chunk))})",
+                [self.config, *chunk],
+            )
+            for key, segment in rows:
+                by_segment[segment].append(key)
+
+        tables = []
+        for segment, segment_keys in by_segment.items():
+            try:
+                with pa.memory_map(str(self._segment_path(segment))) as source:
+                    table = pa.ipc.open_file(source).read_all()
+            except FileNotFoundError:
+                # Evicted by another process since the query
+                continue
+            tables.append(table.filter(pc.is_in(table["intensity_image"], pa.array(segment_keys))))
+
+        if by_segment:
+            with self.db:
+                self.db.executemany(
+                    "UPDATE segments SET last_used = ? WHERE segment = ?",
+                    [(time.time(), segment) for segment in by_segment],
+                )
+        if not tables:
+            return None
+        return pa.concat_tables(tables, promote_options="default")
+
+    def put(self, table:pa.Table) -> None:
+        """ Store rows whose intensity_image column holds the image key
+        """
+        if table.num_rows == 0:
+            return
+        segment = uuid.uuid4().hex
+        path = self._segment_path(segment)
+        tmp = path.with_suffix(".tmp")
+        with pa.OSFile(str(tmp), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, path)
+
+        keys = set(table["intensity_image"].to_pylist())
+        with self.db:
+            self.db.execute(
+                "INSERT INTO segments VALUES (?, ?, ?, ?)", (segment, self.config, path.stat().st_size, time.time())
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", [(self.config, key, segment) for key in keys]
+            )
+        self.evict()
+
+    def evict(self) -> None:
+        """ Delete least recently used segments until the cache fits in max_bytes
+        """
+        with self.db:
+            (total,) = self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM segments").fetchone()
+            if total <= self.max_bytes:
+                return
+            for segment, config, size in self.db.execute(
+                "SELECT segment, config, bytes FROM segments ORDER BY last_used"
+            ).fetchall():
+                if total <= self.max_bytes:
+                    break
+                self.db.execute("DELETE FROM entries WHERE segment = ?", (segment,))
+                self.db.execute("DELETE FROM segments WHERE segment = ?", (segment,))
+                Path(self.root, config, f"{segment}.arrow").unlink(missing_ok=True)
+                total -= size
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def open_cache(features:list, params:dict, mode:str="memory") -> Optional[FeatureCache]:
+    """ Cache configured by PANMICRO_FEATURE_CACHE, None when caching is off
+
+    mode is "memory" for featurize_cached and "directory" for
+    featurize_files_cached.
+    """
+    root = os.environ.get(CACHE_ENV)
+    if not root:
+        return None
+    max_bytes = int(float(os.environ.get(CACHE_SIZE_ENV, CACHE_SIZE_GB)) * 1024 ** 3)
+    return FeatureCache(root, features, params, max_bytes, mode)
+
+
+def report(stats:dict, desc:str="") -> None:
+    total = stats["hits"] + stats["misses"]
+    if total:
+        logger.info(f"{desc} feature cache: {stats['hits']} hits, {stats['misses']} misses ({100 * stats['hits'] / total:.1f}% hit rate)")
+
+
+def serve(cache:Optional[FeatureCache], keys:list, names:list, compute, columns:tuple) -> pa.Table:
+    """ Rows for keys in order, from the cache or from compute(missing keys)
+
+    compute returns rows whose intensity_image holds the key; in the result
+    the given columns hold the name of the image instead.
+    """
+    cached = cache.get(keys) if cache is not None else None
+    cached_keys = set(cached["intensity_image"].to_pylist()) if cached is not None else set()
+    missing = list(dict.fromkeys(key for key in keys if key not in cached_keys))
+
+    tables = [cached] if cached is not None else []
+    if missing:
+        table = compute(missing)
+        if cache is not None:
+            cache.put(table)
+        tables.append(table)
+
+    if cache is not None:
+        hits = sum(key in cached_keys for key in keys)
+        cache.hits += hits
+        cache.misses += len(keys) - hits
+
+    table = pa.concat_tables(tables, promote_options="default")
+    rows = defaultdict(list)
+    for i, key in enumerate(table["intensity_image"].to_pylist()):
+        rows[key].append(i)
+    indices, out_names = [], []
+    for key, name in zip(keys, names):
+        indices.extend(rows[key])
+        out_names.extend([name] * len(rows[key]))
+
+    table = table.take(pa.array(indices, pa.int64()))
+    for column in columns:
+        table = table.set_column(table.schema.get_field_index(column), column, pa.array(out_names, pa.string()))
+    return table
+
+
+def featurize_cached(nyx, images:list, names:list, cache:Optional[FeatureCache]=None) -> pa.Table:
+    """ Featurize in-memory images as whole-image ROIs, serving cached rows where possible
+
+    Images of equal shape and dtype are stacked into a single Nyxus call.
+    The intensity_image and mask_image columns of the result hold names.
+    """
+    keys = [FeatureCache.image_key(image) for image in images]
+    by_key = dict(zip(keys, images))
+
+    def compute(missing):
+        groups = defaultdict(list)
+        for key in missing:
+            groups[(by_key[key].shape, by_key[key].dtype.str)].append(key)
+        tables = []
+        for group in groups.values():
+            stack = np.stack([by_key[key] for key in group])
+            masks = np.ones(stack.shape, dtype=np.uint32)
+            # Keys as names so that the new rows can be stored and matched back
+            df = nyx.featurize(stack, masks, intensity_names=group, label_names=group)
+            tables.append(pa.Table.from_pandas(df, preserve_index=False))
+        return pa.concat_tables(tables, promote_options="default")
+
+    return serve(cache, keys, names, compute, ("intensity_image", "mask_image"))
+
+
+def featurize_files_cached(nyx, intensity_dir, file_pattern:str, out_path:Path, cache:FeatureCache) -> None:
+    """ Cached counterpart of featurize_directory without labels
+
+    Images are hashed READ_CHUNK at a time. The ones not in the cache are
+    linked into a scratch folder under their key and featurized there with
+    featurize_directory, writing arrow output as the uncached run does, so
+    the rows have its values and column types. Writes the same single arrow
+    file, with the rows in file name order, and an empty one with the same
+    columns when no image matches.
+    """
+    files = sorted(str(f[1][0]) for f in fp.FilePattern(intensity_dir, file_pattern)())
+    out_path = Path(out_path)
+    tmp = out_path.with_suffix(".arrow.tmp")
+
+    writer = None
+    for start in range(0, len(files), READ_CHUNK):
+        chunk = files[start:start + READ_CHUNK]
+        keys = []
+        for f in chunk:
+            with BioReader(f) as br:
+                keys.append(FeatureCache.image_key(br[:].squeeze()))
+        by_key = dict(zip(keys, chunk))
+
+        def compute(missing):
+            with tempfile.TemporaryDirectory(dir=out_path.parent, prefix=".featurize_") as scratch:
+                for key in missing:
+                    os.symlink(by_key[key], Path(scratch, key + "".join(Path(by_key[key]).suffixes)))
+                nyx.featurize_directory(intensity_dir=scratch, label_dir=None, file_pattern=".*",
+                                        output_type="arrowipc", output_path=scratch)
+                with pa.memory_map(str(Path(scratch, "NyxusFeatures.arrow"))) as source:
+                    table = pa.ipc.open_file(source).read_all()
+            # intensity_image holds the name of the link, named after the key
+            keys_column = pa.array([Path(name).name[:KEY_LENGTH] for name in table["intensity_image"].to_pylist()], pa.string())
+            return table.set_column(table.schema.get_field_index("intensity_image"), "intensity_image", keys_column)
+
+        table = serve(cache, keys, [Path(f).name for f in chunk], compute, ("intensity_image",))
+        if writer is None:
+            schema = table.schema
+            writer = pa.ipc.new_file(str(tmp), schema)
+        writer.write_table(table.cast(schema))
+
+    if writer is not None:
+        writer.close()
+        os.replace(tmp, out_path)
+    else:
+        # No image matched: the empty table the uncached run writes, with its columns
+        with tempfile.TemporaryDirectory(dir=out_path.parent, prefix=".featurize_") as scratch:
+            nyx.featurize_directory(intensity_dir=scratch, label_dir=None, file_pattern=".*",
+                                    output_type="arrowipc", output_path=scratch)
+            os.replace(Path(scratch, "NyxusFeatures.arrow"), out_path)
+    report(cache.stats(), str(intensity_dir))
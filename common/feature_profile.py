@@ -0,0 +1,211 @@
+from pathlib import Path
+import sys
+import json
+import time
+import logging
+from itertools import combinations
+import numpy as np
+import typer
+from bfio import BioReader
+from nyxus import Nyxus
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from common.autotune import sample_files
+from common.backfill import ID_COLUMNS
+
+
+app = typer.Typer()
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Feature profile")
+logger.setLevel(logging.INFO)
+
+_ORDERS = [f"{i}{j}" for i in range(4) for j in range(4)]
+_NORM_CENTRAL = ["02", "03", "11", "12", "20", "21", "30"]
+
+# Feature families as lists of Nyxus features or groups
+FAMILIES = {
+    "intensity": ["*ALL_INTENSITY*"],
+    "morphology": ["*ALL_MORPHOLOGY*"],
+    "neighbors": ["*ALL_NEIGHBOR*"],
+    "glcm": ["*ALL_GLCM*"],
+    "glrlm": ["*ALL_GLRLM*"],
+    "gldzm": ["*ALL_GLDZM*"],
+    "glszm": ["*ALL_GLSZM*"],
+    "gldm": ["*ALL_GLDM*"],
+    "ngldm": ["*ALL_NGLDM*"],
+    "ngtdm": ["*ALL_NGTDM*"],
+    "gabor": ["GABOR"],
+    "zernike": ["ZERNIKE2D"],
+    "radial": ["FRAC_AT_D", "MEAN_FRAC", "RADIAL_CV"],
+    "moments": (
+        [f"SPAT_MOMENT_{o}" for o in _ORDERS[:13]]
+        + [f"CENTRAL_MOMENT_{o}" for o in _ORDERS]
+        + [f"NORM_SPAT_MOMENT_{o}" for o in _ORDERS]
+        + [f"NORM_CENTRAL_MOMENT_{o}" for o in _NORM_CENTRAL]
+        + [f"HU_M{i}" for i in range(1, 8)]
+        + [f"WEIGHTED_SPAT_MOMENT_{o}" for o in ["00", "01", "02", "03", "10", "11", "12", "20", "21", "30"]]
+        + [f"WEIGHTED_CENTRAL_MOMENT_{o}" for o in _NORM_CENTRAL]
+        + [f"WEIGHTED_HU_M{i}" for i in range(1, 8)]
+    ),
+}
+# Cheapest possible run, its time is the per-image overhead of any feature set
+BASELINE = ["MEAN"]
+REPEATS = 3
+
+
+def _time_features(images:list, features:list) -> tuple:
+    """ Best of REPEATS single-threaded runs over images in seconds, and the feature table
+    """
+    nyx = Nyxus(features)
+    nyx.set_params(neighbor_distance=5, pixels_per_micron=1.0, n_feature_calc_threads=1)
+    best = float("inf")
+    for _ in range(REPEATS):
+        tables = []
+        starttime = time.perf_counter()
+        for i, image in enumerate(images):
+            mask = np.ones(image.shape, dtype=np.uint32)
+            tables.append(nyx.featurize(image, mask, intensity_names=[str(i)], label_names=[str(i)]))
+        best = min(best, time.perf_counter() - starttime)
+    return best, tables
+
+
+def informative_columns(tables:list) -> int:
+    """ Columns that are finite and vary across the sample images
+    """
+    count = 0
+    for column in tables[0].columns:
+        if column in ID_COLUMNS:
+            continue
+        values = np.array([t[column].iloc[0] for t in tables], dtype=float)
+        if np.isfinite(values).all() and np.ptp(values) > 0:
+            count += 1
+    return count
+
+
+def profile_families(files:list, families:dict=FAMILIES) -> dict:
+    """ Cost and yield of each family featurized in isolation on files
+
+    Costs are in ms per image and per megapixel above the baseline run,
+    which is reported separately as the overhead every feature set pays.
+    """
+    images = []
+    for f in files:
+        with BioReader(f) as br:
+            images.append(br[:].squeeze())
+    megapixels = sum(image.size for image in images) / 1e6
+
+    baseline, _ = _time_features(images, BASELINE)
+    result = {
+        "sample": len(images),
+        "megapixels_per_image": megapixels / len(images),
+        "baseline_ms_per_image": 1000 * baseline / len(images),
+        "families": {},
+    }
+    for name, features in families.items():
+        seconds, tables = _time_features(images, features)
+        cost = max(seconds - baseline, 0.0)
+        family = {
+            "features": features,
+            "ms_per_image": 1000 * cost / len(images),
+            "ms_per_megapixel": 1000 * cost / megapixels,
+            "columns": len([c for c in tables[0].columns if c not in ID_COLUMNS]),
+            "informative_columns": informative_columns(tables) if len(images) > 1 else None,
+        }
+        result["families"][name] = family
+        logger.info(
+            f"{name:10s} {family['ms_per_image']:10.2f} ms/image {family['ms_per_megapixel']:10.2f} ms/MP "
+            f"{family['columns']:4d} columns"
+        )
+    return result
+
+
+def plan_features(profile:dict, budget_ms:float, required:tuple=()) -> list:
+    """ Families with the most informative columns within a per-image time budget
+
+    The budget covers the baseline overhead and the families' costs. There
+    are few families, so every subset is checked.
+    """
+    families = profile["families"]
+    budget = budget_ms - profile["baseline_ms_per_image"]
+    required_cost = sum(families[name]["ms_per_image"] for name in required)
+    if required_cost > budget:
+        raise ValueError(f"Required families need {required_cost + profile['baseline_ms_per_image']:.1f} ms per image")
+
+    def value(name):
+        family = families[name]
+        informative = family["informative_columns"]
+        return family["columns"] if informative is None else informative
+
+    optional = [name for name in families if name not in required]
+    best, best_value, best_cost = list(required), sum(value(n) for n in required), required_cost
+    for k in range(1, len(optional) + 1):
+        for subset in combinations(optional, k):
+            cost = required_cost + sum(families[name]["ms_per_image"] for name in subset)
+            if cost > budget:
+                continue
+            total = sum(value(n) for n in required) + sum(value(n) for n in subset)
+            if total > best_value or (total == best_value and cost < best_cost):
+                best, best_value, best_cost = list(required) + list(subset), total, cost
+    return best
+
+
+def family_features(profile:dict, names:list) -> list:
+    return [feature for name in names for feature in profile["families"][name]["features"]]
+
+
+@app.command()
+def profile(
+    inp_dir: Path = typer.Option(
+        ...,
+        "--inpDir",
+        help="Folder of images to sample",
+        exists=True,
+        resolve_path=True,
+        readable=True,
+        file_okay=False,
+        dir_okay=True,
+    ),
+    out_file: Path = typer.Option(..., "--outFile", help="JSON file receiving the measurements", resolve_path=True),
+    file_pattern: str = typer.Option(".*.ome.tif", "--filePattern", help="Pattern of the images"),
+    sample: int = typer.Option(8, "--sample", help="Number of images featurized per family"),
+    ):
+    """ Measure the cost of each feature family on a sample of images
+    """
+    files = sample_files(inp_dir, file_pattern, sample)
+    if not files:
+        raise typer.BadParameter(f"No images matching {file_pattern} in {inp_dir}")
+    result = profile_families(files)
+    result["inp_dir"] = str(inp_dir)
+    with open(out_file, "w") as fh:
+        json.dump(result, fh, indent=2)
+    logger.info(f"Profile written to {out_file}")
+
+
+@app.command()
+def plan(
+    profile_file: Path = typer.Option(..., "--profile", help="JSON written by the profile command", exists=True),
+    budget_ms: float = typer.Option(..., "--budgetMs", help="Featurization time per image in ms"),
+    required: str = typer.Option("intensity", "--required", help="Comma separated families always included"),
+    out_file: Path = typer.Option(None, "--outFile", help="Write the feature list as JSON, for --features @file"),
+    ):
+    """ Print the feature list fitting in a per-image time budget
+    """
+    with open(profile_file, "r") as fh:
+        measured = json.load(fh)
+    names = plan_features(measured, budget_ms, tuple(n for n in required.split(",") if n))
+    features = family_features(measured, names)
+    cost = measured["baseline_ms_per_image"] + sum(measured["families"][n]["ms_per_image"] for n in names)
+    logger.info(f"Families {', '.join(names)}: {cost:.1f} ms per image of {budget_ms} ms")
+    if out_file is not None:
+        with open(out_file, "w") as fh:
+            json.dump(features, fh, indent=2)
+    print(",".join(features))
+
+
+if __name__ == '__main__':
+    app()
@@ -0,0 +1,291 @@
+from pathlib import Path
+import os
+import sys
+import shutil
+import sqlite3
+import socket
+import logging
+import xml.etree.ElementTree as ET
+from typing import Optional
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import pyarrow as pa
+import typer
+import tifffile
+import filepattern as fp
+from tqdm import tqdm
+from bfio import BioReader
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from common.scheduler import file_cost
+
+
+app = typer.Typer()
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Image index")
+logger.setLevel(logging.INFO)
+
+# One index per node: sqlite locking is unreliable on NFS, so nodes must not share the file
+INDEX_PATH = Path(os.environ.get(
+    "PANMICRO_IMAGE_INDEX", Path.home() / f".panmicro_image_index.{socket.gethostname()}.sqlite"
+))
+# Header reads wait on the filesystem, not the CPU
+HEADER_THREADS = 32
+# sqlite limits the number of variables of a query
+QUERY_CHUNK = 500
+# OME pixel types whose numpy names differ
+OME_TYPES = {"float": "float32", "double": "float64", "bit": "bool"}
+COLUMNS = [
+    "path", "size", "mtime_ns", "width", "height", "depth", "channels", "timepoints", "dtype",
+    "physical_size_x", "physical_size_y", "physical_size_z", "physical_unit",
+]
+
+
+def _float(value:Optional[str]) -> Optional[float]:
+    return float(value) if value is not None else None
+
+
+def read_header(path) -> dict:
+    """ Shape, dtype and physical size of an image from its OME-XML and TIFF tags
+
+    No pixels are read. Images that are not TIFF files fall back to bfio,
+    which reads their metadata only.
+    """
+    stat = os.stat(path)
+    header = {"path": str(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    try:
+        with tifffile.TiffFile(path) as tf:
+            if tf.is_ome:
+                pixels = ET.fromstring(tf.ome_metadata).find(".//{*}Pixels")
+                header.update({
+                    "width": int(pixels.get("SizeX")),
+                    "height": int(pixels.get("SizeY")),
+                    "depth": int(pixels.get("SizeZ", 1)),
+                    "channels": int(pixels.get("SizeC", 1)),
+                    "timepoints": int(pixels.get("SizeT", 1)),
+                    "dtype": np.dtype(OME_TYPES.get(pixels.get("Type"), pixels.get("Type"))).name,
+                    "physical_size_x": _float(pixels.get("PhysicalSizeX")),
+                    "physical_size_y": _float(pixels.get("PhysicalSizeY")),
+                    "physical_size_z": _float(pixels.get("PhysicalSizeZ")),
+                    "physical_unit": pixels.get("PhysicalSizeYUnit", "µm"),
+                })
+                return header
+            series = tf.series[0]
+            shape = dict(zip(series.axes, series.shape))
+            header.update({
+                "width": shape.get("X", 1),
+                "height": shape.get("Y", 1),
+                "depth": shape.get("Z", 1),
+                "channels": shape.get("C", shape.get("S", 1)),
+                "timepoints": shape.get("T", 1),
+                "dtype": series.dtype.name,
+                "physical_size_x": None,
+                "physical_size_y": None,
+                "physical_size_z": None,
+                "physical_unit": None,
+            })
+            return header
+    except tifffile.TiffFileError:
+        pass
+
+    with BioReader(path) as br:
+        header.update({
+            "width": br.X,
+            "height": br.Y,
+            "depth": br.Z,
+            "channels": br.C,
+            "timepoints": br.T,
+            "dtype": np.dtype(br.dtype).name,
+            "physical_size_x": br.physical_size_x[0],
+            "physical_size_y": br.physical_size_y[0],
+            "physical_size_z": br.physical_size_z[0],
+            "physical_unit": str(br.physical_size_y[1].value) if br.physical_size_y[1] is not None else None,
+        })
+    return header
+
+
+def pixel_bytes(header:dict) -> int:
+    """ Size of an image's pixels in memory
+    """
+    count = header["width"] * header["height"] * header["depth"] * header["channels"] * header["timepoints"]
+    return count * np.dtype(header["dtype"]).itemsize
+
+
+def pixels_per_micron(header:dict) -> float:
+    """ The value the featurization scripts pass to Nyxus, the physical size of a pixel in y or 1.0
+    """
+    value = header["physical_size_y"]
+    return value if value is not None else 1.0
+
+
+class ImageIndex:
+    """ Headers of images, kept in sqlite and refreshed on size and mtime
+
+    The processes of a node can share the index. sqlite relies on file
+    locks that are unreliable on NFS, so every node keeps its own file, by
+    default named after the host; put PANMICRO_IMAGE_INDEX on a local disk
+    where home directories are on NFS.
+    """
+
+    def __init__(self, path=INDEX_PATH, threads:int=HEADER_THREADS):
+        self.path = Path(path)
+        self.threads = threads
+        self.db = sqlite3.connect(self.path, timeout=300)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                "width INTEGER, height INTEGER, depth INTEGER, channels INTEGER, timepoints INTEGER, dtype TEXT, "
+                "physical_size_x REAL, physical_size_y REAL, physical_size_z REAL, physical_unit TEXT)"
+            )
+
+    def _lookup(self, paths:list) -> dict:
+        found = {}
+        for start in range(0, len(paths), QUERY_CHUNK):
+            chunk = paths[start:start + QUERY_CHUNK]
+            rows = self.db.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM images WHERE path IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            for row in rows:
+                found[row[0]] = dict(zip(COLUMNS, row))
+        return found
+
+    def headers(self, files:list) -> dict:
+        """ Header of every file, reading those that are new or changed in parallel
+        """
+        paths = [str(f) for f in files]
+        found = self._lookup(paths)
+        todo = []
+        for path in paths:
+            stat = os.stat(path)
+            header = found.get(path)
+            if header is None or header["size"] != stat.st_size or header["mtime_ns"] != stat.st_mtime_ns:
+                todo.append(path)
+
+        if todo:
+            with ThreadPoolExecutor(max_workers=min(self.threads, len(todo))) as executor:
+                threads = {executor.submit(read_header, path): path for path in todo}
+                for f in tqdm(
+                    as_completed(threads),
+                    total=len(threads),
+                    mininterval=5,
+                    desc="Reading image headers",
+                    colour="cyan",
+                ):
+                    try:
+                        found[threads[f]] = f.result()
+                    except Exception as e:
+                        found.pop(threads[f], None)
+                        logger.warning(f"Cannot read the header of {threads[f]}: {e}")
+            with self.db:
+                self.db.executemany(
+                    f"INSERT OR REPLACE INTO images VALUES ({', '.join('?' * len(COLUMNS))})",
+                    [tuple(found[path][c] for c in COLUMNS) for path in todo if path in found],
+                )
+        logger.debug(f"{len(paths) - len(todo)} of {len(paths)} headers from {self.path}")
+        return {path: found[path] for path in paths if path in found}
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def header_cost(headers:dict):
+    """ Cost function for the schedulers: pixel bytes of indexed images, size on disk of the others
+    """
+    def cost(path) -> int:
+        header = headers.get(str(path))
+        return pixel_bytes(header) if header is not None else file_cost(path)
+    return cost
+
+
+def resolution_groups(headers:dict) -> dict:
+    """ Image paths grouped by the pixels_per_micron Nyxus is given for them
+    """
+    groups = defaultdict(list)
+    for path, header in headers.items():
+        groups[pixels_per_micron(header)].append(path)
+    return dict(groups)
+
+
+def featurize_by_resolution(nyxfun, intensity_dir, file_pattern:str, out_dir, headers:dict, **kwargs) -> None:
+    """ Run a script's nyxfun with the pixels_per_micron of each image
+
+    nyxfun is called once per distinct value, on a folder of symlinks to
+    the images of that value, and the results are combined into
+    out_dir/NyxusFeatures.arrow. The links keep the images' names, so rows
+    are named as in a single call, and every nyxfun path (plain, cached or
+    tiled) sees an ordinary folder. Folders of a single resolution, the
+    usual case, take one call on intensity_dir itself. Images without a
+    header, e.g. one that could not be read, go with those of the default
+    value 1.0.
+    """
+    groups = resolution_groups(headers)
+    names = {Path(path).name for path in headers}
+    unread = [str(f[1][0]) for f in fp.FilePattern(intensity_dir, file_pattern)() if Path(f[1][0]).name not in names]
+    if unread:
+        logger.warning(f"{intensity_dir}: {len(unread)} images without a header featurized with pixels_per_micron 1.0")
+        groups.setdefault(1.0, []).extend(unread)
+    if not groups:
+        raise FileNotFoundError(f"No images matching {file_pattern} in {intensity_dir}")
+    if len(groups) == 1:
+        (value,) = groups
+        nyxfun(intensity_dir=intensity_dir, file_pattern=file_pattern, out_dir=out_dir, pixels_per_micron=value, **kwargs)
+        return
+
+    logger.info(f"{intensity_dir}: {len(groups)} resolutions, {', '.join(str(v) for v in sorted(groups))}")
+    tables, group_dirs = [], []
+    for i, (value, paths) in enumerate(sorted(groups.items())):
+        group_dir = Path(out_dir, f".resolution_{i}")
+        if group_dir.exists():
+            shutil.rmtree(group_dir)
+        link_dir = Path(group_dir, "images")
+        link_dir.mkdir(parents=True)
+        group_dirs.append(group_dir)
+        for path in paths:
+            os.symlink(Path(path).resolve(), Path(link_dir, Path(path).name))
+        nyxfun(intensity_dir=link_dir, file_pattern=file_pattern, out_dir=group_dir, pixels_per_micron=value, **kwargs)
+        with pa.memory_map(str(Path(group_dir, "NyxusFeatures.arrow"))) as source:
+            tables.append(pa.ipc.open_file(source).read_all())
+
+    table = pa.concat_tables(tables, promote_options="default")
+    out_path = Path(out_dir, "NyxusFeatures.arrow")
+    tmp = Path(f"{out_path}.tmp")
+    with pa.OSFile(str(tmp), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp, out_path)
+    for group_dir in group_dirs:
+        shutil.rmtree(group_dir)
+
+
+@app.command()
+def main(
+    inp_dir: Path = typer.Option(
+        ...,
+        "--inpDir",
+        help="Folder of images, searched recursively",
+        exists=True,
+        resolve_path=True,
+        readable=True,
+        file_okay=False,
+        dir_okay=True,
+    ),
+    file_pattern: str = typer.Option(".*.ome.tif", "--filePattern", help="Pattern of the images"),
+    index: Path = typer.Option(INDEX_PATH, "--index", help="sqlite file of the index", resolve_path=True),
+    ):
+    """ Index the headers of all images below a folder
+    """
+    folders = [inp_dir] + sorted(p for p in inp_dir.rglob("*") if p.is_dir())
+    files = [f[1][0] for folder in folders for f in fp.FilePattern(folder, file_pattern)()]
+    headers = ImageIndex(index).headers(files)
+    total = sum(pixel_bytes(h) for h in headers.values())
+    logger.info(f"{len(headers)} images, {total / 1024 ** 3:.1f} GB of pixels, indexed in {index}")
+
+
+if __name__ == '__main__':
+    app()
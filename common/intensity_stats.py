@@ -0,0 +1,284 @@
+from pathlib import Path
+import os
+import sys
+import hashlib
+import logging
+from typing import Optional
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pyarrow as pa
+import typer
+import filepattern as fp
+from tqdm import tqdm
+from bfio import BioReader
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from common.scheduler import available_cpus
+from common.tiled_features import TILE_ALIGN, iter_tiles
+
+
+app = typer.Typer()
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Intensity stats")
+logger.setLevel(logging.INFO)
+
+# Statistics tables are kept outside the feature trees, whose .arrow files are all read as features
+STATS_DIR = Path(os.environ.get("PANMICRO_INTENSITY_STATS", Path.home() / ".panmicro_intensity_stats"))
+STATS_FILE = "IntensityStats.arrow"
+# Tiles streamed per read, so large images are never held whole
+STREAM_TILE = 4 * TILE_ALIGN
+# Bins of the stored histogram, spanning the image's min to max
+HIST_BINS = 256
+PERCENTILES = [0.1, 1, 5, 25, 50, 75, 95, 99, 99.9]
+# Pixels kept per float image to estimate its percentiles and histogram
+FLOAT_SAMPLE = 65536
+
+
+def percentile_column(q:float) -> str:
+    return "p" + f"{q:g}".replace(".", "_")
+
+
+SCHEMA = pa.schema(
+    [
+        ("path", pa.string()),
+        ("size", pa.int64()),
+        ("mtime_ns", pa.int64()),
+        ("dtype", pa.string()),
+        ("height", pa.int64()),
+        ("width", pa.int64()),
+        ("count", pa.int64()),
+        ("min", pa.float64()),
+        ("max", pa.float64()),
+        ("mean", pa.float64()),
+        ("std", pa.float64()),
+    ]
+    + [(percentile_column(q), pa.float64()) for q in PERCENTILES]
+    + [("hist", pa.list_(pa.int64()))]
+)
+
+
+def _hist_quantiles(counts:np.ndarray, values:np.ndarray, qs:list) -> list:
+    """ Percentiles of pixels given as counts of each value, nearest rank
+    """
+    cumulative = np.cumsum(counts)
+    ranks = np.ceil(np.asarray(qs) / 100 * cumulative[-1]).clip(1, None)
+    return [float(v) for v in values[np.searchsorted(cumulative, ranks)]]
+
+
+def image_stats(path) -> dict:
+    """ Min, max, mean, std, percentiles and histogram of an image's first plane
+
+    The image is streamed tile by tile. Integer images are counted per
+    value, which gives exact percentiles and histogram; float images keep an
+    evenly strided sample of FLOAT_SAMPLE pixels for both.
+    """
+    stat = os.stat(path)
+    with BioReader(path) as br:
+        dtype = np.dtype(br.dtype)
+        height, width = br.Y, br.X
+        exact = dtype.kind in "ui" and dtype.itemsize <= 2
+        offset = int(np.iinfo(dtype).min) if exact else 0
+        counts = np.zeros(2 ** (8 * dtype.itemsize), np.int64) if exact else None
+        stride = max(1, height * width // FLOAT_SAMPLE)
+        sample = []
+        total, mean, m2 = 0, 0.0, 0.0
+        lo, hi = np.inf, -np.inf
+        for _, _, tile in iter_tiles(br, STREAM_TILE):
+            pixels = tile.ravel()
+            if exact:
+                counts += np.bincount((pixels.astype(np.int64) - offset), minlength=counts.size)
+            else:
+                sample.append(pixels[::stride].astype(np.float64))
+            # Chan et al. merge of the tile's mean and variance
+            n = pixels.size
+            tile_mean = float(pixels.mean(dtype=np.float64))
+            tile_m2 = float(((pixels - tile_mean) ** 2).sum(dtype=np.float64))
+            delta = tile_mean - mean
+            mean += delta * n / (total + n)
+            m2 += tile_m2 + delta ** 2 * total * n / (total + n)
+            total += n
+            lo, hi = min(lo, float(pixels.min())), max(hi, float(pixels.max()))
+
+    edges = np.linspace(lo, hi, HIST_BINS + 1) if hi > lo else np.array([lo, lo + 1.0])
+    if exact:
+        present = np.flatnonzero(counts)
+        values = (present + offset).astype(np.float64)
+        quantiles = _hist_quantiles(counts[present], values, PERCENTILES)
+        hist, _ = np.histogram(values, bins=edges, weights=counts[present])
+    else:
+        sample = np.sort(np.concatenate(sample))
+        quantiles = [float(v) for v in np.percentile(sample, PERCENTILES, method="inverted_cdf")]
+        hist, _ = np.histogram(sample, bins=edges)
+        hist = hist * (total / sample.size)
+
+    row = {
+        "path": str(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "dtype": dtype.name,
+        "height": height,
+        "width": width,
+        "count": total,
+        "min": lo,
+        "max": hi,
+        "mean": mean,
+        "std": float(np.sqrt(m2 / total)),
+        "hist": [int(round(c)) for c in np.pad(hist, (0, HIST_BINS - hist.size))],
+    }
+    row.update({percentile_column(q): v for q, v in zip(PERCENTILES, quantiles)})
+    return row
+
+
+def stats_path(folder:Path, store:Path=STATS_DIR) -> Path:
+    """ Statistics table of a folder of images under STATS_DIR
+    """
+    digest = hashlib.blake2b(str(Path(folder).resolve()).encode(), digest_size=8).hexdigest()
+    return Path(store, f"{Path(folder).name}_{digest}_{STATS_FILE}")
+
+
+def read_stats(stats_path:Path) -> pa.Table:
+    with pa.memory_map(str(stats_path)) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def _write(table:pa.Table, path:Path) -> None:
+    tmp = Path(f"{path}.tmp")
+    with pa.OSFile(str(tmp), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp, path)
+
+
+def collect_stats(files:list, stats_path:Path, processes:Optional[int]=None) -> pa.Table:
+    """ Statistics of every file, read once per change of the file
+
+    Rows of files whose size and modification time match the table at
+    stats_path are reused, the others are computed in parallel, each image
+    being read once. The table holds the rows of files only and is replaced
+    atomically, so it can serve QC and normalisation afterwards.
+    """
+    stats_path = Path(stats_path)
+    files = sorted(str(f) for f in files)
+    cached = {}
+    if stats_path.exists():
+        for row in read_stats(stats_path).to_pylist():
+            cached[row["path"]] = row
+
+    rows, todo = {}, []
+    for f in files:
+        stat = os.stat(f)
+        row = cached.get(f)
+        if row is not None and row["size"] == stat.st_size and row["mtime_ns"] == stat.st_mtime_ns:
+            rows[f] = row
+        else:
+            todo.append(f)
+
+    if todo:
+        processes = min(processes or available_cpus(), len(todo))
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            threads = {executor.submit(image_stats, f): f for f in todo}
+            for f in tqdm(
+                as_completed(threads),
+                total=len(threads),
+                mininterval=5,
+                desc=f"Intensity statistics {stats_path.parent}",
+                colour="cyan",
+            ):
+                rows[threads[f]] = f.result()
+
+    table = pa.Table.from_pylist([rows[f] for f in files], schema=SCHEMA)
+    if todo or len(cached) != len(files):
+        stats_path.parent.mkdir(parents=True, exist_ok=True)
+        _write(table, stats_path)
+    logger.info(f"{len(files) - len(todo)} of {len(files)} images of {stats_path} were already measured")
+    return table
+
+
+def merged_histogram(table:pa.Table, bins:int=HIST_BINS * 4) -> tuple:
+    """ Histogram of all pixels of the table's images on one grid
+
+    Each image's histogram is spread over the common grid assuming the
+    pixels are uniform within its bins. Returns counts and bin edges.
+    """
+    lo, hi = min(table["min"].to_pylist()), max(table["max"].to_pylist())
+    edges = np.linspace(lo, hi, bins + 1) if hi > lo else np.array([lo, lo + 1.0])
+    cumulative = np.zeros(edges.size)
+    for image_lo, image_hi, hist in zip(table["min"].to_pylist(), table["max"].to_pylist(), table["hist"].to_pylist()):
+        hist = np.asarray(hist, dtype=np.float64)
+        if image_hi > image_lo:
+            image_edges = np.linspace(image_lo, image_hi, hist.size + 1)
+            cumulative += np.interp(edges, image_edges, np.concatenate([[0.0], np.cumsum(hist)]))
+        else:
+            cumulative += np.where(edges >= image_lo, hist.sum(), 0.0)
+    return np.diff(cumulative), edges
+
+
+def intensity_range(table:pa.Table, lower:float=0.0, upper:float=100.0) -> tuple:
+    """ Intensity range of all images of the table between two percentiles
+
+    0 and 100 give the exact min and max; other percentiles are read from
+    the merged histogram, to the precision of its bins.
+    """
+    if lower <= 0 and upper >= 100:
+        return min(table["min"].to_pylist()), max(table["max"].to_pylist())
+    counts, edges = merged_histogram(table)
+    cumulative = np.concatenate([[0.0], np.cumsum(counts)]) / counts.sum()
+    lo = min(table["min"].to_pylist()) if lower <= 0 else float(np.interp(lower / 100, cumulative, edges))
+    hi = max(table["max"].to_pylist()) if upper >= 100 else float(np.interp(upper / 100, cumulative, edges))
+    return lo, hi
+
+
+def group_ranges(table:pa.Table, group=lambda path: str(Path(path).parent), lower:float=0.0, upper:float=100.0) -> dict:
+    """ intensity_range of each group of images, by default of each folder
+    """
+    indices = defaultdict(list)
+    for i, path in enumerate(table["path"].to_pylist()):
+        indices[group(path)].append(i)
+    return {
+        key: intensity_range(table.take(pa.array(rows, pa.int64())), lower, upper)
+        for key, rows in indices.items()
+    }
+
+
+def nyxus_range(table:pa.Table, lower:float=0.0, upper:float=100.0) -> dict:
+    """ Nyxus parameters setting the intensity range of the table's images
+    """
+    lo, hi = intensity_range(table, lower, upper)
+    return {"min_intensity": lo, "max_intensity": hi}
+
+
+@app.command()
+def main(
+    inp_dir: Path = typer.Option(
+        ...,
+        "--inpDir",
+        help="Folder of images",
+        exists=True,
+        resolve_path=True,
+        readable=True,
+        file_okay=False,
+        dir_okay=True,
+    ),
+    out_file: Path = typer.Option(None, "--outFile", help=f"Statistics table, kept in {STATS_DIR} when not given", resolve_path=True),
+    file_pattern: str = typer.Option(".*.ome.tif", "--filePattern", help="Pattern of the images"),
+    lower: float = typer.Option(0.0, "--lower", help="Percentile of the lower end of the printed range"),
+    upper: float = typer.Option(100.0, "--upper", help="Percentile of the upper end of the printed range"),
+    ):
+    """ Measure the intensity statistics of a folder and print its intensity range
+    """
+    files = [f[1][0] for f in fp.FilePattern(inp_dir, file_pattern)()]
+    if not files:
+        raise typer.BadParameter(f"No images matching {file_pattern} in {inp_dir}")
+    table = collect_stats(files, out_file or stats_path(inp_dir))
+    lo, hi = intensity_range(table, lower, upper)
+    print(f"{lo} {hi}")
+
+
+if __name__ == '__main__':
+    app()
@@ -0,0 +1,204 @@
+from pathlib import Path
+import os
+import time
+import hashlib
+import logging
+from typing import Optional
+from collections import defaultdict
+import pyarrow as pa
+import typer
+import filepattern as fp
+
+
+app = typer.Typer()
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Inventory")
+logger.setLevel(logging.INFO)
+
+# Listings are kept outside the dataset trees, which may be read-only
+INVENTORY_DIR = Path(os.environ.get("PANMICRO_INVENTORY", Path.home() / ".panmicro_inventory"))
+SCHEMA = pa.schema(
+    [
+        ("path", pa.string()),
+        ("is_dir", pa.bool_()),
+        ("size", pa.int64()),
+        ("mtime_ns", pa.int64()),
+        ("depth", pa.int16()),
+    ]
+)
+
+
+def listing_path(root:Path, store:Path=INVENTORY_DIR) -> Path:
+    digest = hashlib.blake2b(str(Path(root).resolve()).encode(), digest_size=8).hexdigest()
+    return Path(store, f"{Path(root).name}_{digest}.arrow")
+
+
+def scan_tree(root:Path) -> pa.Table:
+    """ Every file and directory below root in one os.scandir pass
+
+    Paths are relative to root. Symlinked directories are listed but not
+    entered, which keeps link cycles from looping.
+    """
+    paths, is_dir, sizes, mtimes, depths = [], [], [], [], []
+    stack = [(str(root), "", 0)]
+    while stack:
+        directory, relative, depth = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except (PermissionError, FileNotFoundError) as e:
+            logger.warning(f"Cannot list {directory}: {e}")
+            continue
+        for entry in entries:
+            try:
+                stat = entry.stat()
+                directory_entry = entry.is_dir()
+            except FileNotFoundError:
+                # Removed while scanning
+                continue
+            path = f"{relative}/{entry.name}" if relative else entry.name
+            paths.append(path)
+            is_dir.append(directory_entry)
+            sizes.append(0 if directory_entry else stat.st_size)
+            mtimes.append(stat.st_mtime_ns)
+            depths.append(depth + 1)
+            if directory_entry and not entry.is_symlink():
+                stack.append((entry.path, path, depth + 1))
+    return pa.table([paths, is_dir, sizes, mtimes, depths], schema=SCHEMA)
+
+
+class Inventory:
+    """ Listing of a dataset tree, scanned once per run and kept between runs
+
+    The tree is walked once when the inventory is created and queries are
+    answered from the listing, so folders and patterns cost no further
+    filesystem calls. The listing is saved under INVENTORY_DIR, and the one
+    saved by the previous run tells which files changed since. With
+    save=False it is saved only by an explicit save(), e.g. once the run's
+    outputs for the listed files are all written.
+    """
+
+    def __init__(self, root, store:Path=INVENTORY_DIR, save:bool=True):
+        self.root = Path(root).resolve()
+        self.path = listing_path(self.root, store)
+        self.previous = self._load()
+
+        starttime = time.time()
+        self.table = scan_tree(self.root)
+        if save:
+            self.save()
+
+        self._dirs = []
+        self._files = defaultdict(list)
+        self._stats = {}
+        for path, is_dir, size, mtime, depth in zip(*(self.table[c].to_pylist() for c in SCHEMA.names)):
+            if is_dir:
+                self._dirs.append((path, depth))
+            else:
+                parent, _, _ = path.rpartition("/")
+                self._files[parent].append(path)
+                self._stats[path] = (size, mtime)
+        logger.info(
+            f"{self.root}: {len(self._stats)} files in {len(self._dirs)} folders, scanned in {time.time() - starttime:.1f} s"
+        )
+
+    def _load(self) -> Optional[dict]:
+        if not self.path.exists():
+            return None
+        with pa.memory_map(str(self.path)) as source:
+            table = pa.ipc.open_file(source).read_all()
+        return {
+            path: (size, mtime)
+            for path, is_dir, size, mtime in zip(
+                table["path"].to_pylist(), table["is_dir"].to_pylist(), table["size"].to_pylist(), table["mtime_ns"].to_pylist()
+            )
+            if not is_dir
+        }
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(f"{self.path}.{os.getpid()}.tmp")
+        schema = self.table.schema.with_metadata({"root": str(self.root), "scanned": str(time.time())})
+        with pa.OSFile(str(tmp), "wb") as sink:
+            with pa.ipc.new_file(sink, schema) as writer:
+                writer.write_table(self.table.replace_schema_metadata(schema.metadata))
+        os.replace(tmp, self.path)
+
+    def _relative(self, folder) -> str:
+        relative = Path(folder).resolve().relative_to(self.root)
+        return "" if relative == Path(".") else relative.as_posix()
+
+    def dirs(self) -> list:
+        return sorted(Path(self.root, path) for path, _ in self._dirs)
+
+    def leaf_dirs(self, part:Optional[str]=None) -> list:
+        """ Deepest folders having part among their path components, e.g. the image folders below Images
+
+        Without part, folders without subfolders.
+        """
+        if part is None:
+            parents = {path.rpartition("/")[0] for path, _ in self._dirs}
+            return sorted(Path(self.root, path) for path, _ in self._dirs if path not in parents)
+        matching = [(path, depth) for path, depth in self._dirs if part in Path(self.root, path).parts]
+        if not matching:
+            return []
+        deepest = max(depth for _, depth in matching)
+        return sorted(Path(self.root, path) for path, depth in matching if depth == deepest)
+
+    def files(self, folder, file_pattern:str=".*") -> list:
+        """ Files directly in folder matching a filepattern, as FilePattern on the folder lists them
+        """
+        paths = [str(Path(self.root, path)) for path in self._files.get(self._relative(folder), [])]
+        if not paths:
+            return []
+        return [f[1][0] for f in fp.FilePattern(paths, file_pattern)()]
+
+    def changed(self, folder=None) -> list:
+        """ Files below folder new or modified since the previous run, all of them on the first run
+        """
+        prefix = self._relative(folder) if folder is not None else ""
+        previous = self.previous or {}
+        return sorted(
+            Path(self.root, path)
+            for path, stat in self._stats.items()
+            if (not prefix or path.startswith(prefix + "/")) and previous.get(path) != stat
+        )
+
+    def removed(self, folder=None) -> list:
+        """ Files below folder in the previous run's listing that are gone
+        """
+        prefix = self._relative(folder) if folder is not None else ""
+        return sorted(
+            Path(self.root, path)
+            for path in (self.previous or {})
+            if (not prefix or path.startswith(prefix + "/")) and path not in self._stats
+        )
+
+
+@app.command()
+def main(
+    inp_dir: Path = typer.Option(
+        ...,
+        "--inpDir",
+        help="Root of the dataset tree",
+        exists=True,
+        resolve_path=True,
+        readable=True,
+        file_okay=False,
+        dir_okay=True,
+    ),
+    part: str = typer.Option(None, "--part", help="List the deepest folders below this path component, e.g. Images"),
+    ):
+    """ Scan a dataset tree and print its leaf folders and the files changed since the last scan
+    """
+    inventory = Inventory(inp_dir)
+    for folder in inventory.leaf_dirs(part):
+        print(folder)
+    logger.info(f"{len(inventory.changed())} files changed, {len(inventory.removed())} removed since the last scan")
+
+
+if __name__ == '__main__':
+    app()
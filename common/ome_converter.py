@@ -0,0 +1,168 @@
+from pathlib import Path
+import os
+import re
+import time
+import shutil
+import logging
+from typing import Optional
+from multiprocessing import cpu_count, get_context
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import filepattern as fp
+from bfio import BioReader, BioWriter
+from tqdm import tqdm
+from common.executor import Job, JobResult, run_job, container_command
+from common.scheduler import lpt_order, file_cost
+
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Ome converter")
+logger.setLevel(logging.INFO)
+
+NUM_WORKERS = max(cpu_count() // 2, 2)
+TILE_SIZE = 1024 * 4
+# Callers may be multithreaded (pipeline stages, Nyxus), and forking them can deadlock the workers
+MP_CONTEXT = "forkserver"
+
+CONTAINER = "/home/abbasih2/plugins/ome-converter-tool_0_1_0_dev0.sif"
+
+
+def output_name(inp_file:Path, file_extension:str) -> str:
+    """ Output file name for an input image, Plate1_A01.png -> Plate1_A01.ome.tif
+    """
+    name = re.sub(r"(\.ome)?\.[^.]+$", "", Path(inp_file).name)
+    return f"{name}{file_extension}"
+
+
+def is_up_to_date(inp_file:Path, out_file:Path) -> bool:
+    return out_file.exists() and out_file.stat().st_mtime >= Path(inp_file).stat().st_mtime
+
+
+def convert_image(inp_file:Path, out_file:Path) -> Path:
+    """ Convert one image to OME tile by tile, so memory does not grow with image size
+
+    The image is written under a temporary name and renamed into place once
+    complete, so an interrupted conversion never leaves a truncated output.
+    """
+    out_file = Path(out_file)
+    tmp_file = out_file.with_name(f".partial_{out_file.name}")
+
+    with BioReader(inp_file) as br:
+        with BioWriter(tmp_file, metadata=br.metadata) as bw:
+            for t in range(br.T):
+                for c in range(br.C):
+                    for z in range(br.Z):
+                        for y in range(0, br.Y, TILE_SIZE):
+                            y_max = min(y + TILE_SIZE, br.Y)
+                            for x in range(0, br.X, TILE_SIZE):
+                                x_max = min(x + TILE_SIZE, br.X)
+                                bw[y:y_max, x:x_max, z:z + 1, c, t] = br[y:y_max, x:x_max, z:z + 1, c, t]
+
+    if out_file.is_dir():
+        shutil.rmtree(out_file)
+    os.replace(tmp_file, out_file)
+    return out_file
+
+
+def convert_files(
+    file_map:dict,
+    num_workers:int=NUM_WORKERS,
+    force:bool=False,
+    desc:str="Converting",
+) -> dict:
+    """ Convert each input image in file_map to its output path on a process pool
+
+    The largest images are submitted first, so none of them is left running
+    alone at the end.
+
+    Args:
+        file_map (dict): Input image path mapped to output image path
+        num_workers (int): Number of conversion processes
+        force (bool): Convert even when the output is newer than the input
+        desc (str): Progress bar label
+
+    Returns:
+        Dictionary with the converted, skipped and failed files, failures
+        mapped to their error message.
+    """
+    result = {"converted": [], "skipped": [], "failed": {}}
+    todo = []
+    for inp_file, out_file in file_map.items():
+        out_file = Path(out_file)
+        if not force and is_up_to_date(inp_file, out_file):
+            result["skipped"].append(inp_file)
+        else:
+            out_file.parent.mkdir(parents=True, exist_ok=True)
+            todo.append((inp_file, out_file))
+    todo = lpt_order(todo, cost=lambda pair: file_cost(pair[0]))
+
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=get_context(MP_CONTEXT)) as executor:
+        threads = {executor.submit(convert_image, inp_file, out_file): inp_file for inp_file, out_file in todo}
+        for f in tqdm(
+            as_completed(threads),
+            total=len(threads),
+            mininterval=5,
+            desc=desc,
+            initial=0,
+            unit_scale=True,
+            colour="cyan",
+        ):
+            inp_file = threads[f]
+            try:
+                f.result()
+                result["converted"].append(inp_file)
+            except Exception as e:
+                result["failed"][inp_file] = str(e)
+                logger.error(f"Failed to convert {inp_file}: {e}")
+
+    logger.info(
+        f"{desc}: {len(result['converted'])} converted, {len(result['skipped'])} up to date, "
+        f"{len(result['failed'])} failed"
+    )
+    return result
+
+
+def convert_directory(
+    inp_dir:Path,
+    file_pattern:str,
+    file_extension:str,
+    out_dir:Path,
+    num_workers:int=NUM_WORKERS,
+    force:bool=False,
+) -> dict:
+    """ Convert every image of inp_dir matching file_pattern on a process pool
+
+    Args:
+        inp_dir (Path): Folder of input images
+        file_pattern (str): filepattern selecting the images to convert
+        file_extension (str): Output format, .ome.tif or .ome.zarr
+        out_dir (Path): Output folder
+        num_workers (int): Number of conversion processes
+        force (bool): Convert even when the output is newer than the input
+
+    Returns:
+        Dictionary with the converted, skipped and failed files, failures
+        mapped to their error message.
+    """
+    fps = fp.FilePattern(inp_dir, file_pattern)
+    flist = [f[1][0] for f in fps()]
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+
+    file_map = {inp_file: Path(out_dir, output_name(inp_file, file_extension)) for inp_file in flist}
+    return convert_files(file_map, num_workers=num_workers, force=force, desc=str(inp_dir))
+
+
+def container_convert(inp_dir:Path, file_pattern:str, file_extension:str, out_dir:Path, container:Optional[str]=None) -> JobResult:
+    """ Convert a folder with the ome-converter singularity container
+    """
+    job = Job(
+        name=f"omeconverter_{Path(inp_dir).name}",
+        command=container_command(container or CONTAINER, [
+            f"--inpDir={inp_dir}", f"--filePattern={file_pattern}",
+            f"--fileExtension={file_extension}", f"--outDir={out_dir}",
+        ]),
+        log_path=Path(out_dir, "logs", f"omeconverter_{Path(inp_dir).name}.log"),
+    )
+    return run_job(job)
@@ -0,0 +1,164 @@
+import time
+import queue
+import logging
+import threading
+from typing import Callable
+from dataclasses import dataclass, field
+
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Pipeline")
+logger.setLevel(logging.INFO)
+
+# Seconds between queue depth samples and between status lines
+SAMPLE_SECONDS = 1
+STATUS_SECONDS = 300
+
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    """ A step of a pipeline: fn maps an item to the item handed to the next stage
+
+    fn returning None drops the item. The stage has its own worker threads
+    and a bounded input queue, so a slow stage holds back the stages before
+    it instead of letting work pile up in memory.
+    """
+    name: str
+    fn: Callable
+    workers: int = 1
+    queue_size: int = 2
+    processed: int = 0
+    failed: int = 0
+    busy_seconds: float = 0.0
+    depth_sum: int = 0
+    depth_max: int = 0
+    samples: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+
+class Pipeline:
+    """ Items streamed through stages, each stage working on a different item
+
+    With convert, featurize and annotate stages, folder N+1 converts while
+    folder N featurizes and folder N-1 is annotated. Queue depths are
+    sampled and stage utilisation, the fraction of its workers' time spent
+    in fn, is logged every STATUS_SECONDS and at the end: a stage near 100%
+    with a full input queue is the bottleneck.
+    """
+
+    def __init__(self, stages:list, describe:Callable=str, status_seconds:float=STATUS_SECONDS):
+        self.stages = stages
+        self.describe = describe
+        self.status_seconds = status_seconds
+        self.queues = [queue.Queue(maxsize=stage.queue_size) for stage in stages]
+        self.results = []
+        self.failures = {}
+        self.starttime = None
+
+    def _work(self, i:int, remaining:list) -> None:
+        stage, inbox = self.stages[i], self.queues[i]
+        outbox = self.queues[i + 1] if i + 1 < len(self.stages) else None
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            starttime = time.time()
+            try:
+                result = stage.fn(item)
+            except Exception as e:
+                logger.error(f"{stage.name} failed on {self.describe(item)}: {e}")
+                self.failures[self.describe(item)] = f"{stage.name}: {e}"
+                result = None
+                with stage.lock:
+                    stage.failed += 1
+            else:
+                with stage.lock:
+                    stage.processed += 1
+            with stage.lock:
+                stage.busy_seconds += time.time() - starttime
+
+            if result is None:
+                continue
+            if outbox is not None:
+                outbox.put(result)
+            else:
+                self.results.append(result)
+
+        # The last worker of a stage to finish closes the next stage
+        with stage.lock:
+            remaining[i] -= 1
+            last = remaining[i] == 0
+        if last and outbox is not None:
+            for _ in range(self.stages[i + 1].workers):
+                outbox.put(_DONE)
+
+    def _monitor(self, stop:threading.Event) -> None:
+        last_status = time.time()
+        while not stop.wait(SAMPLE_SECONDS):
+            for stage, inbox in zip(self.stages, self.queues):
+                depth = inbox.qsize()
+                stage.depth_sum += depth
+                stage.depth_max = max(stage.depth_max, depth)
+                stage.samples += 1
+            if time.time() - last_status >= self.status_seconds:
+                self.log_stats()
+                last_status = time.time()
+
+    def stats(self) -> dict:
+        """ Per stage: items processed and failed, utilisation and input queue depth
+        """
+        elapsed = max(time.time() - self.starttime, 1e-9) if self.starttime else 1e-9
+        return {
+            stage.name: {
+                "processed": stage.processed,
+                "failed": stage.failed,
+                "utilisation": stage.busy_seconds / (stage.workers * elapsed),
+                "queue_depth": inbox.qsize(),
+                "mean_queue_depth": stage.depth_sum / stage.samples if stage.samples else 0.0,
+                "max_queue_depth": stage.depth_max,
+            }
+            for stage, inbox in zip(self.stages, self.queues)
+        }
+
+    def log_stats(self) -> None:
+        for name, s in self.stats().items():
+            logger.info(
+                f"{name:12s} {s['processed']:5d} done {s['failed']:3d} failed  utilisation {100 * s['utilisation']:5.1f}%  "
+                f"queue {s['queue_depth']} (mean {s['mean_queue_depth']:.1f}, max {s['max_queue_depth']})"
+            )
+
+    def run(self, items) -> list:
+        """ Stream items through the stages, returns the outputs of the last stage
+
+        Failures are logged and the item dropped, the others go on; failed
+        items are kept in self.failures with the stage and error.
+        """
+        self.starttime = time.time()
+        remaining = [stage.workers for stage in self.stages]
+        workers = [
+            threading.Thread(target=self._work, args=(i, remaining), name=f"{stage.name}-{n}", daemon=True)
+            for i, stage in enumerate(self.stages)
+            for n in range(stage.workers)
+        ]
+        stop = threading.Event()
+        monitor = threading.Thread(target=self._monitor, args=(stop,), daemon=True)
+        for thread in workers:
+            thread.start()
+        monitor.start()
+
+        for item in items:
+            self.queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            self.queues[0].put(_DONE)
+
+        for thread in workers:
+            thread.join()
+        stop.set()
+        monitor.join()
+        self.log_stats()
+        return self.results
@@ -0,0 +1,211 @@
+from pathlib import Path
+import os
+import json
+import logging
+import platform
+import threading
+from typing import Optional
+from dataclasses import dataclass
+import psutil
+
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Scheduler")
+logger.setLevel(logging.INFO)
+
+# Shared overrides for every featurization script, e.g. PANMICRO_CPUS=16
+CPUS_ENV = "PANMICRO_CPUS"
+PROCESSES_ENV = "PANMICRO_PROCESSES"
+THREADS_ENV = "PANMICRO_THREADS"
+
+# Images above this size get several Nyxus threads per process
+LARGE_IMAGE_BYTES = 64 * 1024 ** 2
+LARGE_IMAGE_THREADS = 4
+# Working memory of a Nyxus process relative to the size of the image
+MEMORY_FACTOR = 8
+
+# Autotuned profiles, keyed by host signature and dataset
+PROFILE_PATH = Path(os.environ.get("PANMICRO_PROFILES", Path.home() / ".panmicro_profiles.json"))
+_profile_lock = threading.Lock()
+
+
+@dataclass
+class Schedule:
+    """ Number of worker processes and Nyxus threads within each of them
+    """
+    processes: int
+    threads: int
+
+    @property
+    def cpus(self) -> int:
+        return self.processes * self.threads
+
+
+def _env_int(name:str) -> Optional[int]:
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+def cgroup_cpus() -> Optional[float]:
+    """ CPU quota of the cgroup the process runs in, None when unlimited
+    """
+    # cgroup v2
+    cpu_max = Path("/sys/fs/cgroup/cpu.max")
+    if cpu_max.exists():
+        quota, period = cpu_max.read_text().split()[:2]
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    # cgroup v1
+    quota_path = Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period_path = Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota_path.exists() and period_path.exists():
+        quota = int(quota_path.read_text())
+        if quota > 0:
+            return quota / int(period_path.read_text())
+    return None
+
+
+def available_cpus() -> int:
+    """ CPUs this process may actually use
+
+    Takes the smallest of the affinity mask, which reflects SLURM and taskset
+    allocations, and the cgroup quota of containers. PANMICRO_CPUS overrides
+    both.
+    """
+    override = _env_int(CPUS_ENV)
+    if override:
+        return override
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpus()
+    if quota is not None:
+        cpus = min(cpus, max(int(quota), 1))
+    return max(cpus, 1)
+
+
+def file_cost(path) -> int:
+    """ Cost estimate of featurizing an image, its size on disk
+    """
+    return os.stat(path).st_size
+
+
+def lpt_order(items:list, cost=file_cost) -> list:
+    """ Items in longest-processing-time first order
+
+    Starting the largest images first keeps a single large image from being
+    the last task running while all other workers sit idle.
+    """
+    return sorted(items, key=cost, reverse=True)
+
+
+def host_signature() -> str:
+    """ Identifies a node type: CPU model, usable CPUs and memory
+    """
+    model = platform.processor() or platform.machine()
+    cpuinfo = Path("/proc/cpuinfo")
+    if cpuinfo.exists():
+        for line in cpuinfo.read_text().splitlines():
+            if line.startswith("model name"):
+                model = line.split(":", 1)[1].strip()
+                break
+    memory_gb = round(psutil.virtual_memory().total / 1024 ** 3)
+    return f"{model}|{available_cpus()}cpu|{memory_gb}GB"
+
+
+def read_profiles(path:Path=PROFILE_PATH) -> dict:
+    if not Path(path).exists():
+        return {}
+    with open(path, "r") as fh:
+        return json.load(fh)
+
+
+def dataset_key(dataset:Optional[str]) -> Optional[str]:
+    """ Key of a dataset in the profiles, case-insensitive so TissueNet and tissueNet match
+    """
+    return dataset.casefold() if dataset else None
+
+
+def save_profile(dataset:str, profile:dict, path:Path=PROFILE_PATH) -> None:
+    """ Store the profile of a dataset for this host, replacing any earlier one
+    """
+    with _profile_lock:
+        profiles = read_profiles(path)
+        host = profiles.setdefault(host_signature(), {})
+        # Profiles stored before keys were normalized, under another spelling
+        for key in [k for k in host if dataset_key(k) == dataset_key(dataset)]:
+            del host[key]
+        host[dataset_key(dataset)] = profile
+        tmp = Path(f"{path}.tmp")
+        with open(tmp, "w") as fh:
+            json.dump(profiles, fh, indent=2)
+        os.replace(tmp, path)
+
+
+def load_profile(dataset:Optional[str], path:Path=PROFILE_PATH) -> Optional[dict]:
+    """ Autotuned profile of a dataset on this host, None when not tuned
+    """
+    if dataset is None:
+        return None
+    try:
+        host = read_profiles(path).get(host_signature(), {})
+        return {dataset_key(k): v for k, v in host.items()}.get(dataset_key(dataset))
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable profiles {path}: {e}")
+        return None
+
+
+def plan(files:Optional[list]=None, processes:Optional[int]=None, cpus:Optional[int]=None,
+         dataset:Optional[str]=None, cost=file_cost) -> Schedule:
+    """ Split the available CPUs into worker processes and Nyxus threads
+
+    Small images are featurized one thread per process, large ones get
+    LARGE_IMAGE_THREADS threads per process. The number of processes is
+    bounded by the number of images and by the memory the largest image
+    needs, as estimated by cost, e.g. the pixel bytes of the image index.
+    Passing processes fixes the process count, e.g. processes=1 for
+    scripts that hand a whole directory to a single Nyxus call.
+
+    When the dataset has been autotuned on this kind of host, the measured
+    profile is used instead of the heuristic. PANMICRO_PROCESSES and
+    PANMICRO_THREADS override the result.
+    """
+    profile = load_profile(dataset)
+    if profile is not None:
+        if processes == 1:
+            threads = profile["single_threads"]
+        else:
+            processes, threads = processes or profile["processes"], profile["threads"]
+    else:
+        cpus = cpus or available_cpus()
+        largest = max((cost(f) for f in files), default=0) if files else 0
+
+        if processes is None:
+            threads = LARGE_IMAGE_THREADS if largest > LARGE_IMAGE_BYTES else 1
+            threads = min(threads, cpus)
+            processes = max(cpus // threads, 1)
+            if files:
+                processes = min(processes, len(files))
+            if largest:
+                memory_limit = psutil.virtual_memory().available // (largest * MEMORY_FACTOR)
+                processes = max(min(processes, memory_limit), 1)
+        processes = max(processes, 1)
+        threads = max(cpus // processes, 1)
+
+    schedule = Schedule(
+        processes=_env_int(PROCESSES_ENV) or processes,
+        threads=_env_int(THREADS_ENV) or threads,
+    )
+    logger.debug(f"{schedule.processes} processes x {schedule.threads} threads")
+    return schedule
+
+
+def nyxus_threads(dataset:Optional[str]=None) -> int:
+    """ Nyxus threads for a script running a single Nyxus call at a time
+    """
+    return plan(processes=1, dataset=dataset).threads
@@ -0,0 +1,142 @@
+from pathlib import Path
+import os
+import math
+import logging
+import numpy as np
+import pyarrow as pa
+import filepattern as fp
+from bfio import BioReader
+
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Tiled features")
+logger.setLevel(logging.INFO)
+
+# bfio reads in 1024 pixel tiles, tiles are kept on that grid
+TILE_ALIGN = 1024
+# Working memory of Nyxus relative to the tile's pixels, as in common.scheduler
+MEMORY_FACTOR = 8
+TILE_COLUMNS = ["tile_x", "tile_y", "tile_width", "tile_height"]
+ID_COLUMNS = ["intensity_image", "mask_image", "ROI_label", "t_index"]
+
+
+def tile_size_for(memory_mb:float, itemsize:int) -> int:
+    """ Largest aligned tile side whose featurization fits in memory_mb
+    """
+    # Pixels, Nyxus working copies and the uint32 mask
+    bytes_per_pixel = itemsize * MEMORY_FACTOR + 4
+    side = int(math.sqrt(memory_mb * 1024 ** 2 / bytes_per_pixel))
+    return max(TILE_ALIGN, side // TILE_ALIGN * TILE_ALIGN)
+
+
+def iter_tiles(br:BioReader, tile_size:int):
+    """ (x, y, pixels) of each tile of the first plane, one tile in memory at a time
+    """
+    for y in range(0, br.Y, tile_size):
+        for x in range(0, br.X, tile_size):
+            height, width = min(tile_size, br.Y - y), min(tile_size, br.X - x)
+            tile = br[y:y + height, x:x + width, 0, 0, 0]
+            # Reshaped, not squeezed, so edge tiles one pixel wide or tall stay 2D
+            yield x, y, np.asarray(tile).reshape(height, width)
+
+
+class TileAggregate:
+    """ Running count, mean, standard deviation, min and max of features over tiles
+
+    Uses Welford's update so only one row of state is kept per image.
+    """
+
+    def __init__(self, columns:list):
+        self.columns = columns
+        n = len(columns)
+        self.count = np.zeros(n)
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)
+        self.min = np.full(n, np.inf)
+        self.max = np.full(n, -np.inf)
+        self.tiles = 0
+
+    def add(self, values:np.ndarray) -> None:
+        self.tiles += 1
+        finite = np.isfinite(values)
+        self.count[finite] += 1
+        delta = np.where(finite, values - self.mean, 0.0)
+        self.mean[finite] += delta[finite] / self.count[finite]
+        self.m2[finite] += delta[finite] * (values[finite] - self.mean[finite])
+        self.min[finite] = np.minimum(self.min[finite], values[finite])
+        self.max[finite] = np.maximum(self.max[finite], values[finite])
+
+    def table(self, name:str) -> pa.Table:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            std = np.sqrt(self.m2 / self.count)
+        empty = self.count == 0
+        data = {"intensity_image": [name], "tiles": [self.tiles]}
+        for stat, values in (("mean", self.mean), ("std", std), ("min", self.min), ("max", self.max)):
+            values = np.where(empty, np.nan, values)
+            for column, value in zip(self.columns, values):
+                data[f"{column}_{stat}"] = [float(value)]
+        return pa.table(data)
+
+
+def featurize_tiled(nyx, files:list, out_path:Path, tile_size:int, aggregate:bool=False) -> Path:
+    """ Featurize images tile by tile into a single arrow file
+
+    Every tile is a whole-tile ROI and gives one row tagged with tile_x,
+    tile_y, tile_width and tile_height. With aggregate there is one row per
+    image instead, holding the mean, std, min and max of every feature over
+    its tiles. Rows are streamed to disk, so memory depends on the tile size
+    only, not on the size of the images.
+    """
+    out_path = Path(out_path)
+    tmp = out_path.with_suffix(".arrow.tmp")
+    writer = None
+    schema = None
+
+    for f in files:
+        name = Path(f).name
+        agg = None
+        with BioReader(f) as br:
+            for x, y, tile in iter_tiles(br, tile_size):
+                mask = np.ones(tile.shape, dtype=np.uint32)
+                df = nyx.featurize(tile, mask, intensity_names=[name], label_names=[name])
+                if aggregate:
+                    columns = [c for c in df.columns if c not in ID_COLUMNS]
+                    if agg is None:
+                        agg = TileAggregate(columns)
+                    agg.add(df[columns].to_numpy(dtype=float)[0])
+                    continue
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                for column, value in zip(TILE_COLUMNS, (x, y, tile.shape[1], tile.shape[0])):
+                    table = table.append_column(column, pa.array([value] * table.num_rows, pa.int64()))
+                if writer is None:
+                    schema = table.schema
+                    writer = pa.ipc.new_file(str(tmp), schema)
+                writer.write_table(table.cast(schema))
+
+        if agg is not None:
+            table = agg.table(name)
+            if writer is None:
+                schema = table.schema
+                writer = pa.ipc.new_file(str(tmp), schema)
+            writer.write_table(table.cast(schema))
+
+    if writer is not None:
+        writer.close()
+        os.replace(tmp, out_path)
+    return out_path
+
+
+def featurize_directory_tiled(nyx, intensity_dir, file_pattern:str, out_dir, memory_mb:float, aggregate:bool=False) -> Path:
+    """ Tiled counterpart of featurize_directory writing NyxusFeatures.arrow
+    """
+    files = sorted(str(f[1][0]) for f in fp.FilePattern(intensity_dir, file_pattern)())
+    if not files:
+        raise FileNotFoundError(f"No images matching {file_pattern} in {intensity_dir}")
+    with BioReader(files[0]) as br:
+        itemsize = np.dtype(br.dtype).itemsize
+    tile_size = tile_size_for(memory_mb, itemsize)
+    logger.info(f"Featurizing {len(files)} images of {intensity_dir} in {tile_size} pixel tiles")
+    return featurize_tiled(nyx, files, Path(out_dir, "NyxusFeatures.arrow"), tile_size, aggregate)
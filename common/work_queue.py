@@ -0,0 +1,402 @@
+from pathlib import Path
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shlex
+import socket
+import logging
+import threading
+from typing import Optional
+from collections import defaultdict
+import typer
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from common.executor import Job, run_job
+
+
+app = typer.Typer()
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Work queue")
+logger.setLevel(logging.INFO)
+
+LEASE_SECONDS = 600
+MAX_ATTEMPTS = 3
+# Leases with less than this fraction of their length left may be raced by reclaimers
+RENEW_MARGIN = 0.25
+
+
+class WorkQueue:
+    """ Work units on a shared filesystem, claimed with expiring leases
+
+    Layout of the queue directory:
+        units/<id>.json     command of each unit, written by plan
+        leases/<id>.json    current claim: node, worker, expiry
+        attempts/<id>       number of claims so far
+        done/<id>.json      node, duration and exit code of finished units
+        failed/<id>.json    units that failed MAX_ATTEMPTS times
+        logs/<id>.log       output of the unit's command
+
+    A lease is taken by creating its file with O_EXCL, which is atomic on
+    local filesystems and NFSv3 and later, so no broker is needed. Only
+    expired leases are taken over: the reclaimer renames the lease to a
+    private name, which only one worker can do, and checks that the moved
+    file is the lease it read; a lease moved by mistake is linked back,
+    which never overwrites a newer one. Holders push the expiry forward in
+    place while the unit runs, as nobody else touches a valid lease, and
+    stop the unit's command, without recording it, once the lease is lost.
+    """
+
+    def __init__(self, root, lease_seconds:float=LEASE_SECONDS, max_attempts:int=MAX_ATTEMPTS):
+        self.root = Path(root)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        for name in ("units", "leases", "attempts", "done", "failed", "logs"):
+            Path(self.root, name).mkdir(parents=True, exist_ok=True)
+
+    def _path(self, kind:str, unit_id:str, suffix:str=".json") -> Path:
+        return Path(self.root, kind, f"{unit_id}{suffix}")
+
+    @staticmethod
+    def _read(path:Path) -> Optional[dict]:
+        try:
+            with open(path, "r") as fh:
+                return json.load(fh)
+        except (FileNotFoundError, ValueError):
+            # Missing, or caught between create and write
+            return None
+
+    @staticmethod
+    def _write(path:Path, data:dict) -> None:
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        with open(tmp, "w") as fh:
+            json.dump(data, fh)
+        os.replace(tmp, path)
+
+    def add(self, unit_id:str, command:list) -> bool:
+        """ Add a unit unless it is already planned
+        """
+        path = self._path("units", unit_id)
+        if path.exists():
+            return False
+        self._write(path, {"id": unit_id, "command": command})
+        return True
+
+    def units(self) -> list:
+        return sorted(p.stem for p in Path(self.root, "units").glob("*.json"))
+
+    def finished(self, unit_id:str) -> bool:
+        return self._path("done", unit_id).exists() or self._path("failed", unit_id).exists()
+
+    @staticmethod
+    def _restore(moved:Path, lease_path:Path) -> bool:
+        """ Put a moved lease back, False when a new lease was created meanwhile
+        """
+        try:
+            os.link(moved, lease_path)
+            restored = True
+        except FileExistsError:
+            # Its holder finds the lease gone at the next heartbeat
+            restored = False
+        moved.unlink(missing_ok=True)
+        return restored
+
+    def _take(self, lease_path:Path, kind:str, inode:int, lease:Optional[dict]) -> Optional[Path]:
+        """ Move the lease file away if it is still the one read, returns its new path
+        """
+        moved = lease_path.with_name(f".{kind}.{lease_path.stem}.{uuid.uuid4().hex}")
+        try:
+            os.rename(lease_path, moved)
+        except FileNotFoundError:
+            return None
+        # Another worker may have replaced the lease between the read and the rename
+        if os.stat(moved).st_ino != inode or self._read(moved) != lease:
+            self._restore(moved, lease_path)
+            return None
+        return moved
+
+    def claim(self, unit_id:str, worker:str) -> Optional[dict]:
+        """ Lease a unit for worker, None when it is held by someone else
+        """
+        lease_path = self._path("leases", unit_id)
+        try:
+            stat = os.stat(lease_path)
+        except FileNotFoundError:
+            stat = None
+        if stat is not None:
+            lease = self._read(lease_path)
+            if lease is None:
+                # Empty: being written, or its holder died between creating and writing it
+                if stat.st_mtime + self.lease_seconds >= time.time():
+                    return None
+            elif lease["expires"] >= time.time():
+                return None
+            # Reclaim: of all workers moving the expired lease only one gets the file it read
+            moved = self._take(lease_path, "expired", stat.st_ino, lease)
+            if moved is None:
+                return None
+            moved.unlink()
+            logger.warning(f"Reclaimed {unit_id} from {lease['worker'] if lease else 'unknown'}")
+
+        token = uuid.uuid4().hex
+        lease = {
+            "unit": unit_id,
+            "worker": worker,
+            "node": socket.gethostname(),
+            "token": token,
+            "claimed": time.time(),
+            "expires": time.time() + self.lease_seconds,
+        }
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, "w") as fh:
+            json.dump(lease, fh)
+
+        if self.finished(unit_id):
+            # Finished between the listing and the claim
+            self.release(lease)
+            return None
+        return lease
+
+    def _hold(self, lease:dict, kind:str) -> Optional[Path]:
+        """ Move worker's own lease to a private name, None when it is not held anymore
+        """
+        lease_path = self._path("leases", lease["unit"])
+        try:
+            stat = os.stat(lease_path)
+        except FileNotFoundError:
+            return None
+        current = self._read(lease_path)
+        if current is None or current.get("token") != lease["token"]:
+            return None
+        return self._take(lease_path, kind, stat.st_ino, current)
+
+    def heartbeat(self, lease:dict) -> bool:
+        """ Extend a lease, False when it has been reclaimed by another worker
+
+        A lease well within its expiry is rewritten in place once its token
+        is checked, so the file never disappears and claims keep seeing it.
+        One close to or past expiry may be raced by a reclaimer and is only
+        rewritten once moved away as the holder's own, then linked back
+        unless a reclaimer has created a new one meanwhile.
+        """
+        lease_path = self._path("leases", lease["unit"])
+        current = self._read(lease_path)
+        if current is None or current.get("token") != lease["token"]:
+            return False
+        if current["expires"] - time.time() > self.lease_seconds * RENEW_MARGIN:
+            lease["expires"] = time.time() + self.lease_seconds
+            self._write(lease_path, lease)
+            return True
+
+        held = self._hold(lease, "renew")
+        if held is None:
+            return False
+        lease["expires"] = time.time() + self.lease_seconds
+        self._write(held, lease)
+        return self._restore(held, self._path("leases", lease["unit"]))
+
+    def release(self, lease:dict) -> None:
+        held = self._hold(lease, "release")
+        if held is not None:
+            held.unlink()
+
+    def next_attempt(self, unit_id:str) -> int:
+        """ Count a new attempt at a unit, only called by the lease holder
+        """
+        path = self._path("attempts", unit_id, "")
+        attempt = int(path.read_text()) + 1 if path.exists() else 1
+        path.write_text(str(attempt))
+        return attempt
+
+    def pending(self) -> list:
+        return [u for u in self.units() if not self.finished(u)]
+
+    def run_unit(self, lease:dict, worker:str) -> Optional[int]:
+        """ Run a leased unit with heartbeats and record the outcome
+
+        A unit whose lease is lost is stopped and not recorded, the worker
+        holding the lease now runs it; returns None then.
+        """
+        unit_id = lease["unit"]
+        attempt = self.next_attempt(unit_id)
+        if attempt > self.max_attempts:
+            self._write(self._path("failed", unit_id), {"worker": worker, "node": lease["node"], "attempts": attempt - 1})
+            self.release(lease)
+            return None
+
+        unit = self._read(self._path("units", unit_id))
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease_seconds / 3):
+                if not self.heartbeat(lease):
+                    logger.warning(f"Lease of {unit_id} was taken over by another worker, stopping it")
+                    lost.set()
+                    return
+
+        heart = threading.Thread(target=beat, daemon=True)
+        heart.start()
+        starttime = time.time()
+        try:
+            job = Job(name=unit_id, command=unit["command"], log_path=self._path("logs", unit_id, ".log"), cancel=lost)
+            result = run_job(job)
+        finally:
+            stop.set()
+            heart.join()
+
+        # The lease is checked, and extended, right before the outcome is recorded
+        if lost.is_set() or not self.heartbeat(lease):
+            logger.warning(f"{worker} lost the lease of {unit_id}, its outcome is not recorded")
+            return None
+
+        record = {
+            "worker": worker,
+            "node": lease["node"],
+            "started": starttime,
+            "finished": time.time(),
+            "returncode": result.returncode,
+            "attempt": attempt,
+            "peak_rss_mb": result.peak_rss_mb,
+        }
+        if result.ok:
+            self._write(self._path("done", unit_id), record)
+        elif attempt >= self.max_attempts:
+            self._write(self._path("failed", unit_id), record)
+        self.release(lease)
+        return result.returncode
+
+    def work(self, worker:Optional[str]=None, max_units:Optional[int]=None) -> int:
+        """ Claim and run units until none is left, returns the number run
+        """
+        worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+        count = 0
+        while max_units is None or count < max_units:
+            pending = self.pending()
+            if not pending:
+                break
+            # Different orders per worker keep them from racing for the same unit
+            random.shuffle(pending)
+            lease = None
+            for unit_id in pending:
+                lease = self.claim(unit_id, worker)
+                if lease is not None:
+                    break
+            if lease is None:
+                # Everything left is leased; wait for leases to finish or expire
+                time.sleep(min(self.lease_seconds / 3, 30))
+                continue
+            logger.info(f"{worker} running {lease['unit']}")
+            self.run_unit(lease, worker)
+            count += 1
+        return count
+
+    def status(self) -> dict:
+        """ Unit counts and, per node, finished units and throughput
+        """
+        units = self.units()
+        done = {u: self._read(self._path("done", u)) for u in units if self._path("done", u).exists()}
+        failed = [u for u in units if self._path("failed", u).exists()]
+        leases = [self._read(p) for p in Path(self.root, "leases").glob("*.json")]
+        leases = [l for l in leases if l is not None]
+        now = time.time()
+
+        nodes = defaultdict(lambda: {"done": 0, "busy_seconds": 0.0, "first": now, "last": 0.0, "running": 0})
+        for record in done.values():
+            if record is None:
+                continue
+            node = nodes[record["node"]]
+            node["done"] += 1
+            node["busy_seconds"] += record["finished"] - record["started"]
+            node["first"] = min(node["first"], record["started"])
+            node["last"] = max(node["last"], record["finished"])
+        for lease in leases:
+            if lease["expires"] >= now:
+                nodes[lease["node"]]["running"] += 1
+
+        for node in nodes.values():
+            hours = max(node["last"] - node["first"], 1) / 3600
+            node["units_per_hour"] = node["done"] / hours if node["done"] else 0.0
+
+        return {
+            "units": len(units),
+            "done": len(done),
+            "failed": len(failed),
+            "running": sum(1 for l in leases if l["expires"] >= now),
+            "expired": sum(1 for l in leases if l["expires"] < now),
+            "nodes": dict(nodes),
+        }
+
+
+@app.command()
+def plan(
+    queue: Path = typer.Option(..., "--queue", help="Queue directory on the shared filesystem", resolve_path=True),
+    inp_dir: Path = typer.Option(
+        ...,
+        "--inpDir",
+        help="Directory holding the folders to process",
+        exists=True,
+        resolve_path=True,
+        file_okay=False,
+        dir_okay=True,
+    ),
+    out_dir: Path = typer.Option(..., "--outDir", help="Output root, mirrors the layout of inpDir", resolve_path=True),
+    pattern: str = typer.Option("Plate*", "--pattern", help="Glob of the folders below inpDir"),
+    command: str = typer.Option(
+        ...,
+        "--command",
+        help="Command run per folder, {inp}, {out} and {name} are substituted",
+    ),
+    ):
+    """ Enumerate folders into work units, skipping units already planned
+    """
+    q = WorkQueue(queue)
+    added = 0
+    folders = sorted(p for p in inp_dir.rglob(pattern) if p.is_dir())
+    for folder in folders:
+        relative = folder.relative_to(inp_dir)
+        unit_id = "__".join(relative.parts)
+        out = Path(out_dir, relative)
+        args = [a.format(inp=folder, out=out, name=unit_id) for a in shlex.split(command)]
+        added += q.add(unit_id, args)
+    logger.info(f"Planned {added} new units, {len(folders)} folders matching {pattern}")
+
+
+@app.command()
+def worker(
+    queue: Path = typer.Option(..., "--queue", help="Queue directory on the shared filesystem", resolve_path=True),
+    lease_seconds: float = typer.Option(LEASE_SECONDS, "--leaseSeconds", help="Lease length, renewed every third"),
+    max_attempts: int = typer.Option(MAX_ATTEMPTS, "--maxAttempts", help="Attempts before a unit is marked failed"),
+    max_units: int = typer.Option(None, "--maxUnits", help="Stop after this many units"),
+    ):
+    """ Claim and run units until the queue is drained
+    """
+    q = WorkQueue(queue, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    count = q.work(max_units=max_units)
+    logger.info(f"Worker finished after {count} units")
+
+
+@app.command()
+def status(
+    queue: Path = typer.Option(..., "--queue", help="Queue directory on the shared filesystem", resolve_path=True),
+    ):
+    """ Print unit counts and throughput per node
+    """
+    s = WorkQueue(queue).status()
+    print(f"units {s['units']}  done {s['done']}  failed {s['failed']}  running {s['running']}  expired leases {s['expired']}")
+    for name, node in sorted(s["nodes"].items()):
+        print(f"{name:30s} done {node['done']:6d}  running {node['running']:3d}  {node['units_per_hour']:8.1f} units/h")
+
+
+if __name__ == '__main__':
+    app()
@@ -0,0 +1,93 @@
+from pathlib import Path
+import sys
+import time
+import threading
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from common import executor
+from common.executor import Job, container_command, run_job, run_jobs
+
+# Stand-in for singularity: "run --bind <bind> <image> <args>", the image picks the behaviour
+FAKE_CONTAINER = f"""#!/bin/sh
+shift 3
+image=$1
+shift
+case "$image" in
+    ok) echo "ran $@" ;;
+    fail) echo "failing" >&2; exit 3 ;;
+    sleep) sleep 30 ;;
+    hog) exec {sys.executable} -c "import time; block = bytearray(300 * 1024 ** 2); time.sleep(30)" ;;
+esac
+"""
+
+
+@pytest.fixture
+def container(tmp_path, monkeypatch):
+    script = Path(tmp_path, "singularity")
+    script.write_text(FAKE_CONTAINER)
+    script.chmod(0o755)
+    monkeypatch.setattr(executor, "SINGULARITY", str(script))
+    return script
+
+
+def job(tmp_path, image, **kwargs):
+    return Job(name=image, command=container_command(image, ["--inpDir=x"]), log_path=Path(tmp_path, f"{image}.log"), **kwargs)
+
+
+def test_success_is_logged(container, tmp_path):
+    result = run_job(job(tmp_path, "ok"))
+    assert result.ok and result.attempts == 1
+    assert "ran --inpDir=x" in result.log_path.read_text()
+
+
+def test_nonzero_exit_is_retried(container, tmp_path):
+    result = run_job(job(tmp_path, "fail", retries=2, backoff=0))
+    assert result.returncode == 3
+    assert result.attempts == 2
+    assert [code for code, _ in result.history] == [3, 3]
+    assert result.log_path.read_text().count("failing") == 2
+
+
+def test_timeout_kills_the_container(container, tmp_path):
+    starttime = time.time()
+    result = run_job(job(tmp_path, "sleep", timeout=0.5))
+    assert result.timed_out and not result.ok
+    assert time.time() - starttime < 10
+
+
+def test_memory_limit_kills_without_retry(container, tmp_path):
+    result = run_job(job(tmp_path, "hog", max_memory_mb=100, retries=3, backoff=0))
+    assert result.memory_exceeded and not result.ok
+    assert result.attempts == 1
+    assert result.peak_rss_mb > 100
+
+
+def test_cancel_stops_the_container(container, tmp_path):
+    cancel = threading.Event()
+    threading.Timer(0.3, cancel.set).start()
+    result = run_job(job(tmp_path, "sleep", cancel=cancel, retries=3, backoff=0))
+    assert result.cancelled and result.attempts == 1
+
+
+def test_missing_container_binary_fails_the_job(tmp_path, monkeypatch):
+    monkeypatch.setattr(executor, "SINGULARITY", str(Path(tmp_path, "missing")))
+    results = run_jobs([job(tmp_path, "ok", backoff=0), job(tmp_path, "fail", backoff=0)], slots=2)
+    assert [r.name for r in results] == ["ok", "fail"]
+    assert all(r.returncode is None and not r.ok for r in results)
+    assert "could not start" in results[0].log_path.read_text()
+
+
+def test_start_failure_is_not_retried(tmp_path, monkeypatch):
+    monkeypatch.setattr(executor, "SINGULARITY", str(Path(tmp_path, "missing")))
+    starttime = time.time()
+    result = run_job(job(tmp_path, "ok", retries=3))
+    assert result.start_failed and result.attempts == 1
+    assert result.history == [(None, result.history[0][1])]
+    assert time.time() - starttime < 10
+
+
+def test_run_jobs_keeps_job_order(container, tmp_path):
+    results = run_jobs([job(tmp_path, "fail", backoff=0), job(tmp_path, "ok")], slots=2)
+    assert [(r.name, r.returncode) for r in results] == [("fail", 3), ("ok", 0)]
@@ -0,0 +1,145 @@
+from pathlib import Path
+import sys
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parents[1].joinpath("RxRx", "rxrx3")))
+
+import rxrx3_download as dl
+
+SIZE = 1024 * 1024 + 123
+CONTENT = np.random.default_rng(0).integers(0, 256, SIZE, dtype=np.uint8).tobytes()
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """ Serves CONTENT with byte ranges, recording the Range header of every GET
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def _headers(self, status, length, start=None, end=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if start is not None:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{SIZE}")
+        self.end_headers()
+
+    def do_HEAD(self):
+        if self.server.head_fails:
+            self._headers(404, 0)
+            return
+        self._headers(200, SIZE)
+
+    def do_GET(self):
+        header = self.headers.get("Range")
+        self.server.requests.append(header)
+        if header is None or not self.server.ranges:
+            self._headers(200, SIZE)
+            self.wfile.write(CONTENT)
+            return
+        start, _, end = header.removeprefix("bytes=").partition("-")
+        start, end = int(start), int(end) if end else SIZE - 1
+        if start >= SIZE:
+            self._headers(416, 0)
+            return
+        self._headers(206, end - start + 1, start, end)
+        self.wfile.write(CONTENT[start:end + 1])
+
+
+@pytest.fixture(params=[True, False], ids=["ranges", "no-ranges"])
+def server(request):
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    httpd.ranges = request.param
+    httpd.requests = []
+    httpd.head_fails = False
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def manifest_for(server, root):
+    url = f"http://127.0.0.1:{server.server_port}/plate.tar"
+    return dl.build_manifest(f'<a href="{url}">plate.tar 1 MB</a>', root)
+
+
+def test_resume_from_partial_file(server, tmp_path):
+    manifest = manifest_for(server, tmp_path)
+    Path(tmp_path, "plate.tar").write_bytes(CONTENT[:300000])
+
+    dl.download_content(manifest.entries["plate.tar"], tmp_path, manifest, split_size=SIZE + 1)
+
+    assert Path(tmp_path, "plate.tar").read_bytes() == CONTENT
+    assert manifest.entries["plate.tar"]["state"] == dl.DONE
+    # A server ignoring the range sends the whole file, which replaces the partial one
+    assert server.requests == ["bytes=300000-"]
+
+
+def test_split_parts_assemble(server, tmp_path):
+    manifest = manifest_for(server, tmp_path)
+
+    dl.download_content(manifest.entries["plate.tar"], tmp_path, manifest, split_size=1024)
+
+    assert Path(tmp_path, "plate.tar").read_bytes() == CONTENT
+    saved = json.loads(Path(tmp_path, dl.MANIFEST_NAME).read_text())["plate.tar"]
+    assert saved["state"] == dl.DONE
+    if server.ranges:
+        assert len(server.requests) == dl.NUM_PARTS
+        assert all(done for _, _, done in saved["parts"])
+        assert sum(end - start + 1 for start, end, _ in saved["parts"]) == SIZE
+
+
+def interrupted_split(server, root):
+    """ Manifest and file of a split download stopped after its first three parts
+    """
+    manifest = manifest_for(server, root)
+    step = -(-SIZE // dl.NUM_PARTS)
+    parts = [[start, min(start + step, SIZE) - 1, start < 3 * step] for start in range(0, SIZE, step)]
+    manifest.update("plate.tar", size=SIZE, parts=parts, state=dl.PARTIAL)
+    # Ranges recorded as done are on disk, the rest is the preallocated hole
+    Path(root, "plate.tar").write_bytes(CONTENT[:3 * step] + bytes(SIZE - 3 * step))
+    return manifest, parts
+
+
+def test_split_resumes_missing_parts(server, tmp_path):
+    if not server.ranges:
+        pytest.skip("split downloads need byte ranges")
+    manifest, parts = interrupted_split(server, tmp_path)
+
+    dl.download_content(manifest.entries["plate.tar"], tmp_path, manifest, split_size=1024)
+
+    assert Path(tmp_path, "plate.tar").read_bytes() == CONTENT
+    assert sorted(server.requests) == sorted(f"bytes={start}-{end}" for start, end, _ in parts[3:])
+
+
+def test_interrupted_split_never_completes_with_holes(server, tmp_path):
+    # Rerun with a split size above the file, and, without ranges, on the plain resume path
+    manifest, parts = interrupted_split(server, tmp_path)
+
+    dl.download_content(manifest.entries["plate.tar"], tmp_path, manifest, split_size=SIZE + 1)
+
+    assert Path(tmp_path, "plate.tar").read_bytes() == CONTENT
+    assert manifest.entries["plate.tar"]["state"] == dl.DONE
+    if server.ranges:
+        assert sorted(server.requests) == sorted(f"bytes={start}-{end}" for start, end, _ in parts[3:])
+    else:
+        assert server.requests == [f"bytes={parts[3][0]}-"]
+
+
+def test_interrupted_split_with_unknown_size_fails(server, tmp_path):
+    manifest, _ = interrupted_split(server, tmp_path)
+    server.head_fails = True
+
+    with pytest.raises(IOError):
+        dl.download_content(manifest.entries["plate.tar"], tmp_path, manifest)
+
+    assert manifest.entries["plate.tar"]["state"] == dl.FAILED
+    assert not any(done for _, _, done in manifest.entries["plate.tar"]["parts"][3:])
+    assert server.requests == []
@@ -0,0 +1,147 @@
+from pathlib import Path
+import sys
+import json
+import time
+import threading
+import multiprocessing
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from common.work_queue import WorkQueue
+
+WORKERS = 8
+ROUNDS = 10
+
+
+def race_claim(root, unit_id, barrier, results):
+    q = WorkQueue(root)
+    barrier.wait()
+    lease = q.claim(unit_id, f"worker-{multiprocessing.current_process().pid}")
+    results.put(lease["token"] if lease is not None else None)
+
+
+def drain(root, lease_seconds):
+    WorkQueue(root, lease_seconds=lease_seconds).work()
+
+
+def expire(q, unit_id):
+    lease_path = q._path("leases", unit_id)
+    lease = json.loads(lease_path.read_text())
+    lease["expires"] = 0
+    q._write(lease_path, lease)
+
+
+def concurrent_claims(root, unit_id):
+    """ Tokens returned by WORKERS processes claiming unit_id at the same time
+    """
+    barrier = multiprocessing.Barrier(WORKERS)
+    results = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(target=race_claim, args=(root, unit_id, barrier, results))
+        for _ in range(WORKERS)
+    ]
+    for p in procs:
+        p.start()
+    tokens = [results.get(timeout=60) for _ in procs]
+    for p in procs:
+        p.join()
+    return [t for t in tokens if t is not None]
+
+
+def test_concurrent_claim_of_free_unit(tmp_path):
+    q = WorkQueue(tmp_path)
+    for i in range(ROUNDS):
+        q.add(f"unit{i}", ["true"])
+        winners = concurrent_claims(tmp_path, f"unit{i}")
+        assert len(winners) == 1
+        assert q._read(q._path("leases", f"unit{i}"))["token"] == winners[0]
+
+
+def test_concurrent_reclaim_of_expired_lease(tmp_path):
+    q = WorkQueue(tmp_path)
+    for i in range(ROUNDS):
+        q.add(f"unit{i}", ["true"])
+        q.claim(f"unit{i}", "dead")
+        expire(q, f"unit{i}")
+        winners = concurrent_claims(tmp_path, f"unit{i}")
+        assert len(winners) == 1
+        assert q._read(q._path("leases", f"unit{i}"))["token"] == winners[0]
+
+
+def test_lost_lease_is_not_renewed_or_released(tmp_path):
+    q = WorkQueue(tmp_path)
+    q.add("unit", ["true"])
+    old = q.claim("unit", "a")
+    expire(q, "unit")
+    new = q.claim("unit", "b")
+    assert new is not None
+
+    assert not q.heartbeat(old)
+    q.release(old)
+    assert q._read(q._path("leases", "unit"))["token"] == new["token"]
+    assert q.heartbeat(new)
+
+
+def test_lost_lease_stops_the_unit_unrecorded(tmp_path):
+    q = WorkQueue(tmp_path, lease_seconds=0.6)
+    q.add("unit", [sys.executable, "-c", "import time; time.sleep(30)"])
+    lease = q.claim("unit", "a")
+
+    def steal():
+        time.sleep(0.3)
+        expire(q, "unit")
+        q.claim("unit", "b")
+
+    thief = threading.Thread(target=steal)
+    thief.start()
+    starttime = time.time()
+    assert q.run_unit(lease, "a") is None
+    thief.join()
+    assert time.time() - starttime < 10
+    assert not q.finished("unit")
+    assert q._read(q._path("leases", "unit"))["worker"] == "b"
+
+
+def test_workers_run_each_unit_once(tmp_path):
+    q = WorkQueue(tmp_path)
+    out = Path(tmp_path, "out")
+    out.mkdir()
+    for i in range(20):
+        q.add(f"unit{i}", [sys.executable, "-c", f"open('{out}/unit{i}', 'a').write('x')"])
+    procs = [multiprocessing.Process(target=drain, args=(tmp_path, 30)) for _ in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    assert q.pending() == []
+    assert sorted(p.read_text() for p in out.iterdir()) == ["x"] * 20
+    assert list(Path(tmp_path, "leases").iterdir()) == []
+
+
+def beat(root, lease, count, results):
+    q = WorkQueue(root)
+    results.put(("beat", all(q.heartbeat(lease) for _ in range(count))))
+
+
+def claim_loop(root, unit_id, count, results):
+    q = WorkQueue(root)
+    results.put(("claim", sum(q.claim(unit_id, "thief") is not None for _ in range(count))))
+
+
+def test_heartbeat_races_no_claim(tmp_path):
+    q = WorkQueue(tmp_path)
+    q.add("unit", ["true"])
+    lease = q.claim("unit", "holder")
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=beat, args=(tmp_path, lease, 500, results))]
+    procs += [multiprocessing.Process(target=claim_loop, args=(tmp_path, "unit", 500, results)) for _ in range(WORKERS)]
+    for p in procs:
+        p.start()
+    outcomes = sorted(results.get(timeout=120) for _ in procs)
+    for p in procs:
+        p.join()
+
+    # The holder kept its lease through every renewal and no claim took the live unit
+    assert outcomes == [("beat", True)] + [("claim", 0)] * WORKERS
+    assert q._read(q._path("leases", "unit"))["token"] == lease["token"]
@@ -1,14 +1,21 @@
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from multiprocessing import cpu_count
 import filepattern as fp
 from tqdm import tqdm 
 import os
 from bfio import BioReader
 import numpy as np
-from multiprocessing import cpu_count
+import sys
 
 from nyxus import Nyxus
+from tissue_nyxus import featurize_store, featurize_files_batched
+from tissue_standard import DATASET
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from common.scheduler import nyxus_threads
+from common.intensity_stats import collect_stats, nyxus_range, stats_path
+from common.inventory import Inventory
 
 
 # def nyxfun(intensity_dir, file_pattern, outname, out_dir, minI, maxI):
@@ -21,7 +28,7 @@ def nyxfun(intensity_dir, file_pattern, outname, out_dir):
     nyx_params = {
         "neighbor_distance": 5,
         "pixels_per_micron": 1.0,
-        "n_feature_calc_threads": 28,
+        "n_feature_calc_threads": nyxus_threads(DATASET),
         # 'min_intensity' : minI,
         # 'max_intensity' : maxI
     }
@@ -37,12 +44,14 @@ def nyxfun(intensity_dir, file_pattern, outname, out_dir):
             
 
 
-numworkers = int(cpu_count() / 2)
 data_paths = ["val"]
 # data_paths = ["train", "val", "test"]
 # versions = ["v1.0", "v1.1"]
 versions = ["v1.1"]
 for v in versions:
+    # One walk per version, the splits' images are looked up in the listing.
+    # It is saved once every batch is written, so an interrupted run is redone.
+    inventory = Inventory(Path(f'/projects/PanMicroscopy/data/tissueNet/{v}/standard'), save=False)
     for d in data_paths:
         inp_dir=Path(f'/projects/PanMicroscopy/data/tissueNet/{v}/standard/{d}/intensity')
         out_dir = Path(f'/projects/PanMicroscopy/NyxusFeatures/tissueNet/{v}/standard/{d}')
@@ -50,25 +59,19 @@ for v in versions:
         if not out_dir.exists():
             out_dir.mkdir(exist_ok=True, parents=True)
 
+        store = Path(f'/projects/PanMicroscopy/data/tissueNet/{v}/standard/{d}.zarr')
+        if store.exists():
+            featurize_store(store, out_dir)
+            continue
 
-        fps = fp.FilePattern(inp_dir, ".*.ome.tif")
-
-        filelist = [f[1][0] for f in fps()]
 
-        with ThreadPoolExecutor(max_workers=50) as executor:
-            threads = []
+        filelist = inventory.files(inp_dir, ".*.ome.tif")
 
-            for inp in filelist:
-                outname = Path(inp).name.split('.')[0] + ".arrow"
-                threads.append(executor.submit(nyxfun(intensity_dir=inp_dir, 
-                file_pattern=Path(inp).name, 
-                out_dir=out_dir,
-                outname=outname)))
+        # Range of the split from one parallel read, instead of a BioReader pass per image
+        stats = collect_stats(filelist, stats_path(inp_dir))
+        featurize_files_batched(filelist, out_dir, params=nyxus_range(stats))
 
-            for f in tqdm(
-                    as_completed(threads), desc=f"Processing version:{v} directory: {d}, filename: {inp}", total=len(threads)
-                ):
-                f.result()
+    inventory.save()
 
 
         #     nyxfun(intensity_dir=inp_dir, 
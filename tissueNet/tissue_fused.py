@@ -0,0 +1,180 @@
+from pathlib import Path
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pyarrow as pa
+import os
+import time
+import logging
+import typer
+from tqdm import tqdm
+from nyxus import Nyxus
+from tissue_standard import (
+    prepare_split,
+    load_staged,
+    example_channels,
+    example_filename,
+    write_examples,
+    TISSUE_NAMES,
+    PLATFORM_NAMES,
+    DATASET,
+)
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from common.scheduler import nyxus_threads
+from common.feature_cache import open_cache, featurize_cached, report
+
+app = typer.Typer()
+
+# Initialize the logger
+logging.basicConfig(
+    format="%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+)
+logger = logging.getLogger("Fused tissueNet features")
+logger.setLevel(os.environ.get("POLUS_LOG", logging.INFO))
+
+# Examples featurized per Nyxus call
+BATCH_SIZE = 256
+
+
+def metadata_columns(split, start, stop, channels):
+    """ tissue, platform, channel, version and split (train, val or test) columns for examples start..stop
+    """
+    tissue_names = TISSUE_NAMES[split["version"]]
+    examples = [ex for ex in range(start, stop) for _ in range(channels)]
+    columns = {
+        "tissue": [tissue_names[split["tissue"][ex]] for ex in examples],
+        "platform": [
+            PLATFORM_NAMES[split["platform"][ex]] if split["platform"] is not None else None
+            for ex in examples
+        ],
+        "channel": [str(ch) for _ in range(start, stop) for ch in range(channels)],
+        "version": [split["version"]] * len(examples),
+        "split": [split["name"]] * len(examples),
+    }
+    return {key: pa.array(value, type=pa.string()) for key, value in columns.items()}
+
+
+def featurize_split(npzfilepath, version, out_dir, batch_size=BATCH_SIZE, write_images=False,
+                    image_dir=None, normalize=False, cache_dir=None, n_threads=None):
+    """ Featurize a TissueNet split straight from the npz arrays
+
+    Examples are sliced from the memory-mapped cache and handed to Nyxus in
+    batches, metadata columns are attached to every batch and the batches
+    are appended to one arrow file. With write_images the images are also
+    saved in the file layout, on a background thread.
+    """
+    split = prepare_split(npzfilepath, version, image_dir or out_dir, cache_dir, makedirs=write_images)
+    data = load_staged(npzfilepath, cache_dir)
+    X, y = data["X"], data["y"]
+    num_examples = split["num_examples"]
+    do_normalize = normalize and split["version"] == "v1.1"
+
+    out_path = Path(out_dir, split["version"], "standard", split["name"])
+    out_path.mkdir(exist_ok=True, parents=True)
+    arrowpath = Path(out_path, "NyxusFeatures.arrow")
+    tmppath = arrowpath.with_suffix(".arrow.tmp")
+
+    features = ["*ALL*"]
+    nyx_params = {"neighbor_distance": 5, "pixels_per_micron": 1.0}
+    nyx = Nyxus(features)
+    nyx.set_params(**nyx_params, n_feature_calc_threads=n_threads or nyxus_threads(DATASET))
+    cache = open_cache(features, nyx_params)
+
+    writer = None
+    pending = []
+    with ThreadPoolExecutor(max_workers=1) as image_writer:
+        for start in tqdm(range(0, num_examples, batch_size), desc=f"Featurizing {split['name']}", unit="batches"):
+            stop = min(start + batch_size, num_examples)
+            if write_images:
+                pending.append(image_writer.submit(
+                    write_examples, split, start, stop, normalize=normalize, cacheDir=cache_dir
+                ))
+
+            images = [image for ex in range(start, stop) for _, image, _ in example_channels(X, y, ex, do_normalize)]
+            names = [example_filename(split, ex, ch, "") for ex in range(start, stop) for ch in range(X.shape[-1])]
+            # The file layout featurizes without labels: the whole image is one ROI
+            table = featurize_cached(nyx, images, names, cache)
+            for key, column in metadata_columns(split, start, stop, X.shape[-1]).items():
+                table = table.append_column(key, column)
+
+            if writer is None:
+                schema = table.schema
+                writer = pa.ipc.new_file(str(tmppath), schema)
+            writer.write_table(table.cast(schema))
+
+        for f in pending:
+            f.result()
+
+    if writer is not None:
+        writer.close()
+        os.replace(tmppath, arrowpath)
+    if cache is not None:
+        report(cache.stats(), split["name"])
+    return arrowpath
+
+
+@app.command()
+def main(
+    inp_dir: Path = typer.Option(
+        ...,
+        "--inpDir",
+        help="Directory containing the TissueNet npz files",
+        exists=True,
+        resolve_path=True,
+        readable=True,
+        file_okay=False,
+        dir_okay=True,
+    ),
+    version: str = typer.Option(
+        ...,
+        "--version",
+        help="TissueNet version, v1.0 or v1.1",
+    ),
+    out_dir: Path = typer.Option(
+        ...,
+        "--outDir",
+        help="Output collection",
+        exists=True,
+        resolve_path=True,
+        writable=True,
+        file_okay=False,
+        dir_okay=True,
+    ),
+    batch_size: int = typer.Option(
+        BATCH_SIZE,
+        "--batchSize",
+        help="Examples featurized per Nyxus call",
+    ),
+    image_dir: Path = typer.Option(
+        None,
+        "--imageDir",
+        help="Also write the images in the file layout under this directory",
+        resolve_path=True,
+        file_okay=False,
+        dir_okay=True,
+    ),
+    normalize: bool = typer.Option(
+        False,
+        "--normalize",
+        help="Min-max normalise v1.1 intensity images",
+    ),
+    ):
+
+    starttime = time.time()
+
+    for npzfilepath in sorted(inp_dir.rglob(f"*_{version}_*.npz")):
+        arrowpath = featurize_split(
+            npzfilepath, version, out_dir, batch_size=batch_size,
+            write_images=image_dir is not None, image_dir=image_dir, normalize=normalize,
+        )
+        logger.info(f"Features of {npzfilepath.name} written to {arrowpath}")
+
+    finishtime = (time.time() - starttime) / 60
+    logger.info(f'total time taken in minutes {finishtime}')
+
+
+if __name__ == '__main__':
+    app()
@@ -1,15 +1,26 @@
 
 from pathlib import Path
-from multiprocessing import cpu_count
+import sys
+import numpy as np
 import filepattern as fp
 from tqdm import tqdm 
 import os
+import hashlib
 from nyxus import Nyxus
 import time
 import logging
-import preadator
 import typer
-from concurrent.futures import as_completed
+import pyarrow as pa
+from bfio import BioReader
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tissue_standard import read_store, example_filename, DATASET
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from common.scheduler import Schedule, plan, nyxus_threads, lpt_order
+from common.feature_cache import open_cache, featurize_cached, report
+from common.image_index import ImageIndex, header_cost
+from common.intensity_stats import collect_stats, nyxus_range, stats_path
 
 app = typer.Typer()
 
@@ -21,7 +32,12 @@ logging.basicConfig(
 logger = logging.getLogger("Recursion dataset")
 logger.setLevel(os.environ.get("POLUS_LOG", logging.INFO))
 
-NUM_THREADS = max(cpu_count() // 2, 2)
+# Examples featurized per Nyxus call when reading a zarr container
+STORE_BATCH = 256
+# Images featurized per Nyxus call by the batched engine
+IMAGE_BATCH = 512
+FEATURES = ["*ALL*"]
+NYX_PARAMS = {"neighbor_distance": 5, "pixels_per_micron": 1.0}
 
 def split_path_at_string(path, target):
     parts = path.parts
@@ -41,7 +57,7 @@ def nyxfun(intensity_dir, file_pattern, out_dir):
     nyx_params = {
         "neighbor_distance": 5,
         "pixels_per_micron": 1.0,
-        "n_feature_calc_threads": 28,
+        "n_feature_calc_threads": nyxus_threads(DATASET),
     }
 
     nyx.set_params(**nyx_params)
@@ -54,18 +70,160 @@ def nyxfun(intensity_dir, file_pattern, out_dir):
                             output_path = str(out_dir))
                             
     
-def featextraction(intensity_dir, out_dir):
+def write_table(table, out_file):
+    """ Write an arrow file under a temporary name and rename it into place
+    """
+    tmp_file = out_file.with_suffix(".arrow.tmp")
+    with pa.OSFile(str(tmp_file), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_file, out_file)
+
+
+# One Nyxus instance and feature cache per worker process, created by _init_worker
+_nyx = None
+_cache = None
+
+
+def _init_worker(n_threads, params):
+    global _nyx, _cache
+    _nyx = Nyxus(FEATURES)
+    _nyx.set_params(**params, n_feature_calc_threads=n_threads)
+    _cache = open_cache(FEATURES, params)
+
+
+def batch_name(files):
+    """ Arrow file of a batch, named by a hash of its sorted files with their size and mtime
+    """
+    digest = hashlib.blake2b(digest_size=12)
+    for f in sorted(str(f) for f in files):
+        stat = os.stat(f)
+        digest.update(f"{f}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return f"NyxusFeatures_{digest.hexdigest()}.arrow"
+
+
+def featurize_batch(name, files, out_dir):
+    """ Featurize a batch of images with the worker's Nyxus instance
+
+    Images of equal shape are stacked and featurized in one call, the whole
+    image being a single ROI as with label_dir=None, and images already in
+    the feature cache are not featurized again. The batch is written to one
+    arrow file, renamed into place once complete. Returns the cache hits
+    and misses of the batch.
+    """
+    images = []
+    for f in files:
+        with BioReader(f) as br:
+            images.append(br[:].squeeze())
+
+    if _cache is not None:
+        _cache.hits = _cache.misses = 0
+    table = featurize_cached(_nyx, images, [Path(f).name for f in files], _cache)
+    write_table(table, Path(out_dir, name))
+    return _cache.stats() if _cache is not None else {"hits": 0, "misses": len(files)}
+
+
+def featurize_files_batched(files, out_dir, batch_size=IMAGE_BATCH, schedule:Schedule=None, params=None):
+    """ Featurize many images as batches spread over long-lived worker processes
+
+    Batches are cut from the sorted file list and named by batch_name, so a
+    rerun with the same files and batch size skips batches whose arrow file
+    already exists, and batch files of other file lists are removed. They are
+    submitted largest first by the pixel sizes of the image index. Without
+    a schedule the process and thread counts come from the autotuned
+    TissueNet profile, or are planned from the available CPUs and the image
+    sizes. params are added to NYX_PARAMS, e.g. the min_intensity and
+    max_intensity of the pre-flight statistics.
+    """
+    files = sorted(str(f) for f in files)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+
+    batches = [files[start:start + batch_size] for start in range(0, len(files), batch_size)]
+    names = [batch_name(batch) for batch in batches]
+    for stale in set(p.name for p in out_dir.glob("NyxusFeatures_*.arrow")) - set(names):
+        Path(out_dir, stale).unlink()
+        logger.info(f"Removed {stale}, its images changed")
+    batches = [(name, batch) for name, batch in zip(names, batches) if not Path(out_dir, name).exists()]
+    cost = header_cost(ImageIndex().headers(files))
+    batches = lpt_order(batches, cost=lambda batch: sum(cost(f) for f in batch[1]))
+    schedule = schedule or plan(files, dataset=DATASET, cost=cost)
+    logger.info(f"{len(batches)} batches on {schedule.processes} processes x {schedule.threads} threads")
+
+    stats = {"hits": 0, "misses": 0}
+    with ProcessPoolExecutor(max_workers=schedule.processes, initializer=_init_worker, initargs=(schedule.threads, {**NYX_PARAMS, **(params or {})})) as executor:
+        threads = [executor.submit(featurize_batch, name, batch, out_dir) for name, batch in batches]
+
+        for f in tqdm(
+            as_completed(threads),
+            total=len(threads),
+            mininterval=5,
+            desc=f"Extracting features {out_dir}",
+            initial=0,
+            unit_scale=True,
+            colour="cyan",
+        ):
+            for key, value in f.result().items():
+                stats[key] += value
+
+    report(stats, str(out_dir))
+
 
+def folder_files(intensity_dir):
     fps = fp.FilePattern(intensity_dir, ".*.ome.tif")
+    return [f[1][0] for f in fps()]
 
 
+def folder_out_dir(intensity_dir, out_dir):
     _, target = split_path_at_string(intensity_dir, "tissueNet")
+    return Path(out_dir, target)
 
-    out_dir = Path(out_dir, target)
+
+def folder_stats(intensity_dir):
+    """ Intensity statistics of a folder, kept for QC and normalisation
+    """
+    return collect_stats(folder_files(intensity_dir), stats_path(intensity_dir))
+
+
+def featextraction(intensity_dir, out_dir, params=None):
+
+    files = folder_files(intensity_dir)
+
+    out_dir = folder_out_dir(intensity_dir, out_dir)
     if not out_dir.exists():
         out_dir.mkdir(exist_ok=True, parents=True)
 
-    nyxfun(intensity_dir=intensity_dir, file_pattern=".*", out_dir=out_dir)
+    featurize_files_batched(files, out_dir, params=params)
+
+
+def featurize_store(storepath, out_dir, batch_size=STORE_BATCH, n_threads=None):
+    """ Featurize a split written with the zarr layout of tissue_standard.py
+
+    Images are read chunk by chunk and handed to Nyxus in memory; each batch
+    is written to its own arrow file. The intensity_image column holds the
+    name the image has in the file layout, e.g. y3_r12_c0. Examples already
+    in the feature cache are not featurized again.
+    """
+    intensity, _, split = read_store(storepath)
+    num_examples, channels, Y, X = intensity.shape
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+
+    nyx = Nyxus(FEATURES)
+    nyx.set_params(**NYX_PARAMS, n_feature_calc_threads=n_threads or nyxus_threads(DATASET))
+    cache = open_cache(FEATURES, NYX_PARAMS)
+
+    for start in range(0, num_examples, batch_size):
+        stop = min(start + batch_size, num_examples)
+        images = np.asarray(intensity[start:stop]).reshape(-1, Y, X)
+        names = [example_filename(split, ex, ch, "") for ex in range(start, stop) for ch in range(channels)]
+        # label_dir=None in the file layout: the whole image is one ROI
+        table = featurize_cached(nyx, list(images), names, cache)
+        write_table(table, Path(out_dir, f"NyxusFeatures_{start:06d}.arrow"))
+
+    if cache is not None:
+        report(cache.stats(), str(storepath))
 
 
 @app.command()
@@ -89,36 +247,51 @@ def main(
         writable=True,
         file_okay=False,
         dir_okay=True,
-    )
+    ),
+    intensity_range: str = typer.Option(
+        None,
+        "--intensityRange",
+        help="Set Nyxus min_intensity and max_intensity from a pre-flight statistics pass over each folder or the whole dataset",
+    ),
+    range_percentiles: str = typer.Option(
+        "0,100",
+        "--rangePercentiles",
+        help="Lower and upper percentile bounding the intensity range",
+    ),
     ):
 
     starttime = time.time()
 
+    if intensity_range not in (None, "folder", "dataset"):
+        raise typer.BadParameter("--intensityRange must be folder or dataset")
+    lower, upper = (float(q) for q in range_percentiles.split(","))
+
+    folders = {}
     for d in list(inp_dir.iterdir())[1:]:
+        folders[d] = [path for path in d.rglob('*') if path.is_dir() and "intensity"  in path.name and ".zarr" not in str(path)]
+
+    ranges = {}
+    if intensity_range is not None:
+        # One parallel read of every image, reused by later runs while the files are unchanged
+        tables = {f: folder_stats(f) for folderpath in folders.values() for f in folderpath}
+        if intensity_range == "dataset" and tables:
+            params = nyxus_range(pa.concat_tables(list(tables.values())), lower, upper)
+            ranges = {f: params for f in tables}
+        else:
+            ranges = {f: nyxus_range(table, lower, upper) for f, table in tables.items()}
+        for f, params in ranges.items():
+            logger.info(f"Intensity range of {f}: {params['min_intensity']} to {params['max_intensity']}")
+
+    for d, folderpath in folders.items():
+
+        # Splits written with the zarr layout are read directly
+        for store in d.rglob('*.zarr'):
+            _, target = split_path_at_string(store, "tissueNet")
+            featurize_store(store, Path(out_dir, target, store.stem))
 
-        folderpath = [path for path in d.rglob('*') if path.is_dir() and "intensity"  in path.name]
-
-        with preadator.ProcessManager(
-            name="Extracting nyxus features",
-            num_processes=NUM_THREADS,
-            threads_per_process=2,
-        ) as executor:
-            threads = []
-            for f in folderpath:
-                threads.append(
-                    executor.submit(featextraction, f, out_dir),
-                )
-
-            for f in tqdm(
-                as_completed(threads),
-                total=len(threads),
-                mininterval=5,
-                desc=f"Extracting features {f}",
-                initial=0,
-                unit_scale=True,
-                colour="cyan",
-            ):
-                f.result()
+        # Each folder is spread over the whole worker pool
+        for f in folderpath:
+            featextraction(f, out_dir, ranges.get(f))
 
         finishtime = (time.time() - starttime) / 60
         logger.info(f'total time taken in minutes {finishtime}')
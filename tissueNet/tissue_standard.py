@@ -4,11 +4,19 @@ from tqdm import tqdm
 import numpy as np
 import os
 import re
+import json
 import time
+import shutil
+import csv
+import zipfile
+import zarr
 from typing import Optional
 import multiprocessing
 from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+import threading
 import sys
 
 
@@ -17,6 +25,32 @@ FILE_EXT = os.environ.get("POLUS_EXT", ".ome.tif")
 
 DATASET = "TissueNet"
 
+# Examples per work unit handed to a pool worker
+SHARD_SIZE = int(os.environ.get("TISSUENET_SHARD_SIZE", 32))
+WRITER_THREADS = 4
+# Images sliced but not yet written, per worker
+WRITE_BEHIND = 16
+# Examples per chunk of the zarr layout, each chunk holds one channel
+CHUNK_EXAMPLES = 1
+
+# Decoded tissue and platform codes, named as in combine.py
+TISSUE_NAMES = {
+    "v1.0": {0: "breast", 1: "gi", 2: "immune", 3: "lung", 4: "pancreas", 5: "skin"},
+    "v1.1": {
+        0: "breast",
+        1: "colon",
+        2: "lymph node",
+        3: "lung",
+        4: "pancreas",
+        5: "epidermis",
+        6: "esophagus",
+        7: "spleen",
+        8: "tonsil",
+        9: "lymph node metastasis",
+    },
+}
+PLATFORM_NAMES = {0: "codex", 1: "cycif", 2: "imc", 3: "mibi", 4: "mxif", 5: "vectra"}
+
 
 def makedirectory(root: str, version: str) -> None:
     """Make directories for downloading raw and preprocessed data"""
@@ -30,6 +64,56 @@ def makedirectory(root: str, version: str) -> None:
     return
 
 
+def stage_npz(npzfilepath: os.path, cacheDir: Optional[os.path] = None) -> dict:
+    """Extract every member of an npz file once into an uncompressed .npy cache
+    Args:
+        npzfilepath (pathlib.Path): Path to the npz file
+        cacheDir (pathlib.Path): Cache root, defaults to a .npy_cache directory next to the npz file
+    Returns:
+        Dictionary mapping member name to its cached .npy path. The cache is
+        rebuilt when the size or mtime of the npz file changes.
+    """
+    npzfilepath = pathlib.Path(npzfilepath)
+    if cacheDir is None:
+        cacheDir = npzfilepath.parent.joinpath(".npy_cache")
+    cachepath = pathlib.Path(cacheDir, npzfilepath.stem)
+    stamppath = cachepath.joinpath("source.json")
+
+    stat = os.stat(npzfilepath)
+    source = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    with zipfile.ZipFile(npzfilepath) as zf:
+        members = [info.filename for info in zf.infolist() if info.filename.endswith(".npy")]
+
+        fresh = stamppath.exists() and json.loads(stamppath.read_text()) == source
+        if not fresh:
+            print("Staging: " + npzfilepath.name)
+            shutil.rmtree(cachepath, ignore_errors=True)
+            cachepath.mkdir(parents=True, exist_ok=True)
+            for member in members:
+                tmppath = cachepath.joinpath(member + ".tmp")
+                with zf.open(member) as src, open(tmppath, "wb") as dst:
+                    shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+                os.replace(tmppath, cachepath.joinpath(member))
+            stamppath.write_text(json.dumps(source))
+
+    return {pathlib.Path(member).stem: cachepath.joinpath(member) for member in members}
+
+
+def load_staged(npzfilepath: os.path, cacheDir: Optional[os.path] = None) -> dict:
+    """Open the staged members of an npz file
+    Numeric arrays are memory-mapped read-only so every worker shares them
+    through the page cache; object arrays (metadata) are small and loaded.
+    """
+    data = {}
+    for key, path in stage_npz(npzfilepath, cacheDir).items():
+        try:
+            data[key] = np.load(path, mmap_mode="r")
+        except ValueError:
+            data[key] = np.load(path, allow_pickle=True)
+    return data
+
+
 def save_omezarr(image: np.ndarray, out_file: pathlib.Path) -> None:
     """Writing images in omezarr format
     Args:
@@ -43,19 +127,23 @@ def save_omezarr(image: np.ndarray, out_file: pathlib.Path) -> None:
         bw[:] = image
 
 
-def parsing_tissuenet_data(
+def prepare_split(
     npzfilepath: os.path,
     version: str,
     outDir: os.path,
-    fileExtension: Optional[str] = ".ome.tif",
-    normalize: bool = False,
-):
-    """Parsing npz files into intensity and label images
+    cacheDir: Optional[os.path] = None,
+    makedirs: bool = True,
+) -> dict:
+    """Check an npz file, stage it and collect what workers need to write its examples
     Args:
-        npzfilepath (pathlib.Path): Directory path containing downloaded npz files
+        npzfilepath (pathlib.Path): Path to the npz file of one split
         version (str): Select either of the two supported TissueNet data versions (v1.0 and v1.1)
         outDir (pathlib.Path): Path to output directory
-        fileExtension (str): Type of data conversion. Default format is .ome.tif but can also generate '.ome.zarr' image files
+        cacheDir (pathlib.Path): Directory for the uncompressed .npy cache of the npz file
+        makedirs (bool): Create the intensity and label output directories
+    Returns:
+        Dictionary with the split name, version, output directories, number of
+        examples and per-example tissue and platform codes.
     """
     npzfilename = pathlib.Path(npzfilepath).name
     assert npzfilename.endswith("npz"), 'No file found with ".npz" file extension'
@@ -70,15 +158,13 @@ def parsing_tissuenet_data(
     outfile_label = pathlib.Path(outDir, name).joinpath("label")
     # Create standard subdirectory
 
-    FILE_EXT = FILE_EXT if fileExtension is None else fileExtension
-
-    if not os.path.exists(outfile_intensity):
+    if makedirs and not os.path.exists(outfile_intensity):
         outfile_intensity.mkdir(exist_ok=True, parents=True)
-    if not os.path.exists(outfile_label):
+    if makedirs and not os.path.exists(outfile_label):
         outfile_label.mkdir(exist_ok=True, parents=True)
     print("Loading: " + npzfilename)
 
-    data = np.load(npzfilepath, allow_pickle=True)
+    data = load_staged(npzfilepath, cacheDir)
     if vers == "v1.0":
         X, y, tissue_list, platform_list = (
             data["X"],
@@ -87,7 +173,6 @@ def parsing_tissuenet_data(
             data["platform_list"],
         )
         # sanity check
-        num_examples = len(tissue_list)
         assert len(tissue_list) == len(platform_list)
         assert X.shape[0] == y.shape[0]
         assert X.shape[0] == len(tissue_list)
@@ -109,36 +194,6 @@ def parsing_tissuenet_data(
         }
         tissuelist = [tissuemap[v] for v in tissue_list]
         platformlist = [platformmap[v] for v in platform_list]
-        for ex, tissue, platform in tqdm(
-            zip(range(num_examples + 1), tissuelist, platformlist),
-            desc="Extracting images",
-            unit="files",
-            total=len(tissue_list),
-        ):
-            image_ch0 = X[ex, :, :, 0].squeeze()
-            label_ch0 = y[ex, :, :, 1].squeeze()  
-            image_ch1 = X[ex, :, :, 1].squeeze() 
-            label_ch1 = y[ex, :, :, 0].squeeze()
-
-            file_outname_ch0 = "p{0}_y{1}_r{2}_c0{3}".format(
-                platform, tissue, ex, FILE_EXT
-            )
-            file_outname_ch1 = "p{0}_y{1}_r{2}_c1{3}".format(
-                platform, tissue, ex, FILE_EXT
-            )
-            
-            save_omezarr(
-                image_ch0, out_file=pathlib.Path(outfile_intensity, file_outname_ch0)
-            )
-            save_omezarr(
-                label_ch0, out_file=pathlib.Path(outfile_label, file_outname_ch0)
-            )
-            save_omezarr(
-                image_ch1, out_file=pathlib.Path(outfile_intensity, file_outname_ch1)
-            )
-            save_omezarr(
-                label_ch1, out_file=pathlib.Path(outfile_label, file_outname_ch1)
-            )
 
     elif vers == "v1.1":
         if name == "test":
@@ -148,7 +203,6 @@ def parsing_tissuenet_data(
 
         X, y, tissue_list = (data["X"], data["y"], meta)
         # sanity check
-        num_examples = len(tissue_list)
         assert len(tissue_list) == X.shape[0]
         assert X.shape[0] == y.shape[0]
 
@@ -166,47 +220,226 @@ def parsing_tissuenet_data(
         }
 
         tissuelist = [tissuemap[v] for v in tissue_list]
+        platformlist = None
+
+    return {
+        "npzfilepath": str(npzfilepath),
+        "name": name,
+        "version": vers,
+        "intensity": outfile_intensity,
+        "label": outfile_label,
+        "num_examples": len(tissuelist),
+        "tissue": tissuelist,
+        "platform": platformlist,
+    }
+
+
+def example_filename(split: dict, ex: int, channel: int, fileExtension: str) -> str:
+    """Output file name of one channel of one example, identical for any sharding"""
+    if split["version"] == "v1.0":
+        return "p{0}_y{1}_r{2}_c{3}{4}".format(
+            split["platform"][ex], split["tissue"][ex], ex, channel, fileExtension
+        )
+    return "y{0}_r{1}_c{2}{3}".format(split["tissue"][ex], ex, channel, fileExtension)
 
-        for ex, tissue in tqdm(
-            zip(range(num_examples + 1), tissuelist),
-            desc="Extracting images",
-            unit="files",
-            total=len(tissue_list),
-        ):
 
-            if normalize:
-                image_ch0 = X[ex, :, :, 0].squeeze()
-                image_ch0= (image_ch0 - np.min(image_ch0)) / (np.max(image_ch0) - np.min(image_ch0))
-                image_ch1 = X[ex, :, :, 1].squeeze()
-                image_ch1= (image_ch1 - np.min(image_ch1)) / (np.max(image_ch1) - np.min(image_ch1))
-            else:
-                image_ch0 = X[ex, :, :, 0].squeeze()
-                image_ch1 = X[ex, :, :, 1].squeeze()
-            
-            label_ch0 = y[ex, :, :, 1].squeeze()
-            label_ch1 = y[ex, :, :, 0].squeeze()
-
-            file_outname_ch0 = "y{0}_r{1}_c0{2}".format(tissue, ex, FILE_EXT)
-            file_outname_ch1 = "y{0}_r{1}_c1{2}".format(tissue, ex, FILE_EXT)
-            save_omezarr(
-                image_ch0, out_file=pathlib.Path(outfile_intensity, file_outname_ch0)
-            )
-            save_omezarr(
-                label_ch0, out_file=pathlib.Path(outfile_label, file_outname_ch0)
-            )
-            save_omezarr(
-                image_ch1, out_file=pathlib.Path(outfile_intensity, file_outname_ch1)
-            )
-            save_omezarr(
-                label_ch1, out_file=pathlib.Path(outfile_label, file_outname_ch1)
-            )
+def example_channels(X: np.ndarray, y: np.ndarray, ex: int, normalize: bool) -> list:
+    """Intensity and label image of both channels of one example
+    The label channels are stored in reverse order to the intensity channels.
+    """
+    channels = []
+    for ch in range(2):
+        image = np.ascontiguousarray(X[ex, :, :, ch].squeeze())
+        if normalize:
+            image = (image - np.min(image)) / (np.max(image) - np.min(image))
+        label = np.ascontiguousarray(y[ex, :, :, 1 - ch].squeeze())
+        channels.append((ch, image, label))
+    return channels
+
+
+def write_examples(
+    split: dict,
+    start: int,
+    stop: int,
+    fileExtension: Optional[str] = ".ome.tif",
+    normalize: bool = False,
+    cacheDir: Optional[os.path] = None,
+) -> int:
+    """Write examples start..stop of a split
+    Slices are read from the shared memory-mapped cache while a small pool of
+    writer threads saves the previous ones; at most WRITE_BEHIND images are
+    held in memory waiting to be written.
+    """
+    file_ext = FILE_EXT if fileExtension is None else fileExtension
+    data = load_staged(split["npzfilepath"], cacheDir)
+    X, y = data["X"], data["y"]
+    # Normalisation only ever applied to v1.1
+    normalize = normalize and split["version"] == "v1.1"
+
+    pending = threading.BoundedSemaphore(WRITE_BEHIND)
+    futures = []
+    with ThreadPoolExecutor(max_workers=WRITER_THREADS) as writer:
+        for ex in range(start, stop):
+            for ch, image, label in example_channels(X, y, ex, normalize):
+                file_outname = example_filename(split, ex, ch, file_ext)
+                for array, outdir in ((image, split["intensity"]), (label, split["label"])):
+                    pending.acquire()
+                    f = writer.submit(save_omezarr, array, out_file=pathlib.Path(outdir, file_outname))
+                    f.add_done_callback(lambda _: pending.release())
+                    futures.append(f)
+        for f in futures:
+            f.result()
+    return stop - start
+
+
+def create_store(split: dict, outDir: os.path, chunkExamples: int = CHUNK_EXAMPLES, cacheDir: Optional[os.path] = None) -> pathlib.Path:
+    """Create the zarr container holding a whole split
+    Args:
+        split (dict): Split description returned by prepare_split
+        outDir (pathlib.Path): Path to output directory
+        chunkExamples (int): Number of examples per chunk, every chunk holds a single channel
+        cacheDir (pathlib.Path): Directory for the uncompressed .npy cache of the npz file
+    Returns:
+        Path of the <split>.zarr store. It has an intensity and a label array
+        of shape (examples, channels, Y, X) and an index.csv sidecar mapping
+        the example id to its tissue and platform.
+    """
+    data = load_staged(split["npzfilepath"], cacheDir)
+    num_examples, Y, X, channels = data["X"].shape
+    storepath = pathlib.Path(outDir, split["name"] + ".zarr")
+
+    group = zarr.open_group(str(storepath), mode="w")
+    group.attrs["version"] = split["version"]
+    group.attrs["split"] = split["name"]
+    group.attrs["axes"] = ["example", "channel", "y", "x"]
+    for key, array in (("intensity", data["X"]), ("label", data["y"])):
+        zarr.open_array(
+            store=str(storepath.joinpath(key)),
+            mode="w",
+            shape=(num_examples, channels, Y, X),
+            chunks=(chunkExamples, 1, Y, X),
+            dtype=array.dtype,
+        )
+
+    with open(storepath.joinpath("index.csv"), "w", newline="") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(["example", "tissue", "platform"])
+        for ex in range(num_examples):
+            platform = split["platform"][ex] if split["platform"] is not None else ""
+            writer.writerow([ex, split["tissue"][ex], platform])
+
+    return storepath
+
+
+def write_examples_zarr(
+    split: dict,
+    start: int,
+    stop: int,
+    normalize: bool = False,
+    cacheDir: Optional[os.path] = None,
+) -> int:
+    """Write examples start..stop of a split into its zarr container
+    start and stop must fall on chunk boundaries so workers never share a chunk.
+    """
+    data = load_staged(split["npzfilepath"], cacheDir)
+    X, y = data["X"], data["y"]
+    normalize = normalize and split["version"] == "v1.1"
+    intensity = zarr.open_array(store=str(pathlib.Path(split["store"], "intensity")), mode="r+")
+    label = zarr.open_array(store=str(pathlib.Path(split["store"], "label")), mode="r+")
+
+    for ex in range(start, stop):
+        for ch, image, lab in example_channels(X, y, ex, normalize):
+            intensity[ex, ch] = image
+            label[ex, ch] = lab
+    return stop - start
+
+
+def read_store(storepath: os.path) -> tuple:
+    """Open a split written with the zarr layout
+    Returns:
+        The intensity and label arrays (examples, channels, Y, X) and a split
+        description with the per-example tissue and platform codes, usable
+        with example_filename to name each image as the file layout would.
+    """
+    group = zarr.open_group(str(storepath), mode="r")
+    intensity = zarr.open_array(store=str(pathlib.Path(storepath, "intensity")), mode="r")
+    label = zarr.open_array(store=str(pathlib.Path(storepath, "label")), mode="r")
+
+    tissue, platform = [], []
+    with open(pathlib.Path(storepath, "index.csv"), newline="") as fh:
+        for row in csv.DictReader(fh):
+            tissue.append(int(row["tissue"]))
+            platform.append(int(row["platform"]) if row["platform"] else None)
+
+    split = {
+        "name": group.attrs["split"],
+        "version": group.attrs["version"],
+        "num_examples": len(tissue),
+        "tissue": tissue,
+        "platform": platform if group.attrs["version"] == "v1.0" else None,
+    }
+    return intensity, label, split
+
+
+def parsing_tissuenet_data(
+    npzfilepath: os.path,
+    version: str,
+    outDir: os.path,
+    fileExtension: Optional[str] = ".ome.tif",
+    normalize: bool = False,
+    cacheDir: Optional[os.path] = None,
+):
+    """Parsing npz files into intensity and label images
+    Args:
+        npzfilepath (pathlib.Path): Directory path containing downloaded npz files
+        version (str): Select either of the two supported TissueNet data versions (v1.0 and v1.1)
+        outDir (pathlib.Path): Path to output directory
+        fileExtension (str): Type of data conversion. Default format is .ome.tif but can also generate '.ome.zarr' image files
+        cacheDir (pathlib.Path): Directory for the uncompressed .npy cache of the npz file
+    """
+    split = prepare_split(npzfilepath, version, outDir, cacheDir)
+    num_examples = split["num_examples"]
+    for start in tqdm(
+        range(0, num_examples, SHARD_SIZE),
+        desc="Extracting images",
+        unit="shards",
+    ):
+        write_examples(
+            split, start, min(start + SHARD_SIZE, num_examples), fileExtension, normalize, cacheDir
+        )
 
     return
 
 
-def tissue_data(root: str, version: str, fileExtension: str, normalize: bool):
+def _write_shard(shard: tuple, fileExtension: str, normalize: bool, cacheDir: Optional[str]) -> int:
+    split, start, stop = shard
+    if "store" in split:
+        return write_examples_zarr(split, start, stop, normalize, cacheDir)
+    return write_examples(split, start, stop, fileExtension, normalize, cacheDir)
+
+
+def tissue_data(
+    root: str,
+    version: str,
+    fileExtension: str,
+    normalize: bool,
+    cacheDir: Optional[str] = None,
+    layout: str = "files",
+    chunkExamples: int = CHUNK_EXAMPLES,
+):
+    """Parse the three TissueNet npz files of a version
+    Args:
+        root (str): Directory containing the raw subdirectory with the npz files
+        version (str): TissueNet version, v1.0 or v1.1
+        fileExtension (str): Image format of the files layout
+        normalize (bool): Min-max normalise v1.1 intensity images
+        cacheDir (str): Directory for the uncompressed .npy cache
+        layout (str): "files" writes one image per example, channel and kind,
+            "zarr" writes one chunked container per split
+        chunkExamples (int): Examples per chunk of the zarr layout
+    """
     starttime = time.time()
-    FILE_EXT = FILE_EXT if fileExtension is None else fileExtension
+    fileExtension = FILE_EXT if fileExtension is None else fileExtension
 
     print(f"Starting extracting and preparing datasets!!!")
 
@@ -248,20 +481,44 @@ def tissue_data(root: str, version: str, fileExtension: str, normalize: bool):
                 "Files are not downloaded completely!!Please download them again"
             )
 
-    num_workers = max(multiprocessing.cpu_count() // 2, 2)
+    with ThreadPool(processes=len(npzpath)) as executor:
+        splits = executor.map(
+            partial(prepare_split, version=version, outDir=outDir, cacheDir=cacheDir),
+            sorted(npzpath),
+        )
 
-    with multiprocessing.Pool(processes=num_workers) as executor:
+    shard_size = SHARD_SIZE
+    if layout == "zarr":
+        for split in splits:
+            split["store"] = create_store(split, outDir, chunkExamples, cacheDir)
+        # Shards must not share a chunk
+        shard_size = max(SHARD_SIZE // chunkExamples, 1) * chunkExamples
+
+    # Shard every split by example range so all cores work until the end
+    shards = [
+        (split, start, min(start + shard_size, split["num_examples"]))
+        for split in splits
+        for start in range(0, split["num_examples"], shard_size)
+    ]
+
+    num_workers = max(multiprocessing.cpu_count(), 2)
 
-        executor.map(
-            partial(
-                parsing_tissuenet_data,
-                version=version,
-                outDir=outDir,
-                fileExtension=fileExtension,
-                normalize=normalize,
+    with multiprocessing.Pool(processes=num_workers) as executor:
+        for _ in tqdm(
+            executor.imap_unordered(
+                partial(
+                    _write_shard,
+                    fileExtension=fileExtension,
+                    normalize=normalize,
+                    cacheDir=cacheDir,
+                ),
+                shards,
             ),
-            npzpath,
-        )
+            desc="Extracting images",
+            unit="shards",
+            total=len(shards),
+        ):
+            pass
 
         executor.close()
         executor.join()
@@ -270,11 +527,27 @@ def tissue_data(root: str, version: str, fileExtension: str, normalize: bool):
 
 
 def main():
+    """Usage: tissue_standard.py root version fileExtension normalize [layout] [chunkExamples] [cacheDir]"""
     root = str(sys.argv[1])
     version = str(sys.argv[2])
     fileExtension = str(sys.argv[3])
-    normalize = sys.argv[4]
-    
+    normalize = sys.argv[4].lower() in ("true", "1", "yes")
+    layout = sys.argv[5] if len(sys.argv) > 5 else "files"
+    chunkExamples = int(sys.argv[6]) if len(sys.argv) > 6 else CHUNK_EXAMPLES
+    cacheDir = sys.argv[7] if len(sys.argv) > 7 else None
+    if layout not in ("files", "zarr"):
+        raise ValueError(f"Unknown layout {layout}, use files or zarr")
+
+    tissue_data(
+        root,
+        version,
+        fileExtension,
+        normalize,
+        cacheDir=cacheDir,
+        layout=layout,
+        chunkExamples=chunkExamples,
+    )
+
 
 if __name__ == "__main__":
     main()